@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FLUX.1 DEV 异步API服务启动脚本
+需要安装可选依赖: pip install starlette uvicorn aiohttp
+"""
+
+import sys
+import os
+
+# 添加src目录到Python路径
+project_root = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(project_root, 'src')
+sys.path.insert(0, src_path)
+
+try:
+    import uvicorn
+    from src.asgi_server import app
+except ImportError as e:
+    print(f"缺少异步服务依赖: {e}")
+    print("请运行: pip install starlette uvicorn aiohttp")
+    sys.exit(1)
+
+from src.api_server import load_config, print_endpoints
+
+def main():
+    """主函数"""
+    print("=== FLUX.1 DEV API 服务器（异步） ===")
+    print()
+
+    config = load_config()
+    host = config['api']['host']
+    port = config['api']['port']
+    asgi_config = config['api'].get('asgi', {})
+
+    print("API服务器启动中...")
+    print_endpoints(host, port)
+
+    uvicorn.run(
+        app,
+        host=host,
+        port=port,
+        backlog=asgi_config.get('backlog', 2048),
+        timeout_keep_alive=asgi_config.get('timeout_keep_alive', 5),
+        log_level='info'
+    )
+
+if __name__ == "__main__":
+    main()
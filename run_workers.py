@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FLUX.1 DEV API 多进程服务启动脚本（Linux/macOS）
+工作进程数等配置见 config.json 的 api.workers
+"""
+
+import sys
+import os
+
+# 添加src目录到Python路径
+project_root = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(project_root, 'src')
+sys.path.insert(0, src_path)
+
+from src.api_server import load_config
+from src.workers import WorkerSupervisor
+
+if __name__ == "__main__":
+    supervisor = WorkerSupervisor(load_config(), project_root)
+    if not supervisor.run():
+        sys.exit(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制
+按在途任务数、预计等待时间和像素×步数预算决定是否接收新任务，超限的请求立即拒绝
+"""
+
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """新任务超出准入限制"""
+
+    def __init__(self, reason, message, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+        # 没有可用后端时返回503，超出负载限制时返回429
+        self.status_code = 503 if reason == 'unavailable' else 429
+
+class AdmissionController:
+    """准入控制类
+
+    admission.max_inflight_tasks   同时等待和执行的任务数上限
+    admission.max_estimated_wait   新任务预计等待时间上限（秒），默认等于任务超时时间，
+                                   超过它的任务即使接收也只会超时
+    admission.max_megapixel_steps  在途任务的百万像素×步数总预算，为空时不限制
+
+    结果缓存命中和合并到在途任务的请求不占用ComfyUI，不受限制。
+    所有后端都不健康或已熔断时立即拒绝（reason 为 unavailable），不受 admission.enabled 影响。
+    """
+
+    def __init__(self, admission_config, pool, default_max_wait):
+        self.pool = pool
+        self.enabled = admission_config.get('enabled', True)
+        self.max_inflight_tasks = admission_config.get('max_inflight_tasks', 100)
+        self.max_estimated_wait = admission_config.get('max_estimated_wait', default_max_wait)
+        self.max_megapixel_steps = admission_config.get('max_megapixel_steps')
+
+    def check(self, work, active_tasks, active_work, wait):
+        """检查新任务是否可以接收，超限时抛出 AdmissionRejected
+
+        wait 为新任务的预计等待时间（见 TaskManager.estimate）。
+        """
+        backends = self.pool.available_backends()
+        if not backends:
+            raise AdmissionRejected(
+                'unavailable', '没有可用的ComfyUI后端', self._retry_after(self.pool.retry_after())
+            )
+
+        if not self.enabled:
+            return
+        avg_execution_time = sum(backend.avg_execution_time for backend in backends) / len(backends)
+
+        if self.max_inflight_tasks and active_tasks >= self.max_inflight_tasks:
+            excess = active_tasks - self.max_inflight_tasks + 1
+            raise AdmissionRejected(
+                'inflight',
+                f'在途任务已达上限（{self.max_inflight_tasks}）',
+                self._retry_after(excess * avg_execution_time / len(backends))
+            )
+
+        if self.max_estimated_wait and wait is not None and wait > self.max_estimated_wait:
+            raise AdmissionRejected(
+                'wait',
+                f'预计等待时间 {wait:.0f} 秒超过上限（{self.max_estimated_wait}秒）',
+                self._retry_after(wait - self.max_estimated_wait)
+            )
+
+        # 单个任务超出预算时只在空闲时接收，避免永远无法执行
+        if self.max_megapixel_steps and active_work > 0 and active_work + work > self.max_megapixel_steps:
+            excess = active_work + work - self.max_megapixel_steps
+            raise AdmissionRejected(
+                'budget',
+                f'在途任务计算量已达上限（{self.max_megapixel_steps} 百万像素×步数）',
+                self._retry_after((wait or avg_execution_time) * excess / active_work)
+            )
+
+    def _retry_after(self, seconds):
+        return max(1, int(math.ceil(seconds)))
+
+    def get_stats(self):
+        """获取准入控制配置"""
+        return {
+            'enabled': self.enabled,
+            'max_inflight_tasks': self.max_inflight_tasks,
+            'max_estimated_wait': self.max_estimated_wait,
+            'max_megapixel_steps': self.max_megapixel_steps
+        }
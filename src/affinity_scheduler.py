@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+缓存亲和调度
+ComfyUI只重新执行输入发生变化的节点：与上一个prompt提示词相同的任务跳过文本编码，
+模型相同的任务跳过模型加载。在有限的公平窗口内调整提交顺序，并把任务路由到
+最近执行过相同提示词和模型的后端，以复用这些节点的输出；
+加载一个UNet模型远比一次生成耗时，因此限制每个后端在一段时间内更换模型的次数
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from .metrics import AFFINITY_HITS, MODEL_SWAPS
+
+logger = logging.getLogger(__name__)
+
+def encoder_key(params):
+    """文本编码节点（CLIPTextEncodeFlux）的输入"""
+    return (params.get('prompt'), params.get('guidance_scale'))
+
+def loader_key(params):
+    """模型加载节点的输入，未指定模型时为默认模型"""
+    return params.get('model')
+
+class AffinityScheduler:
+    """缓存亲和调度类
+
+    affinity.enabled                 是否启用
+    affinity.window                  每次从最早的多少个等待任务中挑选
+    affinity.max_skips               一个任务最多被后到的任务插队多少次，达到后必须下一个提交
+    affinity.max_queued_per_backend  每个后端最多同时排队多少个本服务提交的prompt
+    affinity.encoder_seconds         复用一次文本编码节省的秒数（用于估计节省的计算量）
+    affinity.loader_seconds          复用一次模型加载节省的秒数，也是更换模型的代价
+    affinity.max_model_swaps         每个后端在 swap_window 秒内最多更换几次模型
+    affinity.swap_window             统计更换模型次数的时间窗口（秒）
+    affinity.max_hold                任务在本服务最多排队多少秒，超过后下一个提交且不受更换次数限制，默认为任务超时的一半
+
+    ComfyUI按提交顺序执行，为了能调整顺序，任务先在本服务排队，后端排队的prompt数
+    低于 max_queued_per_backend 时才提交。每次选择节省时间最多的（任务, 后端）组合，
+    没有可复用的节点时按到达顺序提交到等待时间最短的后端。
+    需要更换模型的任务优先等待已加载该模型的后端，只有该后端的预计等待时间超过更换模型的代价，
+    且目标后端的更换次数未超过限制时才提交到其他后端。窗口内的任务都在等待换模型时，
+    继续在窗口之后查找不需要换模型的任务，避免空闲的后端等待。
+    未启用时按到达顺序立即提交，但仍统计可复用的节点，便于比较。
+    ComfyUI默认只缓存上一个prompt的节点输出，因此只比较各后端最近一次提交的prompt。
+    """
+
+    def __init__(self, affinity_config, pool, task_timeout=300):
+        self.pool = pool
+        self.enabled = affinity_config.get('enabled', False)
+        self.window = affinity_config.get('window', 16)
+        self.max_skips = affinity_config.get('max_skips', 4)
+        self.max_queued_per_backend = affinity_config.get('max_queued_per_backend', 2)
+        self.encoder_seconds = affinity_config.get('encoder_seconds', 0.5)
+        self.loader_seconds = affinity_config.get('loader_seconds', 30.0)
+        self.max_model_swaps = affinity_config.get('max_model_swaps', 2)
+        self.swap_window = affinity_config.get('swap_window', 600)
+        self.max_hold = affinity_config.get('max_hold') or task_timeout / 2
+
+        self._items = deque()  # {'task': 等待提交的任务, 'skips': 被插队次数}
+        self._reserved = {}    # 后端名 -> 已选定但尚未提交完成的任务数
+        self._last = {}        # 后端名 -> (最近一个prompt的文本编码输入, 模型)
+        self._swaps = {}       # 后端名 -> 最近更换模型的时间列表
+        self._cond = threading.Condition()
+        self._closed = False
+        self.reordered = 0
+        self.encoder_hits = 0
+        self.loader_hits = 0
+        self.model_swaps = 0
+        self.forced = 0
+
+    def put(self, task):
+        """加入一个等待提交的任务"""
+        with self._cond:
+            self._items.append({'task': task, 'skips': 0})
+            self._cond.notify()
+
+    def get(self, timeout=1.0):
+        """取出下一个要提交的任务，返回 (任务, 首选后端)，关闭后返回None
+
+        所有可用后端的排队已满时等待；timeout 为重新检查后端健康和熔断状态的间隔。
+        """
+        with self._cond:
+            while not self._closed:
+                if self._items:
+                    choice = self._select()
+                    if choice is not None:
+                        return choice
+                self._cond.wait(timeout if self._items else None)
+            return None
+
+    def submitted(self, preferred, backend_name, task):
+        """提交结束后调用，backend_name 为实际提交到的后端，提交失败时为None"""
+        with self._cond:
+            if preferred is not None and self._reserved.get(preferred.name, 0) > 0:
+                self._reserved[preferred.name] -= 1
+            if backend_name is not None:
+                encoder_hit, loader_hit = self._reuse(backend_name, task)
+                if encoder_hit:
+                    self.encoder_hits += 1
+                    AFFINITY_HITS.inc(kind='encoder')
+                if loader_hit:
+                    self.loader_hits += 1
+                    AFFINITY_HITS.inc(kind='loader')
+                model = loader_key(task.params)
+                loaded = self._loaded_model(backend_name, model)
+                if loaded != model:
+                    self.model_swaps += 1
+                    self._swaps.setdefault(backend_name, []).append(time.monotonic())
+                    MODEL_SWAPS.inc(backend=backend_name)
+                    logger.info(f"ComfyUI后端更换模型: {backend_name} - {loaded} -> {model}")
+                self._last[backend_name] = (encoder_key(task.params), model)
+            self._cond.notify_all()
+
+    def expire(self, timeout):
+        """移出排队超过timeout秒（从任务创建时算起）仍未提交的任务并返回"""
+        now = time.time()
+        with self._cond:
+            expired = [entry for entry in self._items if now - entry['task'].created_at > timeout]
+            for entry in expired:
+                self._items.remove(entry)
+        return [entry['task'] for entry in expired]
+
+    def notify(self):
+        """后端排队的prompt结束时调用，唤醒等待的提交线程"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def close(self):
+        """停止调度，等待中的提交线程返回None"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        """获取调度统计"""
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'window': self.window,
+                'max_skips': self.max_skips,
+                'max_queued_per_backend': self.max_queued_per_backend,
+                'held': len(self._items),
+                'reordered': self.reordered,
+                'encoder_hits': self.encoder_hits,
+                'loader_hits': self.loader_hits,
+                'estimated_saved_seconds': {
+                    'encoder': round(self.encoder_hits * self.encoder_seconds, 1),
+                    'loader': round(self.loader_hits * self.loader_seconds, 1)
+                },
+                'max_model_swaps': self.max_model_swaps,
+                'swap_window': self.swap_window,
+                'model_swaps': self.model_swaps,
+                'max_hold': self.max_hold,
+                'forced': self.forced,
+                'loaded_models': {name: model for name, (_, model) in self._last.items()}
+            }
+
+    def _reuse(self, backend_name, task):
+        """任务在该后端上是否可复用文本编码和模型加载"""
+        last = self._last.get(backend_name)
+        if last is None:
+            return False, False
+        encoder, model = last
+        return encoder_key(task.params) == encoder, loader_key(task.params) == model
+
+    def _loaded_model(self, backend_name, default):
+        """后端最近一次提交的prompt使用的模型，没有提交过（模型未知）时返回default"""
+        last = self._last.get(backend_name)
+        return default if last is None else last[1]
+
+    def _saving(self, backend_name, task):
+        encoder_hit, loader_hit = self._reuse(backend_name, task)
+        return (self.encoder_seconds if encoder_hit else 0) + (self.loader_seconds if loader_hit else 0)
+
+    def _needs_swap(self, backend, model):
+        return self._loaded_model(backend.name, model) != model
+
+    def _swap_allowed(self, backend, model, available):
+        """是否可以让该后端更换为model：已加载model的后端等待时间超过换模型的代价，且未超过更换次数限制"""
+        loaded = [b for b in available if b.name in self._last and self._last[b.name][1] == model]
+        if loaded and min(b.estimated_wait() for b in loaded) < self.loader_seconds:
+            return False
+        now = time.monotonic()
+        swaps = [t for t in self._swaps.get(backend.name, ()) if now - t < self.swap_window]
+        self._swaps[backend.name] = swaps
+        return len(swaps) < self.max_model_swaps
+
+    def _take(self, position):
+        entry = self._items[position]
+        del self._items[position]
+        return entry['task']
+
+    def _select(self):
+        if not self.enabled:
+            return self._take(0), None
+
+        available = self.pool.available_backends()
+        if not available:
+            # 没有可用后端时按到达顺序交给提交线程，由提交失败快速返回错误
+            return self._take(0), None
+        free = [
+            backend for backend in available
+            if backend.dispatched + self._reserved.get(backend.name, 0) < self.max_queued_per_backend
+        ]
+        if not free:
+            return None
+
+        # 排队超过 max_hold 的任务立即提交，必要时不受换模型次数限制
+        now = time.time()
+        for position, entry in enumerate(self._items):
+            if now - entry['task'].created_at >= self.max_hold:
+                best = self._best(free, available, [(position, entry)], force=True)
+                self.forced += 1
+                logger.warning(f"任务排队超过 {self.max_hold} 秒，立即提交 - 任务ID: {entry['task'].task_id}")
+                break
+        else:
+            # 插队次数已满的任务必须下一个提交，除非它暂时不能提交到任何空闲后端（等待换模型）
+            best = None
+            if self._items[0]['skips'] >= self.max_skips:
+                best = self._best(free, available, [(0, self._items[0])])
+            if best is None:
+                best = self._best(free, available, enumerate(islice(self._items, self.window)))
+            if best is None:
+                # 窗口内的任务都在等待换模型，提交窗口之后第一个不需要换模型的任务
+                best = self._best(
+                    free, available, islice(enumerate(self._items), self.window, None), allow_swap=False, first=True
+                )
+        if best is None:
+            return None
+        _, position, backend = best
+
+        if position:
+            self.reordered += 1
+            for entry in islice(self._items, position):
+                entry['skips'] += 1
+        self._reserved[backend.name] = self._reserved.get(backend.name, 0) + 1
+        return self._take(position), backend
+
+    def _best(self, free, available, candidates, allow_swap=True, force=False, first=False):
+        """在候选任务和空闲后端中选出节省时间最多的组合 (排序键, 任务位置, 后端)，没有可行组合时返回None
+
+        allow_swap 为False时只考虑不需要换模型的组合；force 为True时不受换模型的条件和次数限制；
+        first 为True时返回第一个有可行组合的任务。
+        """
+        best = None
+        for position, entry in candidates:
+            model = loader_key(entry['task'].params)
+            for backend in free:
+                saving = self._saving(backend.name, entry['task'])
+                if self._needs_swap(backend, model):
+                    if not allow_swap or not (force or self._swap_allowed(backend, model, available)):
+                        continue
+                    saving -= self.loader_seconds
+                rank = (saving, -position, -backend.estimated_wait())
+                if best is None or rank > best[0]:
+                    best = (rank, position, backend)
+            if first and best is not None:
+                break
+        return best
@@ -7,16 +7,19 @@ FLUX.1 DEV API服务器
 
 import os
 import json
-import uuid
 import time
 import logging
+import queue
 import base64
-from io import BytesIO
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
-from PIL import Image
-import requests
 from .comfyui_manager import ComfyUIManager
+from .task_manager import TaskManager, STATUS_COMPLETED, STATUSES
+from .result_cache import ResultCache
+from .image_derivatives import DerivativeService
+from .metadata_cache import select_encoding
+from .admission import AdmissionRejected
+from .metrics import REGISTRY, CONTENT_TYPE, STAGE_SECONDS, ERRORS, TIMEOUTS
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,6 +31,13 @@ CORS(app)
 # 全局变量
 config = None
 comfyui_manager = None
+task_manager = None
+result_cache = None
+derivatives = None
+# 启动时接管的未结束任务范围（TaskManager.recover 的参数），None为不接管；多进程部署时由工作进程设置
+task_recovery = {}
+# 多进程部署时由工作进程设置：是否负责图片清理、任务存储清理和元数据获取，None为单进程部署
+housekeeping = None
 
 def load_config():
     """加载配置文件"""
@@ -50,6 +60,8 @@ def validate_request(data):
     height = data.get('height', config['flux']['default_height'])
     steps = data.get('steps', config['flux']['default_steps'])
     guidance_scale = data.get('guidance_scale', config['flux']['default_guidance_scale'])
+    num_images = data.get('num_images', 1)
+    max_num_images = config['flux'].get('max_num_images', 4)
     
     if not isinstance(width, int) or width < 64 or width > config['flux']['max_width']:
         errors.append(f'width必须是64到{config["flux"]["max_width"]}之间的整数')
@@ -63,30 +75,177 @@ def validate_request(data):
     if not isinstance(guidance_scale, (int, float)) or guidance_scale < 0 or guidance_scale > 20:
         errors.append('guidance_scale必须是0到20之间的数值')
     
+    if not isinstance(num_images, int) or num_images < 1 or num_images > max_num_images:
+        errors.append(f'num_images必须是1到{max_num_images}之间的整数')
+    
+    model = data.get('model')
+    if model is not None:
+        if comfyui_manager.default_model is None:
+            errors.append('工作流模板没有唯一的UNETLoader节点，不能指定model')
+        elif not isinstance(model, str) or not model:
+            errors.append('model必须是模型文件名')
+        else:
+            # 按缓存的 /models 列表校验；列表不可用时交给ComfyUI在提交时校验
+            unet_models = comfyui_manager.get_available_models().get('unet')
+            if unet_models is not None and model not in unet_models:
+                errors.append(f'model必须是可用的UNet模型之一: {unet_models}')
+    
     return errors
 
+def request_params(data):
+    """从已验证的请求数据中提取生成参数，未提供的使用默认值"""
+    return {
+        'prompt': data['prompt'].strip(),
+        'width': data.get('width', config['flux']['default_width']),
+        'height': data.get('height', config['flux']['default_height']),
+        'steps': data.get('steps', config['flux']['default_steps']),
+        'guidance_scale': data.get('guidance_scale', config['flux']['default_guidance_scale']),
+        'seed': data.get('seed', -1),
+        'num_images': data.get('num_images', 1),
+        'model': data.get('model') or comfyui_manager.default_model
+    }
+
+def status_info(comfyui_status):
+    """服务状态信息"""
+    return {
+        'status': 'running',
+        'comfyui_status': comfyui_status,
+        'version': '1.0.0',
+        'supported_models': ['FLUX.1-dev'],
+        'max_resolution': {
+            'width': config['flux']['max_width'],
+            'height': config['flux']['max_height']
+        },
+        'max_steps': config['flux']['max_steps'],
+        'tasks': task_manager.get_stats(),
+        'backends': comfyui_manager.pool.get_stats(),
+        'cache': result_cache.get_stats(),
+        'storage': comfyui_manager.images.get_stats(),
+        'metadata': comfyui_manager.metadata.get_stats(),
+        'estimator': comfyui_manager.estimator.get_stats()
+    }
+
+def generation_result(task, image_base64=None):
+    """同步生成完成时的响应内容"""
+    return {
+        'task_id': task.task_id,
+        'status': 'completed',
+        'image_url': f'/image/{task.task_id}',
+        'image_urls': [f'/image/{image_id}' for image_id in task.image_ids],
+        'parameters': dict(task.params, seed=task.seed),
+        'generation_time': task.generation_time,
+        'cached': task.cached,
+        'image_base64': image_base64  # 可选：返回base64编码的图片
+    }
+
+def task_list_params(args):
+    """解析任务列表的查询参数（status、limit、offset），返回 (参数, 错误列表)"""
+    errors = []
+    status = [s for s in args.get('status', '').split(',') if s]
+    unknown = [s for s in status if s not in STATUSES]
+    if unknown:
+        errors.append(f'status必须是{"、".join(STATUSES)}之一')
+    try:
+        limit = int(args.get('limit', 20))
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        return None, ['limit和offset必须是整数']
+    if limit < 1 or limit > 100:
+        errors.append('limit必须是1到100之间的整数')
+    if offset < 0:
+        errors.append('offset不能小于0')
+    return {'status': status, 'limit': limit, 'offset': offset}, errors
+
+def task_list(status, limit, offset):
+    """任务列表的响应内容"""
+    tasks, total = task_manager.list_tasks(status, limit, offset)
+    return {
+        'tasks': [task.to_dict() for task in tasks],
+        'total': total,
+        'limit': limit,
+        'offset': offset
+    }
+
+def resolve_image(image_id, args):
+    """按查询参数（w、h、format、q）获取原图或派生图片，返回 (图片, MIME类型, 错误列表)
+    
+    图片为 ImageStore.get 返回的 {'path', 'size', 'checksum'}，不存在（或已过期清理）时为None；
+    派生图片尚未生成时等待编码完成。
+    """
+    spec, errors = derivatives.parse(args)
+    if errors:
+        return None, None, errors
+    if spec is None:
+        return comfyui_manager.images.get(f'{image_id}.png'), 'image/png', []
+    return derivatives.get(image_id, spec), derivatives.mimetype(spec), []
+
+def image_cache_headers(image):
+    """图片响应的缓存头：内容哈希作为强ETag；同一URL的内容不会改变，允许长期缓存"""
+    max_age = config.get('storage', {}).get('cache_max_age', 365 * 24 * 3600)
+    return {
+        'ETag': f'"{image["checksum"]}"',
+        'Cache-Control': f'public, max-age={max_age}, immutable'
+    }
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match 是否匹配（弱比较，见RFC 9110）"""
+    if if_none_match.strip() == '*':
+        return True
+    return any(
+        candidate.strip().removeprefix('W/') == etag
+        for candidate in if_none_match.split(',')
+    )
+
+def cached_json(encoded):
+    """返回元数据缓存中预先编码的JSON响应，客户端支持时返回gzip压缩内容"""
+    body, headers = select_encoding(encoded, request.headers.get('Accept-Encoding'))
+    return Response(body, headers=headers)
+
 @app.route('/status', methods=['GET'])
 def get_status():
     """获取服务状态"""
     try:
-        # 检查ComfyUI状态
-        comfyui_status = comfyui_manager.check_status()
-        
-        return jsonify({
-            'status': 'running',
-            'comfyui_status': comfyui_status,
-            'version': '1.0.0',
-            'supported_models': ['FLUX.1-dev'],
-            'max_resolution': {
-                'width': config['flux']['max_width'],
-                'height': config['flux']['max_height']
-            },
-            'max_steps': config['flux']['max_steps']
-        })
+        # ComfyUI状态由健康检查线程维护，响应缓存 metadata.status_ttl 秒
+        encoded = comfyui_manager.metadata.status_response(
+            lambda: status_info(comfyui_manager.available)
+        )
+        return cached_json(encoded)
     except Exception as e:
         logger.error(f"获取状态失败: {e}")
         return jsonify({'error': str(e)}), 500
 
+def is_async_request(data):
+    """判断是否以异步模式提交（请求体 async 字段或 ?async=1）"""
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return bool(data.get('async', False))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus格式的运行指标"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/estimate', methods=['POST'])
+def estimate_generation():
+    """估计生成请求的等待时间和完成时间，不提交任务"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': '请求数据不能为空'}), 400
+        
+        errors = validate_request(data)
+        if errors:
+            return jsonify({'error': '参数错误', 'details': errors}), 400
+        
+        estimate = task_manager.estimate(request_params(data))
+        if estimate is None:
+            return jsonify({'error': '没有可用的ComfyUI后端'}), 503
+        return jsonify(estimate)
+        
+    except Exception as e:
+        logger.error(f"估计生成时间失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/generate', methods=['POST'])
 def generate_image():
     """生成图片"""
@@ -97,82 +256,154 @@ def generate_image():
             return jsonify({'error': '请求数据不能为空'}), 400
         
         # 验证参数
-        errors = validate_request(data)
+        with STAGE_SECONDS.time(stage='validation'):
+            errors = validate_request(data)
         if errors:
+            ERRORS.inc(stage='validation')
             return jsonify({'error': '参数错误', 'details': errors}), 400
         
         # 提取参数
-        prompt = data['prompt'].strip()
-        width = data.get('width', config['flux']['default_width'])
-        height = data.get('height', config['flux']['default_height'])
-        steps = data.get('steps', config['flux']['default_steps'])
-        guidance_scale = data.get('guidance_scale', config['flux']['default_guidance_scale'])
-        seed = data.get('seed', -1)
+        params = request_params(data)
         
-        # 生成任务ID
-        task_id = str(uuid.uuid4())
+        # 创建任务，由后台分发线程提交到ComfyUI；超出准入限制时立即拒绝
+        try:
+            task = task_manager.submit(params)
+        except AdmissionRejected as e:
+            logger.warning(f"拒绝生成请求: {e}")
+            response = jsonify({'error': str(e), 'reason': e.reason, 'retry_after': e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, e.status_code
+        task_id = task.task_id
         
         logger.info(f"开始生成图片 - 任务ID: {task_id}")
-        logger.info(f"参数: prompt='{prompt}', size={width}x{height}, steps={steps}, guidance={guidance_scale}")
-        
-        # 调用ComfyUI生成图片
-        result = comfyui_manager.generate_image(
-            prompt=prompt,
-            width=width,
-            height=height,
-            steps=steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            task_id=task_id
+        logger.info(
+            f"参数: prompt='{params['prompt']}', size={params['width']}x{params['height']}, "
+            f"steps={params['steps']}, guidance={params['guidance_scale']}, num_images={params['num_images']}"
         )
         
-        if not result['success']:
-            logger.error(f"图片生成失败: {result['error']}")
-            return jsonify({'error': result['error']}), 500
+        # 异步模式：立即返回任务句柄
+        if is_async_request(data):
+            response = jsonify({
+                'task_id': task_id,
+                'status': task.status,
+                'status_url': f'/tasks/{task_id}',
+                'image_url': f'/image/{task_id}'
+            })
+            response.headers['Location'] = f'/tasks/{task_id}'
+            return response, 202
+        
+        # 同步模式：等待任务结束
+        if not task.wait(task_manager.timeout + 60):
+            TIMEOUTS.inc(kind='request')
+            return jsonify({'error': f'生成超时（{task_manager.timeout}秒）', 'task_id': task_id}), 504
+        
+        if task.status != STATUS_COMPLETED:
+            logger.error(f"图片生成失败: {task.error}")
+            return jsonify({'error': task.error}), 500
+        
+        encode_started = time.perf_counter()
+        
+        # 可选：转换为base64
+        image_base64 = None
+        try:
+            with open(task.image_path, 'rb') as f:
+                image_base64 = base64.b64encode(f.read()).decode('utf-8')
+        except Exception as e:
+            logger.warning(f"转换base64失败: {e}")
         
         # 返回结果
-        response = {
-            'task_id': task_id,
-            'status': 'completed',
-            'image_url': f'/image/{task_id}',
-            'parameters': {
-                'prompt': prompt,
-                'width': width,
-                'height': height,
-                'steps': steps,
-                'guidance_scale': guidance_scale,
-                'seed': result.get('seed', seed)
-            },
-            'generation_time': result.get('generation_time', 0),
-            'image_base64': result.get('image_base64')  # 可选：返回base64编码的图片
-        }
+        response = generation_result(task, image_base64)
         
-        logger.info(f"图片生成完成 - 任务ID: {task_id}, 耗时: {result.get('generation_time', 0):.2f}秒")
+        logger.info(f"图片生成完成 - 任务ID: {task_id}, 耗时: {task.generation_time:.2f}秒")
         
-        return jsonify(response)
+        response = jsonify(response)
+        STAGE_SECONDS.observe(time.perf_counter() - encode_started, stage='encode')
+        return response
         
     except Exception as e:
         logger.error(f"生成图片异常: {e}")
         return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
 
+@app.route('/tasks', methods=['GET'])
+def list_tasks():
+    """按创建时间倒序分页列出任务"""
+    try:
+        params, errors = task_list_params(request.args)
+        if errors:
+            return jsonify({'error': '参数错误', 'details': errors}), 400
+        return jsonify(task_list(**params))
+    except Exception as e:
+        logger.error(f"获取任务列表失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/tasks/<task_id>', methods=['GET'])
+def get_task(task_id):
+    """获取任务状态和结果"""
+    try:
+        task = task_manager.get_task(task_id)
+        if task is None:
+            return jsonify({'error': f'任务不存在: {task_id}'}), 404
+        return jsonify(task.to_dict())
+    except Exception as e:
+        logger.error(f"获取任务状态失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def format_sse(event_type, data):
+    """格式化为Server-Sent Events消息"""
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/tasks/<task_id>/events', methods=['GET'])
+def get_task_events(task_id):
+    """以Server-Sent Events推送任务的排队位置、执行节点、采样进度和最终结果"""
+    task = task_manager.get_task(task_id)
+    if task is None:
+        return jsonify({'error': f'任务不存在: {task_id}'}), 404
+    
+    keepalive_interval = config.get('tasks', {}).get('sse_keepalive', 15)
+    
+    def stream():
+        events = task.subscribe()
+        try:
+            # 先推送当前状态；订阅之后再检查是否结束，避免错过结束事件
+            yield format_sse('status', task.to_dict())
+            if task.done:
+                yield format_sse(task.status, task.to_dict())
+                return
+            while True:
+                try:
+                    event_type, data = events.get(timeout=keepalive_interval)
+                except queue.Empty:
+                    # 注释行保持连接，防止代理因空闲断开
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event_type, data)
+                if event_type in ('completed', 'failed'):
+                    return
+        finally:
+            task.unsubscribe(events)
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/image/<task_id>', methods=['GET'])
 def get_image(task_id):
     """获取生成的图片"""
     try:
-        # 使用绝对路径确保路径正确
-        # 获取项目根目录（src的上级目录）
-        current_dir = os.path.dirname(os.path.abspath(__file__))  # src目录
-        project_root = os.path.dirname(current_dir)  # 项目根目录
-        image_path = os.path.join(project_root, 'output', f'{task_id}.png')
-        
-        logger.info(f"查找图片文件: {image_path}")
-        
-        if not os.path.exists(image_path):
-            logger.error(f"图片文件不存在: {image_path}")
+        image, mimetype, errors = resolve_image(task_id, request.args)
+        if errors:
+            return jsonify({'error': '参数错误', 'details': errors}), 400
+        if image is None:
+            logger.error(f"图片文件不存在: {task_id}")
             return jsonify({'error': f'图片不存在: {task_id}'}), 404
         
-        logger.info(f"成功找到图片文件: {image_path}")
-        return send_file(image_path, mimetype='image/png')
+        # send_file 处理 If-None-Match（304）和 Range（206）
+        headers = image_cache_headers(image)
+        response = send_file(image['path'], mimetype=mimetype, etag=image['checksum'], conditional=True)
+        response.headers['Cache-Control'] = headers['Cache-Control']
+        return response
         
     except Exception as e:
         logger.error(f"获取图片失败: {e}")
@@ -182,8 +413,7 @@ def get_image(task_id):
 def get_models():
     """获取可用模型列表"""
     try:
-        models = comfyui_manager.get_available_models()
-        return jsonify({'models': models})
+        return cached_json(comfyui_manager.metadata.models_response())
     except Exception as e:
         logger.error(f"获取模型列表失败: {e}")
         return jsonify({'error': str(e)}), 500
@@ -206,20 +436,29 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'error': '服务器内部错误'}), 500
 
-def main():
-    """主函数"""
-    global comfyui_manager
-    
-    print("=== FLUX.1 DEV API 服务器 ===")
+def print_endpoints(host, port):
+    """打印服务地址和API端点"""
+    print(f"地址: http://{host}:{port}")
+    print(f"文档: http://{host}:{port}/status")
     print()
-    
-    # 加载配置
-    try:
-        load_config()
-        logger.info("配置文件加载成功")
-    except Exception as e:
-        logger.error(f"加载配置文件失败: {e}")
-        return
+    print("API端点:")
+    print("  POST /generate - 生成图片（async=true 立即返回任务ID）")
+    print("  POST /estimate - 预计等待和完成时间")
+    print("  GET  /tasks    - 任务列表（status、limit、offset）")
+    print("  GET  /tasks/<id> - 任务状态")
+    print("  GET  /tasks/<id>/events - 任务进度（SSE）")
+    print("  GET  /image/<id> - 获取图片（w、h、format、q 获取缩略图或WebP/JPEG）")
+    print("  GET  /status   - 查看状态")
+    print("  GET  /models   - 模型列表")
+    print("  GET  /queue    - 队列状态")
+    print("  GET  /metrics  - 运行指标（Prometheus格式）")
+    print()
+    print("按Ctrl+C停止服务")
+    print()
+
+def init_services():
+    """初始化ComfyUI管理器、结果缓存和任务管理器，返回是否成功"""
+    global comfyui_manager, task_manager, result_cache, derivatives
     
     # 初始化ComfyUI管理器
     try:
@@ -227,34 +466,55 @@ def main():
         logger.info("ComfyUI管理器初始化成功")
     except Exception as e:
         logger.error(f"ComfyUI管理器初始化失败: {e}")
-        return
+        return False
     
     # 检查ComfyUI服务状态
     if not comfyui_manager.check_status():
         logger.error("ComfyUI服务未运行")
         logger.error("请先运行 'python start_comfyui.py' 启动ComfyUI服务")
+        return False
+    
+    # 启动后端池（WebSocket事件监听和健康检查）
+    comfyui_manager.start(housekeeping)
+    
+    # 结果缓存
+    result_cache = ResultCache(config.get('cache', {}), comfyui_manager.project_root)
+    
+    # 缩略图等派生图片
+    derivatives = DerivativeService(config.get('derivatives', {}), comfyui_manager.images)
+    
+    # 启动任务管理器
+    task_manager = TaskManager(comfyui_manager, config, result_cache)
+    task_manager.start(housekeeping is not False)
+    
+    # 接管重启前未结束的任务
+    if task_recovery is not None:
+        task_manager.recover(**task_recovery)
+    return True
+
+def main():
+    """主函数"""
+    print("=== FLUX.1 DEV API 服务器 ===")
+    print()
+    
+    # 加载配置
+    try:
+        load_config()
+        logger.info("配置文件加载成功")
+    except Exception as e:
+        logger.error(f"加载配置文件失败: {e}")
         return
     
-    # 创建输出目录
-    os.makedirs('output', exist_ok=True)
+    if not init_services():
+        return
     
     # 启动API服务器
     host = config['api']['host']
     port = config['api']['port']
     debug = config['api']['debug']
     
-    print(f"API服务器启动中...")
-    print(f"地址: http://{host}:{port}")
-    print(f"文档: http://{host}:{port}/status")
-    print()
-    print("API端点:")
-    print(f"  POST /generate - 生成图片")
-    print(f"  GET  /status   - 查看状态")
-    print(f"  GET  /models   - 模型列表")
-    print(f"  GET  /queue    - 队列状态")
-    print()
-    print("按Ctrl+C停止服务")
-    print()
+    print("API服务器启动中...")
+    print_endpoints(host, port)
     
     try:
         app.run(host=host, port=port, debug=debug)
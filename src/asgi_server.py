@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FLUX.1 DEV 异步API服务器
+基于Starlette的ASGI应用，提供与 api_server 相同的REST API接口；
+等待生成结果和推送进度的连接以协程挂起，不占用线程
+"""
+
+import time
+import base64
+import asyncio
+import logging
+from functools import partial
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, FileResponse, Response, StreamingResponse
+from starlette.routing import Route
+from . import api_server as api
+from .comfyui_manager import ComfyUIManager
+from .comfyui_async import AsyncComfyUIEventListener, AsyncComfyUIClient
+from .task_manager import TaskManager, STATUS_COMPLETED
+from .result_cache import ResultCache
+from .image_derivatives import DerivativeService
+from .metadata_cache import select_encoding
+from .admission import AdmissionRejected
+from .metrics import REGISTRY, CONTENT_TYPE, STAGE_SECONDS, ERRORS, TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+# ComfyUI异步客户端，启动时创建
+comfyui_client = None
+
+# 退出前等待已接收任务结束的最长时间（秒），多进程部署时由工作进程设置
+drain_timeout = 0
+
+class LoopQueue:
+    """把任务事件从工作线程转交到事件循环中的asyncio队列，可作为 Task.subscribe 的队列"""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+
+    def put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # 事件循环已关闭（服务正在退出）
+            pass
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+async def wait_task(task, timeout):
+    """等待任务结束，返回是否在超时前结束"""
+    events = task.subscribe(LoopQueue(asyncio.get_running_loop()))
+    try:
+        # 订阅之后再检查是否结束，避免错过结束事件
+        deadline = time.monotonic() + timeout
+        while not task.done:
+            event_type, _ = await events.get(max(deadline - time.monotonic(), 0))
+            if event_type in ('completed', 'failed'):
+                break
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        task.unsubscribe(events)
+
+def encode_image(image_path):
+    """读取图片并转换为base64"""
+    with open(image_path, 'rb') as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+def is_async_request(request, data):
+    """判断是否以异步模式提交（请求体 async 字段或 ?async=1）"""
+    if request.query_params.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return bool(data.get('async', False))
+
+async def read_json(request):
+    """解析请求体JSON，格式错误时返回None"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+def cached_json(request, encoded):
+    """返回元数据缓存中预先编码的JSON响应，客户端支持时返回gzip压缩内容"""
+    body, headers = select_encoding(encoded, request.headers.get('accept-encoding'))
+    return Response(body, headers=headers)
+
+async def get_status(request):
+    """获取服务状态"""
+    try:
+        # ComfyUI状态由健康检查维护，响应缓存 metadata.status_ttl 秒；生成时读取图片存储统计，不能阻塞事件循环
+        encoded = await run_in_threadpool(
+            api.comfyui_manager.metadata.status_response,
+            lambda: api.status_info(api.comfyui_manager.available)
+        )
+        return cached_json(request, encoded)
+    except Exception as e:
+        logger.error(f"获取状态失败: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def get_metrics(request):
+    """Prometheus格式的运行指标"""
+    return Response(REGISTRY.render(), headers={'Content-Type': CONTENT_TYPE})
+
+async def estimate_generation(request):
+    """估计生成请求的等待时间和完成时间，不提交任务"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return JSONResponse({'error': '请求数据不能为空'}, status_code=400)
+
+        # 校验model时可能同步获取 /object_info，不能阻塞事件循环
+        errors = await run_in_threadpool(api.validate_request, data)
+        if errors:
+            return JSONResponse({'error': '参数错误', 'details': errors}, status_code=400)
+
+        estimate = await run_in_threadpool(api.task_manager.estimate, api.request_params(data))
+        if estimate is None:
+            return JSONResponse({'error': '没有可用的ComfyUI后端'}, status_code=503)
+        return JSONResponse(estimate)
+
+    except Exception as e:
+        logger.error(f"估计生成时间失败: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def generate_image(request):
+    """生成图片"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return JSONResponse({'error': '请求数据不能为空'}, status_code=400)
+
+        # 验证参数
+        with STAGE_SECONDS.time(stage='validation'):
+            errors = await run_in_threadpool(api.validate_request, data)
+        if errors:
+            ERRORS.inc(stage='validation')
+            return JSONResponse({'error': '参数错误', 'details': errors}, status_code=400)
+
+        params = api.request_params(data)
+
+        # 创建任务，由后台分发线程提交到ComfyUI；超出准入限制时立即拒绝
+        # 保存任务和命中结果缓存时复制图片都要读写磁盘，在线程池中进行
+        try:
+            task = await run_in_threadpool(api.task_manager.submit, params)
+        except AdmissionRejected as e:
+            logger.warning(f"拒绝生成请求: {e}")
+            return JSONResponse(
+                {'error': str(e), 'reason': e.reason, 'retry_after': e.retry_after},
+                status_code=e.status_code,
+                headers={'Retry-After': str(e.retry_after)}
+            )
+        task_id = task.task_id
+
+        logger.info(f"开始生成图片 - 任务ID: {task_id}")
+
+        # 异步模式：立即返回任务句柄
+        if is_async_request(request, data):
+            return JSONResponse({
+                'task_id': task_id,
+                'status': task.status,
+                'status_url': f'/tasks/{task_id}',
+                'image_url': f'/image/{task_id}'
+            }, status_code=202, headers={'Location': f'/tasks/{task_id}'})
+
+        # 同步模式：挂起等待任务结束
+        if not await wait_task(task, api.task_manager.timeout + 60):
+            TIMEOUTS.inc(kind='request')
+            return JSONResponse(
+                {'error': f'生成超时（{api.task_manager.timeout}秒）', 'task_id': task_id}, status_code=504
+            )
+
+        if task.status != STATUS_COMPLETED:
+            logger.error(f"图片生成失败: {task.error}")
+            return JSONResponse({'error': task.error}, status_code=500)
+
+        encode_started = time.perf_counter()
+
+        # 读取和编码图片在线程池中进行，不阻塞事件循环
+        image_base64 = None
+        try:
+            image_base64 = await run_in_threadpool(encode_image, task.image_path)
+        except Exception as e:
+            logger.warning(f"转换base64失败: {e}")
+
+        logger.info(f"图片生成完成 - 任务ID: {task_id}, 耗时: {task.generation_time:.2f}秒")
+
+        response = JSONResponse(api.generation_result(task, image_base64))
+        STAGE_SECONDS.observe(time.perf_counter() - encode_started, stage='encode')
+        return response
+
+    except Exception as e:
+        logger.error(f"生成图片异常: {e}")
+        return JSONResponse({'error': f'服务器内部错误: {str(e)}'}, status_code=500)
+
+async def list_tasks(request):
+    """按创建时间倒序分页列出任务"""
+    try:
+        params, errors = api.task_list_params(request.query_params)
+        if errors:
+            return JSONResponse({'error': '参数错误', 'details': errors}, status_code=400)
+        return JSONResponse(await run_in_threadpool(api.task_list, **params))
+    except Exception as e:
+        logger.error(f"获取任务列表失败: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def get_task(request):
+    """获取任务状态和结果"""
+    task_id = request.path_params['task_id']
+    # 其他工作进程创建的任务从任务存储读取
+    task = await run_in_threadpool(api.task_manager.get_task, task_id)
+    if task is None:
+        return JSONResponse({'error': f'任务不存在: {task_id}'}, status_code=404)
+    return JSONResponse(task.to_dict())
+
+async def get_task_events(request):
+    """以Server-Sent Events推送任务的排队位置、执行节点、采样进度和最终结果"""
+    task_id = request.path_params['task_id']
+    task = await run_in_threadpool(api.task_manager.get_task, task_id)
+    if task is None:
+        return JSONResponse({'error': f'任务不存在: {task_id}'}, status_code=404)
+
+    keepalive_interval = api.config.get('tasks', {}).get('sse_keepalive', 15)
+
+    async def stream():
+        events = task.subscribe(LoopQueue(asyncio.get_running_loop()))
+        try:
+            yield api.format_sse('status', task.to_dict())
+            if task.done:
+                yield api.format_sse(task.status, task.to_dict())
+                return
+            while True:
+                try:
+                    event_type, data = await events.get(keepalive_interval)
+                except asyncio.TimeoutError:
+                    # 注释行保持连接，防止代理因空闲断开
+                    yield ": keepalive\n\n"
+                    continue
+                yield api.format_sse(event_type, data)
+                if event_type in ('completed', 'failed'):
+                    return
+        finally:
+            task.unsubscribe(events)
+
+    return StreamingResponse(
+        stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+async def get_image(request):
+    """获取生成的图片"""
+    task_id = request.path_params['task_id']
+    image, mimetype, errors = await run_in_threadpool(api.resolve_image, task_id, request.query_params)
+    if errors:
+        return JSONResponse({'error': '参数错误', 'details': errors}, status_code=400)
+    if image is None:
+        logger.error(f"图片文件不存在: {task_id}")
+        return JSONResponse({'error': f'图片不存在: {task_id}'}, status_code=404)
+
+    headers = api.image_cache_headers(image)
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and api.etag_matches(if_none_match, headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    # FileResponse 处理 Range（206）
+    return FileResponse(image['path'], media_type=mimetype, headers=headers)
+
+async def get_models(request):
+    """获取可用模型列表"""
+    try:
+        metadata = api.comfyui_manager.metadata
+        if metadata.index is None:
+            # 首次请求时尚无索引，获取 /object_info 期间不阻塞事件循环
+            await run_in_threadpool(metadata.ensure_index)
+        return cached_json(request, metadata.models_response())
+    except Exception as e:
+        logger.error(f"获取模型列表失败: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def get_queue(request):
+    """获取生成队列状态"""
+    try:
+        return JSONResponse(await comfyui_client.get_queue_status())
+    except Exception as e:
+        logger.error(f"获取队列状态失败: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def not_found(request, exc):
+    return JSONResponse({'error': '接口不存在'}, status_code=404)
+
+async def internal_error(request, exc):
+    return JSONResponse({'error': '服务器内部错误'}, status_code=500)
+
+@asynccontextmanager
+async def lifespan(app):
+    """启动时初始化ComfyUI连接和任务管理器，退出时停止"""
+    global comfyui_client
+
+    config = api.config or api.load_config()
+    loop = asyncio.get_running_loop()
+
+    # 事件连接在本事件循环中以协程维护
+    api.comfyui_manager = ComfyUIManager(
+        config, event_listener_class=partial(AsyncComfyUIEventListener, loop=loop)
+    )
+    comfyui_client = AsyncComfyUIClient(api.comfyui_manager)
+    await comfyui_client.start()
+
+    if not await comfyui_client.check_status():
+        await comfyui_client.close()
+        raise RuntimeError("ComfyUI服务未运行，请先运行 'python start_comfyui.py' 启动ComfyUI服务")
+
+    api.comfyui_manager.start(api.housekeeping)
+    api.result_cache = ResultCache(config.get('cache', {}), api.comfyui_manager.project_root)
+    api.derivatives = DerivativeService(config.get('derivatives', {}), api.comfyui_manager.images)
+    api.task_manager = TaskManager(api.comfyui_manager, config, api.result_cache)
+    api.task_manager.start(api.housekeeping is not False)
+    if api.task_recovery is not None:
+        await run_in_threadpool(api.task_manager.recover, **api.task_recovery)
+    logger.info("异步API服务器初始化完成")
+
+    try:
+        yield
+    finally:
+        if drain_timeout and not await run_in_threadpool(api.task_manager.drain, drain_timeout):
+            logger.warning("等待任务结束超时，仍有未完成的任务")
+        api.task_manager.stop()
+        api.derivatives.stop()
+        api.comfyui_manager.stop()
+        await comfyui_client.close()
+        logger.info("API服务器已停止")
+
+app = Starlette(
+    routes=[
+        Route('/status', get_status, methods=['GET']),
+        Route('/metrics', get_metrics, methods=['GET']),
+        Route('/estimate', estimate_generation, methods=['POST']),
+        Route('/generate', generate_image, methods=['POST']),
+        Route('/tasks', list_tasks, methods=['GET']),
+        Route('/tasks/{task_id}', get_task, methods=['GET']),
+        Route('/tasks/{task_id}/events', get_task_events, methods=['GET']),
+        Route('/image/{task_id}', get_image, methods=['GET']),
+        Route('/models', get_models, methods=['GET']),
+        Route('/queue', get_queue, methods=['GET'])
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={404: not_found, 500: internal_error},
+    lifespan=lifespan
+)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ComfyUI后端池
+管理多个ComfyUI实例的健康状态、队列深度和任务路由
+"""
+
+import time
+import uuid
+import logging
+import threading
+from .http_pool import ComfyUIHttpClient
+from .circuit_breaker import CircuitBreaker, STATE_CLOSED
+from .comfyui_events import ComfyUIEventListener, EVENT_CONNECTED, EVENT_DISCONNECTED
+
+logger = logging.getLogger(__name__)
+
+class ComfyUIBackend:
+    """单个ComfyUI后端"""
+
+    def __init__(self, name, host, port, comfyui_config, backend_config=None, event_listener_class=None):
+        backend_config = backend_config or {}
+        self.name = name
+        self.host = host
+        self.port = port
+        self.base_url = f"http://{host}:{port}"
+        self.ws_url = f"ws://{host}:{port}/ws"
+
+        # 图片传输方式：http 通过 /view 下载；local 直接从ComfyUI输出目录链接或移动
+        self.transfer_mode = backend_config.get('transfer_mode', comfyui_config.get('transfer_mode', 'http'))
+        self.output_dir = backend_config.get('output_dir')
+
+        # keep-alive连接池
+        self.http = ComfyUIHttpClient(self.base_url, comfyui_config.get('http'))
+
+        # WebSocket事件监听，提交工作流时携带client_id以接收对应事件
+        self.client_id = str(uuid.uuid4())
+        self.events = (event_listener_class or ComfyUIEventListener)(
+            self.ws_url,
+            self.client_id,
+            reconnect_interval=comfyui_config.get('ws_reconnect_interval', 2.0)
+        )
+        self.connection_epoch = 0      # 每次事件连接建立时递增
+        self.reconciled_epoch = 0      # 最近一次对账时的连接代数
+
+        # 健康状态
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_error = None
+        self.last_checked = None
+        # 熔断器：提交失败、生成超时和事件连接断开时计数
+        self.breaker = CircuitBreaker(name, comfyui_config.get('circuit_breaker'))
+
+        # 队列深度：ComfyUI上报的剩余任务数，以及本服务提交但尚未结束的prompt数
+        self.queue_remaining = 0
+        self.dispatched = 0
+        self.dispatched_cost = 0.0     # 本服务已提交prompt的预计执行时间之和
+        self.avg_execution_time = comfyui_config.get('default_execution_time', 20.0)
+        self._execution_starts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def events_connected(self):
+        return self.events.connected
+
+    @property
+    def queue_depth(self):
+        # status事件可能滞后于刚提交的prompt，取两者较大值
+        return max(self.queue_remaining, self.dispatched)
+
+    def estimated_wait(self):
+        """估计新任务的等待时间（秒）
+
+        本服务提交的prompt按各自的预计执行时间累计，其他客户端提交的按平均执行时间估计。
+        """
+        external = max(self.queue_remaining - self.dispatched, 0)
+        return self.dispatched_cost + external * self.avg_execution_time
+
+    def on_dispatched(self, cost=None):
+        with self._lock:
+            self.dispatched += 1
+            self.queue_remaining += 1
+            self.dispatched_cost += self.avg_execution_time if cost is None else cost
+
+    def on_released(self, cost=None):
+        with self._lock:
+            self.dispatched = max(self.dispatched - 1, 0)
+            if self.dispatched == 0:
+                self.dispatched_cost = 0.0
+            else:
+                self.dispatched_cost = max(
+                    self.dispatched_cost - (self.avg_execution_time if cost is None else cost), 0.0
+                )
+
+    def on_execution_start(self, prompt_id):
+        self._execution_starts[prompt_id] = time.time()
+
+    def execution_started_at(self, prompt_id):
+        return self._execution_starts.get(prompt_id)
+
+    def on_execution_end(self, prompt_id):
+        """记录执行耗时，更新平均执行时间"""
+        started_at = self._execution_starts.pop(prompt_id, None)
+        if started_at is None:
+            return None
+        duration = time.time() - started_at
+        with self._lock:
+            self.avg_execution_time = 0.8 * self.avg_execution_time + 0.2 * duration
+        return duration
+
+    def record_success(self, healthy_threshold):
+        self.consecutive_failures = 0
+        self.consecutive_successes += 1
+        self.last_checked = time.time()
+        if not self.healthy and self.consecutive_successes >= healthy_threshold:
+            self.healthy = True
+            logger.info(f"ComfyUI后端已恢复: {self.name}")
+
+    def record_failure(self, error, unhealthy_threshold):
+        self.consecutive_successes = 0
+        self.consecutive_failures += 1
+        self.last_error = str(error)
+        self.last_checked = time.time()
+        if self.healthy and self.consecutive_failures >= unhealthy_threshold:
+            self.healthy = False
+            logger.error(f"ComfyUI后端不可用，已移出路由: {self.name} - {error}")
+
+    def get_stats(self):
+        """获取后端状态"""
+        return {
+            'name': self.name,
+            'url': self.base_url,
+            'healthy': self.healthy,
+            'events_connected': self.events_connected,
+            'queue_remaining': self.queue_remaining,
+            'dispatched': self.dispatched,
+            'queue_depth': self.queue_depth,
+            'transfer_mode': self.transfer_mode,
+            'avg_execution_time': round(self.avg_execution_time, 2),
+            'estimated_wait': round(self.estimated_wait(), 2),
+            'last_error': self.last_error,
+            'last_checked': self.last_checked,
+            'circuit': self.breaker.get_stats(),
+            'connection_pool': self.http.get_stats()
+        }
+
+class BackendPool:
+    """ComfyUI后端池类
+
+    comfyui.backends 为后端列表；未配置时使用 comfyui.host/port 作为唯一后端。
+    后台线程定期探测各后端的 /prompt，连续失败达到阈值的后端被移出路由，
+    连续成功达到阈值后自动恢复。熔断中的后端同样不参与路由（见 CircuitBreaker）。
+    """
+
+    def __init__(self, comfyui_config, event_listener_class=None):
+        self.use_websocket = comfyui_config.get('use_websocket', True)
+        self.health_check_interval = comfyui_config.get('health_check_interval', 5)
+        self.unhealthy_threshold = comfyui_config.get('unhealthy_threshold', 3)
+        self.healthy_threshold = comfyui_config.get('healthy_threshold', 2)
+
+        backend_configs = comfyui_config.get('backends') or [
+            {'host': comfyui_config['host'], 'port': comfyui_config['port']}
+        ]
+        self.backends = []
+        for i, backend_config in enumerate(backend_configs):
+            name = backend_config.get('name') or f"comfyui-{i}"
+            self.backends.append(ComfyUIBackend(
+                name, backend_config['host'], backend_config['port'], comfyui_config, backend_config,
+                event_listener_class
+            ))
+
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """启动事件监听和健康检查线程"""
+        if self._running:
+            return
+        self._running = True
+        if self.use_websocket:
+            for backend in self.backends:
+                backend.events.start()
+        self._thread = threading.Thread(target=self._health_loop, name='backend-health', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程"""
+        self._running = False
+        for backend in self.backends:
+            backend.events.stop()
+
+    def add_event_handler(self, handler):
+        """为所有后端注册事件处理函数 handler(backend, event_type, data)"""
+        for backend in self.backends:
+            backend.events.add_handler(
+                lambda event_type, data, backend=backend: handler(backend, event_type, data)
+            )
+
+    def get(self, name):
+        """按名称获取后端"""
+        for backend in self.backends:
+            if backend.name == name:
+                return backend
+        return None
+
+    def healthy_backends(self):
+        return [backend for backend in self.backends if backend.healthy]
+
+    def available_backends(self):
+        """健康且未熔断、可以接收新任务的后端"""
+        return [backend for backend in self.backends if backend.healthy and backend.breaker.allow()]
+
+    def retry_after(self):
+        """没有可用后端时，预计多少秒后可能有后端恢复"""
+        waits = [
+            backend.breaker.retry_after() if backend.healthy
+            else self.health_check_interval * self.healthy_threshold
+            for backend in self.backends
+        ]
+        return min(waits, default=self.health_check_interval)
+
+    def events_connected(self, backend):
+        """后端的事件连接是否可用（不可用时调用方应回退到轮询）"""
+        return self.use_websocket and backend.events_connected
+
+    def select(self, exclude=(), cost=None, preferred=None):
+        """选择预计完成最早的可用后端，没有可用后端时返回None
+
+        cost(backend) 返回任务在该后端上的预计执行时间，未提供时只比较等待时间。
+        preferred 可用时直接选择（例如缓存亲和调度选定的后端）。
+        """
+        candidates = [b for b in self.available_backends() if b.name not in exclude]
+        if not candidates:
+            return None
+        if preferred is not None and preferred in candidates:
+            return preferred
+        return min(candidates, key=lambda b: (b.estimated_wait() + (cost(b) if cost else 0), b.dispatched))
+
+    def probe(self, backend):
+        """探测后端健康状态并刷新队列深度，返回是否可用"""
+        try:
+            # GET /prompt 只返回队列剩余数量，比 /queue 轻量得多
+            response = backend.http.probe("/prompt", read_timeout=5)
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            return self.on_probe(backend, response.json())
+        except Exception as e:
+            return self.on_probe(backend, error=e)
+
+    def on_probe(self, backend, prompt_info=None, error=None):
+        """记录一次探测结果（prompt_info 为 GET /prompt 的响应），返回是否可用"""
+        if error is not None:
+            backend.record_failure(error, self.unhealthy_threshold)
+            # 熔断期间的探测失败说明后端仍未恢复
+            if backend.breaker.state != STATE_CLOSED:
+                backend.breaker.record_failure('probe')
+            return False
+        exec_info = prompt_info.get('exec_info') or {}
+        backend.queue_remaining = exec_info.get('queue_remaining', backend.queue_remaining)
+        backend.record_success(self.healthy_threshold)
+        return True
+
+    def on_event(self, backend, event_type, data):
+        """维护后端的连接代数和队列深度"""
+        if event_type == EVENT_CONNECTED:
+            backend.connection_epoch += 1
+        elif event_type == EVENT_DISCONNECTED:
+            logger.warning(f"ComfyUI事件连接断开，回退到队列轮询: {backend.name}")
+            backend.breaker.record_failure('disconnect')
+        elif event_type == 'status':
+            exec_info = (data.get('status') or {}).get('exec_info') or {}
+            if 'queue_remaining' in exec_info:
+                backend.queue_remaining = exec_info['queue_remaining']
+
+    def get_stats(self):
+        """获取所有后端的状态"""
+        return [backend.get_stats() for backend in self.backends]
+
+    def _health_loop(self):
+        while self._running:
+            for backend in self.backends:
+                self.probe(backend)
+            time.sleep(self.health_check_interval)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+熔断器
+按后端统计提交失败、生成超时和事件连接断开，连续失败后暂停向该后端路由，
+冷却后放行少量试探任务，试探成功后恢复
+"""
+
+import time
+import logging
+import threading
+from .metrics import CIRCUIT_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = 'closed'        # 正常路由
+STATE_OPEN = 'open'            # 熔断，不路由
+STATE_HALF_OPEN = 'half_open'  # 试探，只放行有限数量的任务
+
+# /metrics 中熔断状态的取值
+STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+class CircuitBreaker:
+    """熔断器类
+
+    comfyui.circuit_breaker.enabled              是否启用
+    comfyui.circuit_breaker.failure_threshold    连续失败多少次后熔断
+    comfyui.circuit_breaker.reset_timeout        熔断后多少秒进入试探状态
+    comfyui.circuit_breaker.half_open_max_calls  试探状态下同时放行的任务数
+
+    试探任务成功完成后恢复正常；试探任务失败（提交失败、超时）或健康探测失败时重新熔断。
+    工作流本身有问题（ComfyUI返回4xx）、执行出错或被中断不能说明后端状态，只归还试探名额。
+    """
+
+    def __init__(self, name, breaker_config=None):
+        breaker_config = breaker_config or {}
+        self.name = name
+        self.enabled = breaker_config.get('enabled', True)
+        self.failure_threshold = breaker_config.get('failure_threshold', 5)
+        self.reset_timeout = breaker_config.get('reset_timeout', 30)
+        self.half_open_max_calls = breaker_config.get('half_open_max_calls', 1)
+
+        self.state = STATE_CLOSED
+        self.failures = 0              # 连续失败次数
+        self.opened_at = None
+        self.trials = 0                # 试探状态下已放行的任务数
+        self.last_failure = None
+        self.opened = 0                # 累计熔断次数
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否可以向该后端路由新任务（不占用试探名额）"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            self._check_reset()
+            if self.state == STATE_OPEN:
+                return False
+            return self.state == STATE_CLOSED or self.trials < self.half_open_max_calls
+
+    def acquire(self):
+        """提交任务前调用，试探状态下占用一个名额，返回是否可以提交"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            self._check_reset()
+            if self.state == STATE_CLOSED:
+                return True
+            if self.state == STATE_HALF_OPEN and self.trials < self.half_open_max_calls:
+                self.trials += 1
+                return True
+            return False
+
+    def record_success(self):
+        """该后端成功完成了一个prompt"""
+        with self._lock:
+            self.failures = 0
+            if self.state != STATE_CLOSED:
+                self._transition(STATE_CLOSED)
+                logger.info(f"ComfyUI后端熔断恢复: {self.name}")
+
+    def release(self):
+        """归还一个试探名额，不计成功或失败（例如工作流被ComfyUI拒绝或执行出错）"""
+        with self._lock:
+            if self.state == STATE_HALF_OPEN and self.trials > 0:
+                self.trials -= 1
+
+    def record_failure(self, reason):
+        """记录一次失败（reason 为 submit、timeout、disconnect 或 probe）"""
+        with self._lock:
+            self.failures += 1
+            self.last_failure = reason
+            if self.state == STATE_HALF_OPEN or (
+                self.state == STATE_CLOSED and self.failures >= self.failure_threshold
+            ):
+                self._transition(STATE_OPEN)
+                logger.error(f"ComfyUI后端熔断: {self.name} - 连续失败 {self.failures} 次，最近一次: {reason}")
+            if self.state == STATE_OPEN:
+                # 熔断期间的失败重新开始计算冷却时间
+                self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        """距离进入试探状态的秒数，未熔断时为0"""
+        with self._lock:
+            self._check_reset()
+            if self.state != STATE_OPEN:
+                return 0
+            return max(self.opened_at + self.reset_timeout - time.monotonic(), 0)
+
+    def get_stats(self):
+        """获取熔断器状态"""
+        retry_after = self.retry_after()
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'last_failure': self.last_failure,
+            'retry_after': round(retry_after, 2),
+            'opened': self.opened
+        }
+
+    def _check_reset(self):
+        if self.state == STATE_OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._transition(STATE_HALF_OPEN)
+            logger.info(f"ComfyUI后端进入熔断试探: {self.name}")
+
+    def _transition(self, state):
+        self.state = state
+        self.trials = 0
+        if state == STATE_OPEN:
+            self.opened += 1
+        CIRCUIT_TRANSITIONS.inc(backend=self.name, state=state)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ComfyUI异步客户端
+基于aiohttp的非阻塞HTTP和WebSocket客户端，供异步服务器（run_asgi.py）使用
+"""
+
+import asyncio
+import logging
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from .comfyui_events import ComfyUIEventListener, EVENT_CONNECTED, EVENT_DISCONNECTED
+
+logger = logging.getLogger(__name__)
+
+class AsyncComfyUIEventListener(ComfyUIEventListener):
+    """在事件循环中接收ComfyUI事件的监听器类
+
+    接口与 ComfyUIEventListener 相同，但连接由协程维护，不占用线程。
+    事件处理函数会读写任务存储，因此不在事件循环中调用，而是按接收顺序交给本监听器的分发线程执行。
+    """
+
+    def __init__(self, ws_url, client_id, reconnect_interval=2.0, recv_timeout=30, loop=None):
+        super().__init__(ws_url, client_id, reconnect_interval, recv_timeout)
+        self.loop = loop
+        self._future = None
+        # 单个线程保证同一后端的事件按顺序处理
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='comfyui-events')
+
+    def start(self):
+        """在事件循环中启动监听协程（可以从其他线程调用）"""
+        if self._running:
+            return
+        self._running = True
+        self._future = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+
+    def stop(self):
+        """停止监听"""
+        self._running = False
+        future, self._future = self._future, None
+        if future is not None:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _dispatch(self, event_type, data):
+        try:
+            self._executor.submit(super()._dispatch, event_type, data)
+        except RuntimeError:
+            # 分发线程已停止（服务正在退出）
+            pass
+
+    async def _run(self):
+        url = f"{self.ws_url}?clientId={self.client_id}"
+        async with aiohttp.ClientSession() as session:
+            while self._running:
+                try:
+                    # heartbeat定期发送ping，长时间无事件时确认连接仍然可用
+                    async with session.ws_connect(url, heartbeat=self.recv_timeout) as ws:
+                        self._connected.set()
+                        logger.info(f"ComfyUI事件连接已建立: {self.ws_url}")
+                        self._dispatch(EVENT_CONNECTED, {})
+                        async for message in ws:
+                            # 二进制消息为预览图，忽略
+                            if message.type == aiohttp.WSMsgType.TEXT:
+                                self._handle_message(message.data)
+                            elif message.type == aiohttp.WSMsgType.ERROR:
+                                raise ConnectionError(f"连接异常: {ws.exception()}")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if self._running:
+                        logger.warning(f"ComfyUI事件连接异常: {e}")
+                finally:
+                    was_connected = self.connected
+                    self._connected.clear()
+                    if was_connected:
+                        self._dispatch(EVENT_DISCONNECTED, {})
+
+                if self._running:
+                    await asyncio.sleep(self.reconnect_interval)
+
+class AsyncComfyUIClient:
+    """ComfyUI异步HTTP客户端类
+
+    请求路径上对ComfyUI的查询（状态探测、队列）使用共享的aiohttp连接池，
+    等待响应时不占用线程；多个后端的查询并发进行。
+    探测结果和队列汇总复用 BackendPool / ComfyUIManager 的逻辑。
+    """
+
+    def __init__(self, comfyui_manager):
+        self.comfyui_manager = comfyui_manager
+        self.pool = comfyui_manager.pool
+        http_config = comfyui_manager.config['comfyui'].get('http') or {}
+        self.pool_size = http_config.get('pool_size', 16)
+        self.connect_timeout = http_config.get('connect_timeout', 3.05)
+        self.read_timeout = http_config.get('read_timeout', 30)
+        self._session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit_per_host=self.pool_size)
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        session, self._session = self._session, None
+        if session is not None:
+            await session.close()
+
+    async def get_json(self, backend, path, read_timeout=None):
+        """GET请求后端并解析JSON响应"""
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.connect_timeout,
+            sock_read=read_timeout or self.read_timeout
+        )
+        async with self._session.get(f"{backend.base_url}{path}", timeout=timeout) as response:
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+            return await response.json(content_type=None)
+
+    async def probe(self, backend):
+        """探测后端健康状态并刷新队列深度，返回是否可用"""
+        try:
+            prompt_info = await self.get_json(backend, "/prompt", read_timeout=5)
+        except Exception as e:
+            return self.pool.on_probe(backend, error=e)
+        return self.pool.on_probe(backend, prompt_info)
+
+    async def check_status(self):
+        """并发探测所有后端，任一后端可用即返回True"""
+        results = await asyncio.gather(*(self.probe(backend) for backend in self.pool.backends))
+        for backend, available in zip(self.pool.backends, results):
+            if not available:
+                logger.error(f"检查ComfyUI状态失败: {backend.name} - {backend.last_error}")
+        return any(results)
+
+    async def get_queue_status(self):
+        """并发获取各后端的队列并汇总"""
+        backends = self.pool.healthy_backends()
+        results = await asyncio.gather(
+            *(self.get_json(backend, "/queue", read_timeout=5) for backend in backends),
+            return_exceptions=True
+        )
+        queues = {}
+        for backend, result in zip(backends, results):
+            if isinstance(result, Exception):
+                logger.error(f"获取队列状态失败: {backend.name} - {result}")
+                result = str(result)
+            queues[backend.name] = result
+        return self.comfyui_manager.summarize_queues(queues)
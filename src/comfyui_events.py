@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ComfyUI事件监听器
+通过单个长连接接收ComfyUI的WebSocket事件并分发给订阅者
+"""
+
+import json
+import time
+import logging
+import threading
+import websocket
+
+logger = logging.getLogger(__name__)
+
+# 监听器自身产生的连接状态事件
+EVENT_CONNECTED = 'connected'
+EVENT_DISCONNECTED = 'disconnected'
+
+class ComfyUIEventListener:
+    """ComfyUI WebSocket事件监听器类
+
+    使用client_id注册到ComfyUI的 /ws，ComfyUI会把以该client_id提交的
+    prompt的 executing / executed / execution_error 等事件推送到这个连接。
+    """
+
+    def __init__(self, ws_url, client_id, reconnect_interval=2.0, recv_timeout=30):
+        self.ws_url = ws_url
+        self.client_id = client_id
+        self.reconnect_interval = reconnect_interval
+        self.recv_timeout = recv_timeout
+
+        self._handlers = []
+        self._connected = threading.Event()
+        self._running = False
+        self._thread = None
+        self._ws = None
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def add_handler(self, handler):
+        """注册事件处理函数 handler(event_type, data)"""
+        self._handlers.append(handler)
+
+    def start(self):
+        """启动监听线程"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='comfyui-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止监听"""
+        self._running = False
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        url = f"{self.ws_url}?clientId={self.client_id}"
+        while self._running:
+            try:
+                self._ws = websocket.create_connection(url, timeout=self.recv_timeout)
+                self._connected.set()
+                logger.info(f"ComfyUI事件连接已建立: {self.ws_url}")
+                self._dispatch(EVENT_CONNECTED, {})
+                self._receive_loop()
+            except Exception as e:
+                if self._running:
+                    logger.warning(f"ComfyUI事件连接异常: {e}")
+            finally:
+                was_connected = self.connected
+                self._connected.clear()
+                self._close_socket()
+                if was_connected:
+                    self._dispatch(EVENT_DISCONNECTED, {})
+
+            if self._running:
+                time.sleep(self.reconnect_interval)
+
+    def _receive_loop(self):
+        while self._running:
+            try:
+                message = self._ws.recv()
+            except websocket.WebSocketTimeoutException:
+                # 长时间无事件时发送ping确认连接仍然可用
+                self._ws.ping()
+                continue
+
+            # 二进制消息为预览图，忽略
+            if not isinstance(message, str):
+                continue
+            if not message:
+                raise ConnectionError('连接已关闭')
+
+            self._handle_message(message)
+
+    def _handle_message(self, message):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            logger.warning(f"无法解析ComfyUI事件: {message[:200]}")
+            return
+
+        self._dispatch(event.get('type'), event.get('data') or {})
+
+    def _dispatch(self, event_type, data):
+        for handler in list(self._handlers):
+            try:
+                handler(event_type, data)
+            except Exception as e:
+                logger.error(f"处理ComfyUI事件失败: {event_type} - {e}", exc_info=True)
+
+    def _close_socket(self):
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
@@ -9,29 +9,70 @@ import os
 import json
 import time
 import uuid
-import base64
+import hashlib
 import logging
-import requests
-from io import BytesIO
-from PIL import Image
-import websocket
 import threading
+from .backend_pool import BackendPool
+from .workflow_template import WorkflowTemplate
+from .estimator import ExecutionTimeEstimator, task_work
+from .image_store import ImageStore, image_name
+from .metadata_cache import MetadataCache
+from .circuit_breaker import STATE_VALUES
+from .metrics import STAGE_SECONDS, BACKEND_QUEUE_DEPTH, BACKEND_HEALTHY, BACKEND_CIRCUIT_STATE
 
 logger = logging.getLogger(__name__)
 
+# 下载图片时每次读取的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 class ComfyUIManager:
     """ComfyUI管理器类"""
     
-    def __init__(self, config):
+    def __init__(self, config, event_listener_class=None):
         self.config = config
-        self.host = config['comfyui']['host']
-        self.port = config['comfyui']['port']
-        self.base_url = f"http://{self.host}:{self.port}"
-        self.ws_url = f"ws://{self.host}:{self.port}/ws"
+        
+        # ComfyUI后端池（每个后端有独立的连接池和事件连接）
+        self.pool = BackendPool(config['comfyui'], event_listener_class)
+        self.backends = self.pool.backends
+        self.pool.add_event_handler(self.pool.on_event)
+        self.pool.add_event_handler(self._on_event)
+        
+        # 获取项目根目录（src的上级目录）
+        self.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # 生成图片的存储（分片目录、元数据索引和定期清理）
+        self.images = ImageStore(config.get('storage', {}), self.project_root)
+        # /object_info 索引和 /models、/status 响应的缓存
+        self.metadata = MetadataCache(config.get('metadata', {}), self)
+        self.local_transfer = config['comfyui'].get('local_transfer', 'link')
+        self._resolve_backend_output_dirs()
         
         # 工作流模板
         self.workflow_template = self._load_workflow_template()
+        self.workflow = WorkflowTemplate(self.workflow_template)
+        # 模板中的UNet模型，请求未指定 model 时使用；模板不能按请求选择模型时为None
+        self.default_model = self.workflow.defaults.get('model')
+        self.fingerprint = self._compute_fingerprint()
+        self._model_fingerprints = {}
+        self.estimator = ExecutionTimeEstimator(config)
+        
+        # 已提交prompt所在的后端（prompt_id -> ComfyUIBackend）及提交时间
+        self._prompt_backends = {}
+        self._prompt_submitted_at = {}
+        self._prompt_costs = {}  # prompt_id -> (计算量, 预计执行时间, 模型)，结束时归还后端占用
+        # 重启前提交的prompt：事件发往旧的client_id，收不到WebSocket事件，每次对账都轮询
+        self._recovered_prompts = set()
+        
+        # 已结束的prompt结果（prompt_id -> (结果, 结束时间)），供等待方认领
+        self.finished_retention = 600
+        self._finished_prompts = {}
+        self._prompt_outputs = {}
+        self._finished_handlers = []
+        self._finished_cond = threading.Condition()
         
+        BACKEND_QUEUE_DEPTH.set_function(lambda: {(b.name,): b.queue_depth for b in self.backends})
+        BACKEND_HEALTHY.set_function(lambda: {(b.name,): int(b.healthy) for b in self.backends})
+        BACKEND_CIRCUIT_STATE.set_function(lambda: {(b.name,): STATE_VALUES[b.breaker.state] for b in self.backends})
+
     def _load_workflow_template(self):
         """加载工作流模板"""
         project_root = os.path.dirname(os.path.dirname(__file__))
@@ -161,131 +202,463 @@ class ComfyUIManager:
         
         return workflow
     
+    def _compute_fingerprint(self):
+        """计算工作流模板和模型文件的指纹，模板或模型变化后缓存结果自动失效"""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(self.workflow_template, sort_keys=True).encode('utf-8'))
+        
+        # 模板中引用的模型文件：本地存在时加入文件大小和修改时间
+        models_dir = os.path.join(self.project_root, self.config['comfyui'].get('models_dir', './models'))
+        model_names = sorted(
+            value for node in self.workflow_template.values()
+            for value in node.get('inputs', {}).values()
+            if isinstance(value, str) and value.endswith('.safetensors')
+        )
+        for name in model_names:
+            digest.update(name.encode('utf-8'))
+            stat = self._model_file_stat(models_dir, name)
+            if stat:
+                digest.update(stat.encode('utf-8'))
+        
+        return digest.hexdigest()[:16]
+    
+    def model_fingerprint(self, model=None):
+        """使用指定UNet模型时的指纹，未指定或为默认模型时与 fingerprint 相同"""
+        if not model or model == self.default_model:
+            return self.fingerprint
+        fingerprint = self._model_fingerprints.get(model)
+        if fingerprint is None:
+            models_dir = os.path.join(self.project_root, self.config['comfyui'].get('models_dir', './models'))
+            digest = hashlib.sha256(self.fingerprint.encode('utf-8'))
+            digest.update(model.encode('utf-8'))
+            stat = self._model_file_stat(models_dir, model)
+            if stat:
+                digest.update(stat.encode('utf-8'))
+            fingerprint = digest.hexdigest()[:16]
+            self._model_fingerprints[model] = fingerprint
+        return fingerprint
+    
+    @staticmethod
+    def _model_file_stat(models_dir, name):
+        """本地模型文件的大小和修改时间，文件不存在时返回None"""
+        for subdir in ('unet', 'checkpoints', 'vae', 'clip'):
+            model_path = os.path.join(models_dir, subdir, name)
+            if os.path.exists(model_path):
+                stat = os.stat(model_path)
+                return f"{stat.st_size}:{int(stat.st_mtime)}"
+        return None
+    
+    def _resolve_backend_output_dirs(self):
+        """确定local传输模式下各后端的ComfyUI输出目录
+        
+        未配置 output_dir 的本机后端使用 install_dir 下的 output 目录；
+        远程后端必须显式配置共享目录，否则只能通过HTTP下载。
+        """
+        install_dir = self.config['comfyui'].get('install_dir', './ComfyUI')
+        for backend in self.backends:
+            output_dir = backend.output_dir
+            if output_dir is None and backend.host in ('127.0.0.1', 'localhost'):
+                output_dir = os.path.join(install_dir, 'output')
+            if output_dir is not None:
+                output_dir = os.path.realpath(os.path.join(self.project_root, output_dir))
+            backend.output_dir = output_dir
+    
+    def start(self, housekeeping=None):
+        """启动后端池的事件监听和健康检查、图片存储的清理线程和元数据刷新线程
+        
+        housekeeping 为None时是单进程部署；多进程部署时只有为True的工作进程清理图片存储，
+        并为其他工作进程获取元数据（见 MetadataCache.share）。
+        """
+        self.pool.start()
+        if housekeeping is not False:
+            self.images.start()
+        if housekeeping is not None:
+            self.metadata.share(leader=housekeeping)
+        self.metadata.start()
+    
+    def stop(self):
+        """停止后端池、图片清理和元数据刷新"""
+        self.pool.stop()
+        self.images.stop()
+        self.metadata.stop()
+    
+    def get_prompt_backend(self, prompt_id):
+        """获取prompt所在的后端"""
+        return self._prompt_backends.get(prompt_id)
+    
+    def add_finished_handler(self, handler):
+        """注册prompt结束回调 handler(prompt_id, result)"""
+        self._finished_handlers.append(handler)
+    
+    def get_finished(self, prompt_id):
+        """获取已结束prompt的结果，未结束时返回None"""
+        with self._finished_cond:
+            entry = self._finished_prompts.get(prompt_id)
+            return entry[0] if entry else None
+    
+    def mark_finished(self, prompt_id, result):
+        """记录prompt结束并通知等待方"""
+        with self._finished_cond:
+            if prompt_id in self._finished_prompts:
+                return
+            now = time.time()
+            self._finished_prompts[prompt_id] = (result, now)
+            self._prompt_outputs.pop(prompt_id, None)
+            self._prompt_submitted_at.pop(prompt_id, None)
+            self._recovered_prompts.discard(prompt_id)
+            cost = self._prompt_costs.pop(prompt_id, None)
+            
+            # 清理过期记录
+            expired = [pid for pid, (_, finished_at) in self._finished_prompts.items()
+                       if now - finished_at > self.finished_retention]
+            for pid in expired:
+                del self._finished_prompts[pid]
+                self._prompt_backends.pop(pid, None)
+            
+            self._finished_cond.notify_all()
+        
+        backend = self._prompt_backends.get(prompt_id)
+        if backend is not None and cost is not None:
+            backend.on_released(cost[1])
+        # 每个结束的prompt都要告知熔断器，否则试探中的后端名额不会归还；
+        # 执行出错和中断是prompt本身的结果，后端仍在正常响应，不计为失败
+        if backend is not None and result.get('success'):
+            backend.breaker.record_success()
+        elif backend is not None:
+            backend.breaker.release()
+        
+        for handler in list(self._finished_handlers):
+            try:
+                handler(prompt_id, result)
+            except Exception as e:
+                logger.error(f"处理prompt结束回调失败: {e}", exc_info=True)
+    
+    def release_prompt(self, prompt_id):
+        """放弃跟踪未结束的prompt（例如等待超时），释放其在后端的占用"""
+        with self._finished_cond:
+            backend = self._prompt_backends.pop(prompt_id, None)
+            self._prompt_submitted_at.pop(prompt_id, None)
+            self._recovered_prompts.discard(prompt_id)
+            cost = self._prompt_costs.pop(prompt_id, None)
+        if backend is not None and cost is not None:
+            backend.on_released(cost[1])
+    
+    def _on_event(self, backend, event_type, data):
+        """处理ComfyUI事件，识别prompt的完成和失败"""
+        prompt_id = data.get('prompt_id')
+        
+        if event_type == 'execution_start' and prompt_id:
+            backend.on_execution_start(prompt_id)
+            with self._finished_cond:
+                submitted_at = self._prompt_submitted_at.pop(prompt_id, None)
+            if submitted_at is not None:
+                STAGE_SECONDS.observe(time.time() - submitted_at, stage='queue')
+        
+        elif event_type == 'executed' and prompt_id:
+            # 收集输出，完成后可直接使用而无需再请求history
+            output = data.get('output') or {}
+            with self._finished_cond:
+                self._prompt_outputs.setdefault(prompt_id, {})[data.get('node')] = output
+        
+        elif event_type in ('executing', 'execution_success') and prompt_id:
+            # executing事件中node为None表示整个prompt执行结束
+            if event_type == 'execution_success' or data.get('node') is None:
+                with self._finished_cond:
+                    outputs = self._prompt_outputs.get(prompt_id)
+                self._observe_execution(backend, prompt_id, succeeded=True)
+                self.mark_finished(prompt_id, {'success': True, 'outputs': outputs})
+        
+        elif event_type == 'execution_error' and prompt_id:
+            error = data.get('exception_message') or data.get('exception_type') or '未知错误'
+            self._observe_execution(backend, prompt_id)
+            self.mark_finished(prompt_id, {'success': False, 'error': f'生成失败: {error}'})
+        
+        elif event_type == 'execution_interrupted' and prompt_id:
+            self._observe_execution(backend, prompt_id)
+            self.mark_finished(prompt_id, {'success': False, 'error': '生成被中断'})
+    
+    def _observe_execution(self, backend, prompt_id, succeeded=False):
+        duration = backend.on_execution_end(prompt_id)
+        if duration is not None:
+            STAGE_SECONDS.observe(duration, stage='execution')
+            with self._finished_cond:
+                cost = self._prompt_costs.get(prompt_id)
+            # 只用成功执行的耗时更新估计，失败和中断的任务耗时不具代表性
+            if succeeded and cost is not None:
+                self.estimator.observe(backend.name, self.model_fingerprint(cost[2]), cost[0], duration)
+    
+    def predict_execution_time(self, backend, work, model=None):
+        """预测计算量为work的任务使用model在后端上的执行时间（秒），不同模型分别估计"""
+        return self.estimator.predict(backend.name, self.model_fingerprint(model), work)
+    
+    def estimate(self, work, model=None):
+        """估计任务的等待时间和执行时间，按预计完成最早的后端计算；没有可用后端时返回None"""
+        target = self.pool.select(cost=lambda b: self.predict_execution_time(b, work, model))
+        if target is None:
+            return None
+        return {
+            'backend': target.name,
+            'wait': target.estimated_wait(),
+            'execution_time': self.predict_execution_time(target, work, model)
+        }
+    
     def check_status(self):
-        """检查ComfyUI服务状态"""
-        try:
-            # 使用与simple_api_test.py相同的端点
-            response = requests.get(f"{self.base_url}/queue", timeout=5)
-            if response.status_code == 200:
-                logger.info("ComfyUI服务状态检查成功")
-                return True
+        """检查ComfyUI服务状态，任一后端可用即返回True"""
+        available = False
+        for backend in self.backends:
+            if self.pool.probe(backend):
+                logger.info(f"ComfyUI服务状态检查成功: {backend.name}")
+                available = True
             else:
-                logger.error(f"ComfyUI服务状态异常: {response.status_code}")
-                return False
-        except Exception as e:
-            logger.error(f"检查ComfyUI状态失败: {e}")
-            return False
+                logger.error(f"检查ComfyUI状态失败: {backend.name} - {backend.last_error}")
+        return available
+    
+    @property
+    def available(self):
+        """是否有可用（健康且未熔断）的后端，不发起请求"""
+        return bool(self.pool.available_backends())
     
     def get_available_models(self):
-        """获取可用模型列表"""
-        try:
-            response = requests.get(f"{self.base_url}/object_info", timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                
-                models = {
-                    'unet': [],
-                    'vae': [],
-                    'clip': []
-                }
-                
-                # 提取模型信息
-                if 'UNETLoader' in data:
-                    models['unet'] = data['UNETLoader']['input']['required']['unet_name'][0]
-                
-                if 'VAELoader' in data:
-                    models['vae'] = data['VAELoader']['input']['required']['vae_name'][0]
-                
-                if 'DualCLIPLoader' in data:
-                    models['clip'] = data['DualCLIPLoader']['input']['required']['clip_name1'][0]
-                
-                return models
-            else:
-                return {'error': 'Failed to fetch models'}
-        except Exception as e:
-            logger.error(f"获取模型列表失败: {e}")
-            return {'error': str(e)}
+        """获取可用模型列表（来自元数据缓存）"""
+        return self.metadata.get_models()
+    
+    @staticmethod
+    def parse_models(object_info):
+        """从ComfyUI的 /object_info 中提取模型列表"""
+        models = {
+            'unet': [],
+            'vae': [],
+            'clip': []
+        }
+        
+        # 提取模型信息
+        if 'UNETLoader' in object_info:
+            models['unet'] = object_info['UNETLoader']['input']['required']['unet_name'][0]
+        
+        if 'VAELoader' in object_info:
+            models['vae'] = object_info['VAELoader']['input']['required']['vae_name'][0]
+        
+        if 'DualCLIPLoader' in object_info:
+            models['clip'] = object_info['DualCLIPLoader']['input']['required']['clip_name1'][0]
+        
+        return models
     
     def get_queue_status(self):
-        """获取队列状态"""
-        try:
-            response = requests.get(f"{self.base_url}/queue", timeout=5)
-            if response.status_code == 200:
-                return response.json()
+        """获取队列状态，包含所有后端的汇总和各后端明细"""
+        queues = {}
+        for backend in self.pool.healthy_backends():
+            try:
+                response = backend.http.get("/queue", read_timeout=5)
+                if response.status_code == 200:
+                    queues[backend.name] = response.json()
+                else:
+                    queues[backend.name] = 'Failed to fetch queue status'
+            except Exception as e:
+                logger.error(f"获取队列状态失败: {backend.name} - {e}")
+                queues[backend.name] = str(e)
+        return self.summarize_queues(queues)
+    
+    def summarize_queues(self, queues):
+        """汇总各后端的队列，queues为 后端名 -> /queue 响应（获取失败时为错误信息）"""
+        queue_running = []
+        queue_pending = []
+        backends = {}
+        
+        for backend in self.backends:
+            detail = {
+                'healthy': backend.healthy,
+                'dispatched': backend.dispatched,
+                'estimated_wait': round(backend.estimated_wait(), 2)
+            }
+            queue_data = queues.get(backend.name)
+            if not backend.healthy and queue_data is None:
+                detail['error'] = backend.last_error
+            elif isinstance(queue_data, dict):
+                running = queue_data.get("queue_running", [])
+                pending = queue_data.get("queue_pending", [])
+                queue_running.extend(running)
+                queue_pending.extend(pending)
+                detail['queue_running'] = len(running)
+                detail['queue_pending'] = len(pending)
             else:
-                return {'error': 'Failed to fetch queue status'}
-        except Exception as e:
-            logger.error(f"获取队列状态失败: {e}")
-            return {'error': str(e)}
+                detail['error'] = queue_data
+            backends[backend.name] = detail
+        
+        return {
+            'queue_running': queue_running,
+            'queue_pending': queue_pending,
+            'backends': backends
+        }
     
-    def generate_image(self, prompt, width=1024, height=1024, steps=20, 
-                      guidance_scale=3.5, seed=-1, task_id=None):
-        """生成图片"""
+    def submit_generation(self, prompt, width=1024, height=1024, steps=20,
+                          guidance_scale=3.5, seed=-1, task_id=None, backend=None,
+                          num_images=1, preferred=None, model=None):
+        """准备并提交工作流，不等待生成完成
+        
+        未指定backend时优先使用可用的preferred后端，否则选择预计完成最早（等待时间加预计执行时间）的可用后端，
+        提交失败时换下一个后端重试；熔断试探中的后端名额已满时直接换下一个后端。
+        num_images大于1时在同一个prompt中批量生成，共享模型加载和文本编码。
+        """
         try:
-            start_time = time.time()
-            
             # 生成随机种子
             if seed == -1:
                 seed = int(time.time() * 1000) % 1000000
             
-            logger.info(f"开始生成图片 - 参数: prompt='{prompt[:50]}...', size={width}x{height}, steps={steps}, guidance={guidance_scale}, seed={seed}")
+            logger.info(f"开始生成图片 - 参数: prompt='{prompt[:50]}...', size={width}x{height}, steps={steps}, guidance={guidance_scale}, seed={seed}, num_images={num_images}, model={model or self.default_model}")
             
             # 准备工作流
-            workflow = self._prepare_workflow(
-                prompt, width, height, steps, guidance_scale, seed, task_id
-            )
-            
-            logger.info(f"工作流准备完成，节点数: {len(workflow)}")
-            
-            # 提交工作流
-            prompt_id = self._submit_workflow(workflow)
-            if not prompt_id:
-                return {'success': False, 'error': '提交工作流失败'}
-            
-            logger.info(f"工作流提交成功，prompt_id: {prompt_id}")
+            with STAGE_SECONDS.time(stage='prepare'):
+                workflow = self._prepare_workflow(
+                    prompt, width, height, steps, guidance_scale, seed, task_id, num_images, model
+                )
             
-            # 等待生成完成
-            result = self._wait_for_completion(prompt_id)
-            if not result['success']:
-                logger.error(f"等待完成失败: {result['error']}")
-                return result
+            logger.info(f"工作流准备完成，节点数: {self.workflow.node_count}")
             
-            logger.info("图片生成完成，开始获取图片")
+            work = task_work({'width': width, 'height': height, 'steps': steps, 'num_images': num_images})
+            result = self._dispatch_workflow(workflow, work, backend, preferred, model)
+            if result['success']:
+                result['seed'] = seed
+            return result
             
-            # 获取生成的图片
-            image_path = self._get_generated_image(prompt_id, task_id)
-            if not image_path:
-                return {'success': False, 'error': '获取生成图片失败'}
-            
-            generation_time = time.time() - start_time
-            logger.info(f"图片生成成功，耗时: {generation_time:.2f}秒，保存路径: {image_path}")
-            
-            # 可选：转换为base64
-            image_base64 = None
-            if os.path.exists(image_path):
-                try:
-                    with open(image_path, 'rb') as f:
-                        image_base64 = base64.b64encode(f.read()).decode('utf-8')
-                except Exception as e:
-                    logger.warning(f"转换base64失败: {e}")
+        except Exception as e:
+            logger.error(f"提交生成任务失败: {e}", exc_info=True)
+            return {'success': False, 'error': str(e)}
+    
+    def _dispatch_workflow(self, workflow, work, backend=None, preferred=None, model=None):
+        """选择后端提交已准备好的工作流并登记prompt，work为计算量（百万像素×步数）"""
+        tried = set()
+        submitted_at = time.time()
+        while True:
+            target = backend or self.pool.select(
+                exclude=tried, cost=lambda b: self.predict_execution_time(b, work, model), preferred=preferred
+            )
+            if target is None:
+                return {'success': False, 'error': '没有可用的ComfyUI后端'}
+            if backend is None and not target.breaker.acquire():
+                tried.add(target.name)
+                continue
             
+            with STAGE_SECONDS.time(stage='submit'):
+                result = self._submit_workflow(target, workflow)
+            if result['success']:
+                break
+            if backend is not None or not result.get('retryable'):
+                return {'success': False, 'error': result['error']}
+            tried.add(target.name)
+        
+        prompt_id = result['prompt_id']
+        self._prompt_backends[prompt_id] = target
+        estimated_wait = target.estimated_wait()
+        execution_time = self.predict_execution_time(target, work, model)
+        
+        # execution_start事件可能先于提交请求返回到达，已结束的prompt不再占用后端
+        with self._finished_cond:
+            if prompt_id not in self._finished_prompts:
+                self._prompt_costs[prompt_id] = (work, execution_time, model)
+                target.on_dispatched(execution_time)
+            started_at = target.execution_started_at(prompt_id)
+            if started_at is None:
+                self._prompt_submitted_at[prompt_id] = submitted_at
+        if started_at is not None:
+            STAGE_SECONDS.observe(max(started_at - submitted_at, 0), stage='queue')
+        
+        logger.info(f"工作流提交成功，prompt_id: {prompt_id}, 后端: {target.name}")
+        return {
+            'success': True,
+            'prompt_id': prompt_id,
+            'backend': target.name,
+            'estimated_wait': estimated_wait,
+            'estimated_execution_time': execution_time
+        }
+    
+    def collect_generation(self, prompt_id, task_id, outputs=None):
+        """获取已完成任务的图片，失败时从历史记录中读取错误信息"""
+        backend = self._prompt_backends.get(prompt_id)
+        if backend is None:
+            return {'success': False, 'error': f'未知的prompt_id: {prompt_id}'}
+        
+        with STAGE_SECONDS.time(stage='transfer'):
+            image_paths, checksums = self._get_generated_images(backend, prompt_id, task_id, outputs)
+        if image_paths:
             return {
                 'success': True,
-                'image_path': image_path,
-                'image_base64': image_base64,
-                'generation_time': generation_time,
-                'seed': seed
+                'image_path': image_paths[0],
+                'image_paths': image_paths,
+                'checksums': checksums
             }
+        
+        status = self._check_completion_status(backend, prompt_id)
+        if not status['success'] and status.get('error') != '无法获取完成状态':
+            return status
+        return {'success': False, 'error': '获取生成图片失败'}
+    
+    def get_queued_prompt_ids(self, backend):
+        """获取后端队列中（执行中和等待中）的prompt_id集合，失败时返回None"""
+        try:
+            response = backend.http.get("/queue", read_timeout=5)
+            if response.status_code != 200:
+                logger.warning(f"获取队列状态失败: {response.status_code}")
+                return None
+            
+            queue_data = response.json()
+            prompt_ids = set()
+            for item in queue_data.get("queue_running", []) + queue_data.get("queue_pending", []):
+                # item格式: [number, prompt_id, ...]
+                if len(item) > 1:
+                    prompt_ids.add(item[1])
+            return prompt_ids
             
         except Exception as e:
-            logger.error(f"生成图片失败: {e}", exc_info=True)
-            return {'success': False, 'error': str(e)}
+            logger.warning(f"获取队列状态失败: {e}")
+            return None
+    
+    def recover_prompt(self, prompt_id, backend_name, work, model=None):
+        """重新跟踪API服务重启前提交的prompt，返回 (状态, 结果)
+        
+        状态为 finished（已在历史记录中，结果格式同 mark_finished）、queued（仍在队列中）、
+        lost（后端没有该prompt，需要重新提交）或 unknown（后端暂时无法查询，按在途处理）。
+        除 lost 外prompt重新登记到后端，之后的轮询和结果获取与新提交的prompt相同；
+        它们的事件发往重启前的client_id，因此每次对账都轮询，直到结束。
+        """
+        backend = self.pool.get(backend_name)
+        if backend is None:
+            return 'lost', None
+        self._prompt_backends[prompt_id] = backend
+        
+        history = None
+        try:
+            response = backend.http.get(f"/history/{prompt_id}", read_timeout=10)
+            if response.status_code == 200:
+                history = response.json()
+        except Exception as e:
+            logger.warning(f"获取历史记录失败: {backend.name} - {e}")
+        
+        if history and prompt_id in history:
+            entry = history[prompt_id]
+            status = entry.get("status", {})
+            if status.get("status_str") == "error":
+                return 'finished', {'success': False, 'error': f'生成失败: {status.get("messages", [])}'}
+            return 'finished', {'success': True, 'outputs': entry.get("outputs") or None}
+        
+        queued_ids = self.get_queued_prompt_ids(backend)
+        if history is not None and queued_ids is not None and prompt_id not in queued_ids:
+            self._prompt_backends.pop(prompt_id, None)
+            return 'lost', None
+        
+        # 仍在队列中的prompt重新计入后端负载，结束时归还
+        execution_time = self.predict_execution_time(backend, work, model)
+        with self._finished_cond:
+            self._prompt_costs[prompt_id] = (work, execution_time, model)
+            self._recovered_prompts.add(prompt_id)
+        backend.on_dispatched(execution_time)
+        return ('queued' if queued_ids is not None else 'unknown'), None
     
-    def _prepare_workflow(self, prompt, width, height, steps, guidance_scale, seed, task_id):
-        """准备工作流"""
-        import copy
-        workflow = copy.deepcopy(self.workflow_template)
+    def _prepare_workflow(self, prompt, width, height, steps, guidance_scale, seed, task_id, num_images=1,
+                          model=None):
+        """准备工作流，返回提交用的JSON字符串
         
+        模板在加载时已编译，这里只填充绑定的参数，不复制也不重新序列化静态节点。
+        """
         # 限制提示词长度，避免Token长度超出限制
         # CLIP模型的最大Token长度通常是77，对应大约200-300个字符
         max_prompt_length = 300
@@ -293,97 +666,100 @@ class ComfyUIManager:
         #     logger.warning(f"提示词过长（{len(prompt)}字符），将截断到{max_prompt_length}字符")
         #     prompt = prompt[:max_prompt_length]
         
-        # 更新参数 - 使用CLIPTextEncodeFlux节点格式
-        workflow["6"]["inputs"]["clip_l"] = prompt  # CLIP-L编码器的提示词
-        workflow["6"]["inputs"]["t5xxl"] = prompt   # T5编码器的提示词
-        workflow["6"]["inputs"]["guidance"] = guidance_scale
-        
-        workflow["71"]["inputs"]["clip_l"] = ""     # 负面提示词（空）
-        workflow["71"]["inputs"]["t5xxl"] = ""      # 负面提示词（空）
-        workflow["71"]["inputs"]["guidance"] = guidance_scale
-        
-        # KSampler参数
-        workflow["3"]["inputs"]["seed"] = seed
-        workflow["3"]["inputs"]["steps"] = steps
-        workflow["3"]["inputs"]["cfg"] = 1.0  # FLUX通常使用CFG=1
+        values = {
+            'prompt': prompt,
+            'guidance_scale': guidance_scale,
+            'seed': seed,
+            'steps': steps,
+            'width': width,
+            'height': height,
+            'batch_size': num_images
+        }
         
-        # 图像尺寸
-        workflow["5"]["inputs"]["width"] = width
-        workflow["5"]["inputs"]["height"] = height
+        if model:
+            values['model'] = model
         
         # 更新输出文件名
         if task_id:
-            workflow["9"]["inputs"]["filename_prefix"] = f"flux_api_{task_id}"
+            values['filename_prefix'] = f"flux_api_{task_id}"
         
-        return workflow
+        return self.workflow.render(**values)
     
-    def _submit_workflow(self, workflow):
-        """提交工作流到ComfyUI"""
+    def _submit_workflow(self, backend, workflow):
+        """提交工作流（已序列化的JSON字符串）到ComfyUI后端
+
+        连接异常和5xx错误计入后端健康状态并允许换后端重试；
+        4xx表示工作流本身有问题，换后端也不会成功。
+        """
         try:
-            response = requests.post(
-                f"{self.base_url}/prompt",
-                json={"prompt": workflow},
-                timeout=30
+            response = backend.http.post(
+                "/prompt",
+                data=f'{{"prompt": {workflow}, "client_id": {json.dumps(backend.client_id)}}}'.encode('utf-8'),
+                headers={'Content-Type': 'application/json'},
+                read_timeout=30
             )
             
             if response.status_code == 200:
                 data = response.json()
-                return data.get("prompt_id")
-            else:
-                logger.error(f"提交工作流失败: {response.status_code} - {response.text}")
-                return None
-                
-        except Exception as e:
-            logger.error(f"提交工作流异常: {e}")
-            return None
-    
-    def _wait_for_completion(self, prompt_id, timeout=300):
-        """等待生成完成"""
-        try:
-            start_time = time.time()
-            logger.info(f"开始等待任务完成，prompt_id: {prompt_id}")
+                return {'success': True, 'prompt_id': data.get("prompt_id")}
             
-            while time.time() - start_time < timeout:
-                # 检查队列状态
-                response = requests.get(f"{self.base_url}/queue", timeout=5)
-                if response.status_code == 200:
-                    queue_data = response.json()
-                    
-                    # 检查是否在执行队列中
-                    executing = queue_data.get("queue_running", [])
-                    pending = queue_data.get("queue_pending", [])
-                    
-                    # 检查是否完成 - 使用与simple_api_test.py相同的逻辑
-                    found_in_queue = False
-                    for item in executing + pending:
-                        # item格式: [number, prompt_id, ...]
-                        if len(item) > 1 and item[1] == prompt_id:
-                            found_in_queue = True
-                            break
-                    
-                    if not found_in_queue:
-                        # 任务完成
-                        logger.info(f"任务完成，prompt_id: {prompt_id}")
-                        return {'success': True}
-                else:
-                    logger.warning(f"获取队列状态失败: {response.status_code}")
+            logger.error(f"提交工作流失败: {backend.name} - {response.status_code} - {response.text}")
+            error = f'提交工作流失败: HTTP {response.status_code}'
+            if response.status_code >= 500:
+                backend.record_failure(error, self.pool.unhealthy_threshold)
+                backend.breaker.record_failure('submit')
+                return {'success': False, 'error': error, 'retryable': True}
+            backend.breaker.release()
+            return {'success': False, 'error': error, 'retryable': False}
                 
-                time.sleep(2)  # 每2秒检查一次
-                elapsed = time.time() - start_time
-                if elapsed % 10 == 0:  # 每10秒打印一次进度
-                    logger.info(f"等待中... {elapsed:.0f}s")
-            
-            logger.error(f"等待超时，prompt_id: {prompt_id}")
-            return {'success': False, 'error': f'生成超时（{timeout}秒）'}
-            
         except Exception as e:
-            logger.error(f"等待完成失败: {e}")
-            return {'success': False, 'error': str(e)}
+            logger.error(f"提交工作流异常: {backend.name} - {e}")
+            backend.record_failure(e, self.pool.unhealthy_threshold)
+            backend.breaker.record_failure('submit')
+            return {'success': False, 'error': f'提交工作流失败: {e}', 'retryable': True}
+    
+    def reconcile(self, prompt_ids, force=False):
+        """对账在途prompt
+
+        只轮询事件连接不可用或刚重新连接的后端，以及有重启前提交的prompt的后端；
+        force为True时轮询所有后端，用于定期兜底，防止遗漏事件。
+        """
+        finished = []
+        for backend, backend_prompt_ids in self._group_by_backend(prompt_ids).items():
+            epoch = backend.connection_epoch
+            if (not force and self.pool.events_connected(backend)
+                    and epoch == backend.reconciled_epoch):
+                recovered = [pid for pid in backend_prompt_ids if pid in self._recovered_prompts]
+                if recovered:
+                    finished.extend(self._poll_backend(backend, recovered))
+                continue
+            backend.reconciled_epoch = epoch
+            finished.extend(self._poll_backend(backend, backend_prompt_ids))
+        return finished
     
-    def _check_completion_status(self, prompt_id):
+    def _group_by_backend(self, prompt_ids):
+        groups = {}
+        for prompt_id in prompt_ids:
+            backend = self._prompt_backends.get(prompt_id)
+            if backend is not None:
+                groups.setdefault(backend, []).append(prompt_id)
+        return groups
+    
+    def _poll_backend(self, backend, prompt_ids):
+        queued_ids = self.get_queued_prompt_ids(backend)
+        if queued_ids is None:
+            return []
+        
+        finished = [pid for pid in prompt_ids if pid not in queued_ids]
+        for prompt_id in finished:
+            logger.info(f"任务完成，prompt_id: {prompt_id}")
+            self.mark_finished(prompt_id, {'success': True, 'outputs': None})
+        return finished
+    
+    def _check_completion_status(self, backend, prompt_id):
         """检查完成状态"""
         try:
-            response = requests.get(f"{self.base_url}/history/{prompt_id}", timeout=5)
+            response = backend.http.get(f"/history/{prompt_id}", read_timeout=5)
             if response.status_code == 200:
                 history = response.json()
                 if prompt_id in history:
@@ -400,55 +776,121 @@ class ComfyUIManager:
             logger.error(f"检查完成状态失败: {e}")
             return {'success': False, 'error': str(e)}
     
-    def _get_generated_image(self, prompt_id, task_id):
-        """获取生成的图片"""
+    def _get_generated_images(self, backend, prompt_id, task_id, outputs=None):
+        """获取生成的全部图片，返回保存路径列表和对应的sha256；outputs为空时从历史记录中查找"""
         try:
-            # 获取历史记录
-            response = requests.get(f"{self.base_url}/history/{prompt_id}", timeout=10)
-            if response.status_code != 200:
-                return None
-            
-            history = response.json()
-            if prompt_id not in history:
-                return None
+            if not outputs:
+                # 获取历史记录
+                response = backend.http.get(f"/history/{prompt_id}", read_timeout=10)
+                if response.status_code != 200:
+                    return [], []
+                
+                history = response.json()
+                if prompt_id not in history:
+                    return [], []
+                
+                outputs = history[prompt_id].get("outputs", {})
             
-            # 查找输出图片
-            outputs = history[prompt_id].get("outputs", {})
+            # 查找输出图片，按批次顺序依次保存
+            image_paths = []
+            checksums = []
             for node_id, output in outputs.items():
                 if "images" in output:
                     for image_info in output["images"]:
-                        filename = image_info["filename"]
-                        subfolder = image_info.get("subfolder", "")
-                        
-                        # 下载图片
-                        image_url = f"{self.base_url}/view"
                         params = {
-                            "filename": filename,
-                            "subfolder": subfolder,
+                            "filename": image_info["filename"],
+                            "subfolder": image_info.get("subfolder", ""),
                             "type": "output"
                         }
-                        
-                        image_response = requests.get(image_url, params=params, timeout=30)
-                        if image_response.status_code == 200:
-                            # 保存图片 - 使用绝对路径确保路径正确
-                            # 获取项目根目录（src的上级目录）
-                            current_dir = os.path.dirname(os.path.abspath(__file__))  # src目录
-                            project_root = os.path.dirname(current_dir)  # 项目根目录
-                            output_dir = os.path.join(project_root, "output")
-                            output_path = os.path.join(output_dir, f"{task_id}.png")
-                            
-                            # 确保输出目录存在
-                            os.makedirs(output_dir, exist_ok=True)
-                            
-                            logger.info(f"保存图片到: {output_path}")
-                            
-                            with open(output_path, 'wb') as f:
-                                f.write(image_response.content)
-                            
-                            return output_path
+                        name = image_name(task_id, len(image_paths))
+                        output_path = self.images.staging_path(name)
+                        checksum = None
+                        if backend.transfer_mode == 'local':
+                            checksum = self._transfer_local(backend, params, output_path)
+                        if checksum is None:
+                            checksum = self._download_image(backend, params, output_path)
+                        if checksum is None:
+                            return [], []
+                        image_paths.append(self.images.commit(name, output_path, checksum))
+                        checksums.append(checksum)
             
+            return image_paths, checksums
+        
+        except Exception as e:
+            logger.error(f"获取生成图片失败: {e}")
+            return [], []
+    
+    def _transfer_local(self, backend, params, output_path):
+        """从ComfyUI输出目录硬链接或移动图片，返回sha256；文件不可达时返回None，由调用方回退到HTTP下载
+        
+        与ComfyUI共享文件系统时省去一次HTTP传输和一份图片拷贝。
+        """
+        if backend.output_dir is None:
+            return None
+        source_path = os.path.realpath(os.path.join(backend.output_dir, params["subfolder"], params["filename"]))
+        # 防止历史记录中的文件名指向输出目录之外
+        if os.path.commonpath([source_path, backend.output_dir]) != backend.output_dir:
+            logger.warning(f"图片路径不在ComfyUI输出目录中: {source_path}")
+            return None
+        if not os.path.isfile(source_path):
+            return None
+        
+        tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+        try:
+            if self.local_transfer == 'move':
+                os.rename(source_path, tmp_path)
+            else:
+                os.link(source_path, tmp_path)
+            os.replace(tmp_path, output_path)
+        except OSError as e:
+            # 跨文件系统等情况无法链接，回退到HTTP下载
+            logger.warning(f"本地传输图片失败，改用HTTP下载: {source_path} - {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return None
+        
+        sha256 = hashlib.sha256()
+        with open(output_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        checksum = sha256.hexdigest()
+        logger.info(f"保存图片到: {output_path} (本地{'移动' if self.local_transfer == 'move' else '链接'}, sha256: {checksum[:12]})")
+        return checksum
+    
+    def _download_image(self, backend, params, output_path):
+        """分块下载图片到临时文件，校验完整后原子重命名，返回sha256；失败时返回None
+        
+        图片不会整体读入内存，内存占用与图片大小和并发数无关。
+        """
+        tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+        filename = params["filename"]
+        try:
+            with backend.http.get("/view", params=params, read_timeout=30, stream=True) as response:
+                if response.status_code != 200:
+                    logger.error(f"下载图片失败: {filename} - {response.status_code}")
+                    return None
+                
+                sha256 = hashlib.sha256()
+                size = 0
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+                
+                expected_size = response.headers.get('Content-Length')
+                if expected_size is not None and int(expected_size) != size:
+                    logger.error(f"下载图片不完整: {filename} - {size}/{expected_size} 字节")
+                    return None
             
+            os.replace(tmp_path, output_path)
+            checksum = sha256.hexdigest()
+            logger.info(f"保存图片到: {output_path} ({size} 字节, sha256: {checksum[:12]})")
+            return checksum
+        
         except Exception as e:
-            logger.error(f"获取生成图片失败: {e}")
-            return None 
\ No newline at end of file
+            logger.error(f"下载图片失败: {filename} - {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
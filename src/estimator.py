@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成耗时估计
+根据已完成任务在线拟合执行时间与计算量的线性关系，用于预测请求的执行时间和完成时间
+"""
+
+import threading
+
+# 参考计算量：1024×1024、20步，对应配置中的 default_execution_time
+REFERENCE_WORK = 1024 * 1024 / 1e6 * 20
+
+def task_work(params):
+    """任务的计算量：百万像素 × 步数 × 图片数"""
+    return params['width'] * params['height'] / 1e6 * params['steps'] * params.get('num_images', 1)
+
+class _LinearFit:
+    """带指数遗忘的加权最小二乘：执行时间 = 固定开销 + 单位耗时 × 计算量"""
+
+    def __init__(self, overhead, reference_time, prior_weight, decay):
+        self.decay = decay
+        self.samples = 0
+        self._w = self._x = self._y = self._xx = self._xy = 0.0
+        # 先验：零计算量时为固定开销，参考计算量时为默认执行时间
+        self._add(0.0, overhead, prior_weight / 2)
+        self._add(REFERENCE_WORK, reference_time, prior_weight / 2)
+
+    def _add(self, x, y, weight=1.0):
+        self._w += weight
+        self._x += weight * x
+        self._y += weight * y
+        self._xx += weight * x * x
+        self._xy += weight * x * y
+
+    def observe(self, work, duration):
+        # 旧样本（包括先验）按decay衰减，执行环境变化后估计能跟上
+        self._w *= self.decay
+        self._x *= self.decay
+        self._y *= self.decay
+        self._xx *= self.decay
+        self._xy *= self.decay
+        self._add(work, duration)
+        self.samples += 1
+
+    def coefficients(self):
+        denominator = self._w * self._xx - self._x * self._x
+        if denominator <= 1e-9:
+            return 0.0, self._y / self._x if self._x else 0.0
+        slope = max((self._w * self._xy - self._x * self._y) / denominator, 0.0)
+        intercept = max((self._y - slope * self._x) / self._w, 0.0)
+        return intercept, slope
+
+    def predict(self, work):
+        intercept, slope = self.coefficients()
+        return intercept + slope * work
+
+class ExecutionTimeEstimator:
+    """执行时间估计类
+
+    每个 (后端, 工作流指纹) 维护一个线性模型，由ComfyUI报告的实际执行时间在线更新；
+    尚无样本的后端使用 comfyui.default_execution_time 和 estimator.prior_overhead 作为先验。
+    """
+
+    def __init__(self, config):
+        estimator_config = config.get('estimator', {})
+        self.default_execution_time = config['comfyui'].get('default_execution_time', 20.0)
+        self.prior_overhead = estimator_config.get('prior_overhead', 2.0)
+        self.prior_weight = estimator_config.get('prior_weight', 2.0)
+        self.decay = estimator_config.get('decay', 0.98)
+        self._fits = {}
+        self._lock = threading.Lock()
+
+    def _fit(self, backend_name, workflow):
+        key = (backend_name, workflow)
+        fit = self._fits.get(key)
+        if fit is None:
+            fit = self._fits[key] = _LinearFit(
+                self.prior_overhead, self.default_execution_time, self.prior_weight, self.decay
+            )
+        return fit
+
+    def observe(self, backend_name, workflow, work, duration):
+        """记录一次实际执行时间"""
+        with self._lock:
+            self._fit(backend_name, workflow).observe(work, duration)
+
+    def predict(self, backend_name, workflow, work):
+        """预测执行时间（秒）"""
+        with self._lock:
+            return max(self._fit(backend_name, workflow).predict(work), 0.1)
+
+    def get_stats(self):
+        """获取各模型的拟合系数"""
+        with self._lock:
+            stats = []
+            for (backend_name, workflow), fit in self._fits.items():
+                intercept, slope = fit.coefficients()
+                stats.append({
+                    'backend': backend_name,
+                    'workflow': workflow,
+                    'samples': fit.samples,
+                    'overhead': round(intercept, 3),
+                    'seconds_per_megapixel_step': round(slope, 4)
+                })
+            return stats
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ComfyUI HTTP连接池
+为每个ComfyUI后端维护线程安全的keep-alive连接池
+"""
+
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+class ComfyUIHttpClient:
+    """ComfyUI HTTP客户端类
+
+    所有请求共用一个 requests.Session，底层urllib3连接池负责连接复用。
+    GET请求在连接错误、读超时和5xx网关错误时按指数退避重试；
+    POST只在连接建立失败（请求尚未发出）时重试，避免重复提交工作流。
+    健康探测使用单独的不重试会话，以便尽快发现后端故障。
+    """
+
+    def __init__(self, base_url, http_config=None):
+        http_config = http_config or {}
+        self.base_url = base_url
+        self.pool_size = http_config.get('pool_size', 16)
+        self.connect_timeout = http_config.get('connect_timeout', 3.05)
+        self.read_timeout = http_config.get('read_timeout', 30)
+        retries = http_config.get('retries', 3)
+        backoff_factor = http_config.get('backoff_factor', 0.3)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._probe_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        self._probe_session = requests.Session()
+        self._probe_session.mount('http://', self._probe_adapter)
+        self._probe_session.mount('https://', self._probe_adapter)
+
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, read_timeout=None, **kwargs):
+        """发送GET请求"""
+        return self.request('GET', path, read_timeout, **kwargs)
+
+    def post(self, path, read_timeout=None, **kwargs):
+        """发送POST请求"""
+        return self.request('POST', path, read_timeout, **kwargs)
+
+    def probe(self, path, read_timeout=None):
+        """发送不重试的GET请求，用于健康探测"""
+        return self.request('GET', path, read_timeout, retry=False)
+
+    def request(self, method, path, read_timeout=None, retry=True, **kwargs):
+        """发送请求，超时分为连接超时和读取超时"""
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        session = self.session if retry else self._probe_session
+        with self._lock:
+            self._active += 1
+        try:
+            return session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def get_stats(self):
+        """获取连接池统计：打开、空闲和复用的连接数"""
+        created = 0
+        requests_sent = 0
+        idle = 0
+
+        for adapter in (self._adapter, self._probe_adapter):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                created += pool.num_connections
+                requests_sent += pool.num_requests
+                # 队列中的连接对象可能已被对端关闭，只统计仍持有socket的连接
+                idle += sum(
+                    1 for conn in list(pool.pool.queue)
+                    if conn is not None and getattr(conn, 'sock', None) is not None
+                )
+
+        with self._lock:
+            active = self._active
+
+        return {
+            'pool_size': self.pool_size,
+            'open': idle + active,
+            'idle': idle,
+            'active': active,
+            'created': created,
+            'requests': requests_sent,
+            'reused': max(requests_sent - created, 0)
+        }
+
+    def close(self):
+        """关闭会话及其连接"""
+        self.session.close()
+        self._probe_session.close()
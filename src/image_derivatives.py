@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片派生
+按请求参数生成缩略图和WebP/JPEG格式的派生图片，编码在独立的进程池中进行，
+结果保存在图片存储中原图旁边，同一派生图片只生成一次
+"""
+
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from PIL import Image
+from .metrics import STAGE_SECONDS, ERRORS
+
+logger = logging.getLogger(__name__)
+
+# 格式 -> (PIL格式名, 扩展名, MIME类型)
+FORMATS = {
+    'png': ('PNG', 'png', 'image/png'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'jpg': ('JPEG', 'jpg', 'image/jpeg')
+}
+
+def watch_parent(parent_pid):
+    """编码进程的初始化函数：服务进程退出（包括被强制结束）后编码进程随之退出"""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+def render_derivative(source_path, dest_path, width, height, image_format, quality):
+    """在进程池中执行：缩放并编码图片，保存到dest_path"""
+    with Image.open(source_path) as image:
+        if width or height:
+            # 只缩小不放大，保持宽高比
+            image.thumbnail((width or image.width, height or image.height), Image.LANCZOS)
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        options = {'optimize': True}
+        if image_format in ('JPEG', 'WEBP'):
+            options['quality'] = quality
+        image.save(dest_path, format=image_format, **options)
+
+class DerivativeService:
+    """图片派生服务类
+
+    derivatives.enabled          是否允许请求派生图片
+    derivatives.workers          编码进程数
+    derivatives.max_dimension    缩放后宽高的上限
+    derivatives.default_quality  WebP/JPEG的默认质量
+    derivatives.timeout          等待编码的最长时间（秒）
+
+    派生图片以 <图片ID>.w<宽>h<高>q<质量>.<扩展名> 保存在图片存储中，与原图同目录，
+    同样受保留时间和容量上限清理。本进程内同一派生图片的并发请求等待同一次编码。
+    """
+
+    def __init__(self, derivative_config, image_store):
+        self.image_store = image_store
+        self.enabled = derivative_config.get('enabled', True)
+        self.workers = derivative_config.get('workers', 2)
+        self.max_dimension = derivative_config.get('max_dimension', 2048)
+        self.default_quality = derivative_config.get('default_quality', 80)
+        self.timeout = derivative_config.get('timeout', 60)
+
+        self._executor = None
+        self._inflight = {}  # 派生图片名 -> Future
+        self._lock = threading.Lock()
+
+    def parse(self, args):
+        """解析查询参数（w、h、format、q），返回 (派生参数, 错误列表)；不需要派生时参数为None"""
+        if not any(args.get(key) for key in ('w', 'h', 'format', 'q')):
+            return None, []
+        if not self.enabled:
+            return None, ['未启用图片派生']
+
+        # 宽高为0表示不限制
+        errors = []
+        spec = {'width': 0, 'height': 0, 'format': 'png', 'quality': self.default_quality}
+        for key, field, maximum in (('w', 'width', self.max_dimension), ('h', 'height', self.max_dimension),
+                                    ('q', 'quality', 100)):
+            value = args.get(key)
+            if not value:
+                continue
+            try:
+                spec[field] = int(value)
+            except ValueError:
+                spec[field] = -1
+            if spec[field] < 1 or spec[field] > maximum:
+                errors.append(f'{key}必须是1到{maximum}之间的整数')
+
+        image_format = args.get('format', 'png').lower()
+        if image_format not in FORMATS:
+            errors.append(f'format必须是{"、".join(FORMATS)}之一')
+        else:
+            spec['format'] = image_format
+        return spec, errors
+
+    def mimetype(self, spec):
+        return FORMATS[spec['format']][2]
+
+    def name(self, image_id, spec):
+        """派生图片在图片存储中的名称"""
+        _, extension, _ = FORMATS[spec['format']]
+        quality = spec['quality'] if extension != 'png' else 0
+        return f"{image_id}.w{spec['width']}h{spec['height']}q{quality}.{extension}"
+
+    def get(self, image_id, spec):
+        """获取派生图片（格式同 ImageStore.get），尚未生成时生成；原图不存在时返回None"""
+        name = self.name(image_id, spec)
+        image = self.image_store.get(name)
+        if image is not None:
+            return image
+
+        with self._lock:
+            future = self._inflight.get(name)
+            owner = future is None
+            if owner:
+                future = self._inflight[name] = Future()
+
+        if not owner:
+            return future.result(self.timeout)
+
+        try:
+            image = self._render(image_id, name, spec)
+            future.set_result(image)
+            return image
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(name, None)
+
+    def _render(self, image_id, name, spec):
+        # 其他请求可能刚刚生成完毕
+        image = self.image_store.get(name)
+        if image is not None:
+            return image
+        source = self.image_store.get(f"{image_id}.png")
+        if source is None:
+            return None
+
+        image_format, _, _ = FORMATS[spec['format']]
+        staging_path = self.image_store.staging_path(name)
+        started = time.perf_counter()
+        try:
+            self._get_executor().submit(
+                render_derivative, source['path'], staging_path,
+                spec['width'], spec['height'], image_format, spec['quality']
+            ).result(self.timeout)
+        except Exception:
+            ERRORS.inc(stage='derivative')
+            raise
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='derivative')
+        self.image_store.commit(name, staging_path)
+        logger.info(f"生成派生图片: {name}")
+        return self.image_store.get(name)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # 服务进程中已有多个线程，使用spawn创建编码进程，避免fork继承其他线程持有的锁
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=watch_parent, initargs=(os.getpid(),)
+                )
+            return self._executor
+
+    def stop(self):
+        """关闭编码进程池"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片存储
+生成的图片按名称哈希分目录保存，元数据索引记录大小、创建时间和最近访问时间，
+后台清理线程按保留时间和总容量（LRU）删除旧图片；存储后端可以替换
+"""
+
+import os
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    checksum TEXT,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_accessed_at ON images (accessed_at);
+CREATE INDEX IF NOT EXISTS idx_images_created_at ON images (created_at);
+CREATE TABLE IF NOT EXISTS image_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS images_totals_insert AFTER INSERT ON images BEGIN
+    UPDATE image_totals SET count = count + 1, size = size + new.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS images_totals_delete AFTER DELETE ON images BEGIN
+    UPDATE image_totals SET count = count - 1, size = size - old.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS images_totals_update AFTER UPDATE OF size ON images BEGIN
+    UPDATE image_totals SET size = size - old.size + new.size WHERE id = 0;
+END;
+-- 旧版本的索引没有汇总行，按现有记录补上（已有时不覆盖）
+INSERT OR IGNORE INTO image_totals (id, count, size)
+    SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM images;
+"""
+
+# 最近访问时间的最小更新间隔（秒），避免每次读取图片都写索引
+TOUCH_INTERVAL = 60
+
+def file_checksum(path):
+    """计算文件的sha256"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def image_name(task_id, index=0):
+    """任务第index张图片的文件名，批量生成时后续图片为 <task_id>_<index>.png"""
+    if index == 0:
+        return f"{task_id}.png"
+    return f"{task_id}_{index}.png"
+
+class StorageBackend:
+    """图片存储后端接口
+
+    名称为不含目录的文件名；save 之后源文件可以删除，local_path 返回可直接读取（send_file）的本地路径。
+    """
+
+    def save(self, name, source_path):
+        """保存本地文件，返回保存后的本地路径"""
+        raise NotImplementedError
+
+    def local_path(self, name):
+        """返回本地路径，不存在时返回None"""
+        raise NotImplementedError
+
+    def delete(self, name):
+        """删除文件，不存在时忽略"""
+        raise NotImplementedError
+
+    def scan(self):
+        """遍历所有文件，生成 (名称, 大小, 修改时间)，用于重建索引"""
+        raise NotImplementedError
+
+class LocalDiskBackend(StorageBackend):
+    """本地磁盘存储后端
+
+    文件保存在 <root>/<ab>/<cd>/<名称>，ab/cd 为名称第一个"."之前部分的MD5前缀，
+    同一张图片的派生文件与原图在同一目录；每个目录的文件数保持在几百个以内。
+    """
+
+    def __init__(self, root, shard_depth=2):
+        self.root = root
+        self.shard_depth = shard_depth
+
+    def _path(self, name):
+        digest = hashlib.md5(name.split('.')[0].encode('utf-8')).hexdigest()
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.root, *shards, name)
+
+    def save(self, name, source_path):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+        return path
+
+    def local_path(self, name):
+        for path in (self._path(name), os.path.join(self.root, name)):
+            # 旧版本平铺在根目录的图片在重建索引时才移动到分片目录
+            if os.path.exists(path):
+                return path
+        return None
+
+    def delete(self, name):
+        for path in (self._path(name), os.path.join(self.root, name)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def scan(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # 跳过写入中的临时目录
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if dirpath == self.root:
+                    # 旧版本平铺在根目录的图片移动到分片目录
+                    path = self.save(filename, path)
+                stat = os.stat(path)
+                yield filename, stat.st_size, stat.st_mtime
+
+class ObjectStoreBackend(StorageBackend):
+    """对象存储后端（以本地目录模拟）
+
+    对象以 images/<名称> 为键平铺保存在 <root>/objects 下，保存时复制内容（相当于上传），
+    不依赖与暂存目录在同一文件系统；可作为接入真实对象存储前的替身。
+    """
+
+    def __init__(self, root):
+        self.bucket_dir = os.path.join(root, 'objects', 'images')
+        os.makedirs(self.bucket_dir, exist_ok=True)
+
+    def save(self, name, source_path):
+        path = os.path.join(self.bucket_dir, name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        os.remove(source_path)
+        return path
+
+    def local_path(self, name):
+        path = os.path.join(self.bucket_dir, name)
+        return path if os.path.exists(path) else None
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.bucket_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def scan(self):
+        with os.scandir(self.bucket_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime
+
+BACKENDS = {
+    'local': LocalDiskBackend,
+    'object': ObjectStoreBackend
+}
+
+class ImageStore:
+    """图片存储类
+
+    storage.backend           存储后端：local（分片目录）或 object（对象存储替身）
+    storage.dir               存储根目录
+    storage.shard_depth       local 后端的分片目录层数（每层256个目录）
+    storage.index             元数据索引（SQLite）路径，多个工作进程共享
+    storage.ttl               图片保留时间（秒），0为不限制
+    storage.max_size_mb       图片总容量上限，超过时按最近访问时间淘汰，0为不限制
+    storage.janitor_interval  清理周期（秒）
+
+    写入时先写到 staging_path() 返回的暂存文件，再由 commit() 保存到后端并登记索引；
+    索引中的sha256在写入时计算，用作HTTP响应的ETag。
+    图片数量和总大小由索引中的触发器随写入和删除维护（image_totals），统计和清理时不需要扫描全表。
+    """
+
+    def __init__(self, storage_config, project_root):
+        self.root = os.path.join(project_root, storage_config.get('dir', 'output'))
+        self.backend_name = storage_config.get('backend', 'local')
+        self.index_path = os.path.join(project_root, storage_config.get('index', 'data/images.db'))
+        self.ttl = storage_config.get('ttl', 30 * 24 * 3600)
+        self.max_bytes = int(storage_config.get('max_size_mb', 0) * 1024 * 1024)
+        self.janitor_interval = storage_config.get('janitor_interval', 300)
+
+        if self.backend_name not in BACKENDS:
+            raise ValueError(f"未知的图片存储后端: {self.backend_name}")
+        if self.backend_name == 'local':
+            self.backend = LocalDiskBackend(self.root, storage_config.get('shard_depth', 2))
+        else:
+            self.backend = BACKENDS[self.backend_name](self.root)
+        self.staging_dir = os.path.join(self.root, '.staging')
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+        self._local = threading.local()
+        self._running = False
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.evicted = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=5.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE 替换已有记录时也要触发删除触发器，汇总才不会重复计入
+            conn.execute('PRAGMA recursive_triggers=ON')
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        """启动后台清理线程"""
+        if self._running:
+            return
+        self._running = True
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._janitor_loop, name='image-janitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._stop_event.set()
+
+    def staging_path(self, name):
+        """写入用的暂存文件路径（与存储在同一文件系统）"""
+        return os.path.join(self.staging_dir, f"{uuid.uuid4().hex}.{name}")
+
+    def commit(self, name, staging_path, checksum=None):
+        """把暂存文件保存到后端并登记索引，返回保存后的本地路径；checksum为空时计算sha256"""
+        size = os.path.getsize(staging_path)
+        if checksum is None:
+            checksum = file_checksum(staging_path)
+        path = self.backend.save(name, staging_path)
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO images (name, size, checksum, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (name, size, checksum, now, now)
+            )
+        return path
+
+    def get(self, name):
+        """获取图片并记录访问，返回 {'path', 'size', 'checksum'}，不存在时返回None"""
+        conn = self._connect()
+        row = conn.execute('SELECT size, checksum, accessed_at FROM images WHERE name = ?', (name,)).fetchone()
+        path = self.backend.local_path(name)
+        if path is None:
+            if row is not None:
+                self._remove_rows([name])
+            return None
+
+        now = time.time()
+        if row is None or row[1] is None:
+            # 索引中没有或缺少校验和（例如旧版本写入的文件），补登记
+            stat = os.stat(path)
+            size, checksum = stat.st_size, file_checksum(path)
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO images (name, size, checksum, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                    (name, size, checksum, stat.st_mtime, now)
+                )
+        else:
+            size, checksum, accessed_at = row
+            if now - accessed_at > TOUCH_INTERVAL:
+                with conn:
+                    conn.execute('UPDATE images SET accessed_at = ? WHERE name = ?', (now, name))
+        return {'path': path, 'size': size, 'checksum': checksum}
+
+    def delete(self, name):
+        self.backend.delete(name)
+        self._remove_rows([name])
+
+    def purge(self):
+        """删除超过保留时间的图片，总容量超过上限时按最近访问时间淘汰，返回删除数量"""
+        conn = self._connect()
+        expired = []
+        if self.ttl:
+            expired = [row[0] for row in conn.execute(
+                'SELECT name FROM images WHERE created_at < ?', (time.time() - self.ttl,)
+            )]
+        self._remove(expired)
+
+        evicted = []
+        if self.max_bytes:
+            _, total = self._totals(conn)
+            if total > self.max_bytes:
+                for name, size in conn.execute('SELECT name, size FROM images ORDER BY accessed_at'):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(name)
+                    total -= size
+        self._remove(evicted)
+
+        if expired or evicted:
+            logger.info(f"图片清理完成: 过期 {len(expired)} 个, 超出容量淘汰 {len(evicted)} 个")
+        return len(expired) + len(evicted)
+
+    def get_stats(self):
+        """获取存储统计"""
+        count, size = self._totals(self._connect())
+        return {
+            'backend': self.backend_name,
+            'images': count,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'evicted': self.evicted
+        }
+
+    def _totals(self, conn):
+        """索引中的图片数量和总大小"""
+        return conn.execute('SELECT count, size FROM image_totals WHERE id = 0').fetchone()
+
+    def _remove(self, names):
+        for name in names:
+            self.backend.delete(name)
+        self._remove_rows(names)
+        self.evicted += len(names)
+
+    def _remove_rows(self, names):
+        if not names:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany('DELETE FROM images WHERE name = ?', [(name,) for name in names])
+
+    def _reindex(self):
+        """索引为空时扫描存储后端重建索引（首次启用或索引文件丢失）"""
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM images LIMIT 1').fetchone() is not None:
+            return
+        count = 0
+        batch = []
+        for name, size, mtime in self.backend.scan():
+            batch.append((name, size, mtime, mtime))
+            if len(batch) >= 1000:
+                count += self._insert_scanned(batch)
+                batch = []
+        count += self._insert_scanned(batch)
+        if count:
+            logger.info(f"图片索引已重建: {count} 个文件")
+
+    def _insert_scanned(self, batch):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO images (name, size, created_at, accessed_at) VALUES (?, ?, ?, ?)', batch
+            )
+        return len(batch)
+
+    def _clean_staging(self):
+        """删除异常退出遗留的暂存文件"""
+        cutoff = time.time() - 3600
+        with os.scandir(self.staging_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def _janitor_loop(self):
+        try:
+            self._reindex()
+        except Exception as e:
+            logger.error(f"重建图片索引失败: {e}", exc_info=True)
+        while self._running:
+            try:
+                self.purge()
+                self._clean_staging()
+            except Exception as e:
+                logger.error(f"图片清理异常: {e}", exc_info=True)
+            self._stop_event.wait(self.janitor_interval)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ComfyUI元数据缓存
+后台线程定期获取 /object_info 并解析为加载器、模型列表和节点定义的索引，
+/models 和 /status 的响应在内存中缓存，并预先生成gzip压缩内容
+"""
+
+import os
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from .metrics import STAGE_SECONDS, ERRORS
+
+logger = logging.getLogger(__name__)
+
+def encode_json(payload, gzip_min_size=1024):
+    """编码JSON响应，内容较大时同时生成gzip压缩内容"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return {
+        'body': body,
+        'gzip': gzip.compress(body, compresslevel=6) if len(body) >= gzip_min_size else None
+    }
+
+def accepts_gzip(accept_encoding):
+    """Accept-Encoding 是否接受gzip（q=0表示拒绝）"""
+    for item in (accept_encoding or '').split(','):
+        coding, *params = item.split(';')
+        if coding.strip().lower() not in ('gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+def select_encoding(encoded, accept_encoding):
+    """按客户端的 Accept-Encoding 选择响应内容，返回 (响应体, 响应头)"""
+    headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+    if encoded['gzip'] is not None and accepts_gzip(accept_encoding):
+        headers['Content-Encoding'] = 'gzip'
+        return encoded['gzip'], headers
+    return encoded['body'], headers
+
+def build_index(object_info, parse_models):
+    """将 /object_info 解析为索引
+
+    nodes    节点类型 -> 节点定义（输入、输出、分类）
+    loaders  加载器节点 -> 输入名 -> 可选值列表（即可用的模型文件）
+    models   /models 返回的模型列表（parse_models(object_info)）
+    """
+    nodes = {}
+    loaders = {}
+    for class_type, info in object_info.items():
+        if not isinstance(info, dict):
+            continue
+        nodes[class_type] = {
+            'input': info.get('input', {}),
+            'output': info.get('output', []),
+            'output_name': info.get('output_name', []),
+            'category': info.get('category', '')
+        }
+        if 'loader' not in class_type.lower() and 'loaders' not in info.get('category', ''):
+            continue
+        options = {}
+        for section in ('required', 'optional'):
+            for name, spec in (info.get('input', {}).get(section) or {}).items():
+                # 下拉选项的定义为 [[可选值, ...], {...}]
+                if isinstance(spec, (list, tuple)) and spec and isinstance(spec[0], list):
+                    options[name] = spec[0]
+        if options:
+            loaders[class_type] = options
+    return {
+        'nodes': nodes,
+        'loaders': loaders,
+        'models': parse_models(object_info)
+    }
+
+class MetadataCache:
+    """ComfyUI元数据缓存类
+
+    metadata.ttl               /object_info 索引的有效期（秒），过期后由后台线程刷新
+    metadata.refresh_interval  后台线程检查索引是否过期的间隔（秒）
+    metadata.status_ttl        /status 响应的缓存时间（秒），0表示不缓存
+    metadata.gzip_min_size     响应大于此字节数时预先生成gzip压缩内容
+    metadata.shared_file       多进程部署时各工作进程共享的 /object_info 内容文件
+
+    刷新失败时继续使用上次的索引；/object_info 内容未变化时不重新解析。
+    后端的可用状态由 BackendPool 的健康检查线程维护，/status 不再逐次探测后端。
+    多进程部署时（见 share）只有一个工作进程从ComfyUI获取 /object_info 并写入共享文件，
+    其他工作进程读取该文件；共享文件超过两倍 ttl 未更新时（负责的进程已退出）各自获取。
+    """
+
+    def __init__(self, metadata_config, comfyui_manager):
+        self.comfyui_manager = comfyui_manager
+        self.ttl = metadata_config.get('ttl', 300)
+        self.refresh_interval = metadata_config.get('refresh_interval', 10)
+        self.status_ttl = metadata_config.get('status_ttl', 1.0)
+        self.gzip_min_size = metadata_config.get('gzip_min_size', 1024)
+        self.shared_file = os.path.join(
+            comfyui_manager.project_root, metadata_config.get('shared_file', 'data/object_info.json')
+        )
+        self.shared = False   # 是否通过共享文件与其他工作进程共享
+        self.leader = True    # 是否由本进程从ComfyUI获取
+
+        self.index = None
+        self.digest = None         # /object_info 响应内容的SHA-256
+        self.source = None         # 提供 /object_info 的后端
+        self.refreshed_at = None
+        self.last_error = None
+        self.refreshes = 0
+
+        self._models_response = None
+        self._status_response = None
+        self._status_built_at = 0.0
+        self._refresh_lock = threading.RLock()
+        self._status_lock = threading.Lock()
+        self._running = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self._running:
+            return
+        self._running = True
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name='metadata-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台刷新线程"""
+        self._running = False
+        self._stop_event.set()
+
+    def share(self, leader):
+        """多进程部署时调用，leader 为True的进程获取 /object_info 并写入共享文件，其他进程读取该文件"""
+        self.shared = True
+        self.leader = leader
+
+    @property
+    def expired(self):
+        return self.refreshed_at is None or time.time() - self.refreshed_at >= self.ttl
+
+    def refresh(self):
+        """从第一个可用的后端获取 /object_info 并更新索引，返回是否成功"""
+        with self._refresh_lock:
+            if self.shared and not self.leader and self._load_shared():
+                return True
+            error = 'Failed to fetch models'
+            for backend in self.comfyui_manager.pool.healthy_backends():
+                started = time.perf_counter()
+                try:
+                    response = backend.http.get("/object_info", read_timeout=10)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"HTTP {response.status_code}")
+                    self.update(response.content, backend.name)
+                    if self.shared:
+                        self._save_shared(response.content)
+                    STAGE_SECONDS.observe(time.perf_counter() - started, stage='object_info')
+                    return True
+                except Exception as e:
+                    ERRORS.inc(stage='object_info')
+                    logger.error(f"获取模型列表失败: {backend.name} - {e}")
+                    error = str(e)
+            self.last_error = error
+            return False
+
+    def update(self, content, source=None):
+        """用 /object_info 的响应内容更新索引，内容未变化时只更新刷新时间"""
+        digest = hashlib.sha256(content).hexdigest()
+        if digest != self.digest:
+            index = build_index(json.loads(content), self.comfyui_manager.parse_models)
+            self._models_response = encode_json({'models': index['models']}, self.gzip_min_size)
+            self.index = index
+            self.digest = digest
+            logger.info(f"已更新ComfyUI元数据索引: {len(index['nodes'])} 个节点, {source}")
+        self.source = source
+        self.refreshed_at = time.time()
+        self.last_error = None
+        self.refreshes += 1
+
+    def ensure_index(self):
+        """尚未获取过索引时同步获取（并发请求只获取一次），返回索引是否可用"""
+        if self.index is None:
+            with self._refresh_lock:
+                if self.index is None:
+                    self.refresh()
+        return self.index is not None
+
+    def get_models(self):
+        """模型列表，尚未获取过索引时同步获取"""
+        if not self.ensure_index():
+            return {'error': self.last_error}
+        return self.index['models']
+
+    def models_response(self):
+        """/models 的响应内容（见 encode_json），尚未获取过索引时同步获取"""
+        if not self.ensure_index():
+            return encode_json({'models': {'error': self.last_error}}, self.gzip_min_size)
+        return self._models_response
+
+    def status_response(self, build):
+        """/status 的响应内容，缓存 status_ttl 秒；build() 返回最新的状态信息"""
+        now = time.monotonic()
+        if self._status_response is not None and now - self._status_built_at < self.status_ttl:
+            return self._status_response
+        with self._status_lock:
+            # 等待锁期间其他线程可能已经生成
+            if self._status_response is None or time.monotonic() - self._status_built_at >= self.status_ttl:
+                self._status_response = encode_json(build(), self.gzip_min_size)
+                self._status_built_at = time.monotonic()
+            return self._status_response
+
+    def get_stats(self):
+        """获取元数据缓存统计"""
+        return {
+            'nodes': len(self.index['nodes']) if self.index else 0,
+            'loaders': len(self.index['loaders']) if self.index else 0,
+            'source': self.source,
+            'refreshed_at': self.refreshed_at,
+            'refreshes': self.refreshes,
+            'ttl': self.ttl,
+            'last_error': self.last_error
+        }
+
+    def _load_shared(self):
+        """读取其他工作进程写入的共享文件，文件不存在或超过两倍 ttl 未更新时返回False"""
+        try:
+            if time.time() - os.path.getmtime(self.shared_file) > 2 * self.ttl:
+                return False
+            with open(self.shared_file, 'rb') as f:
+                content = f.read()
+            self.update(content, 'shared')
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"读取共享的元数据失败: {e}")
+            return False
+
+    def _save_shared(self, content):
+        """写入共享文件，先写临时文件再替换，读取方不会读到写了一半的内容"""
+        try:
+            os.makedirs(os.path.dirname(self.shared_file), exist_ok=True)
+            tmp_path = f"{self.shared_file}.{uuid.uuid4().hex}.part"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, self.shared_file)
+        except Exception as e:
+            logger.warning(f"写入共享的元数据失败: {e}")
+
+    def _refresh_loop(self):
+        while self._running:
+            if self.expired:
+                self.refresh()
+            self._stop_event.wait(self.refresh_interval)
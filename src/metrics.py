@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标
+按Prometheus文本格式导出各阶段耗时直方图、错误计数和队列深度等指标
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+# 各阶段耗时直方图的默认分桶（秒），覆盖从毫秒级的参数校验到分钟级的生成
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric:
+    """指标基类，按标签值分别保存数据"""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}"
+        ]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    """只增计数器"""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', key, None, value) for key, value in items]
+
+class Gauge(_Metric):
+    """瞬时值；设置了回调函数时在导出时读取当前值"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """导出时调用 function()：无标签时返回数值，有标签时返回 {标签值元组: 数值}"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception:
+                return []
+            if not self.labelnames:
+                return [('', (), None, result)]
+            items = sorted((tuple(str(v) for v in key), value) for key, value in result.items())
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [('', key, None, value) for key, value in items]
+
+class Histogram(_Metric):
+    """直方图，记录观测值的分布、总和与次数"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录代码块的执行时间"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        samples = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, f'le="{_format_value(bound)}"', cumulative))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, count))
+        return samples
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """以Prometheus文本格式导出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 请求各阶段耗时：
+# validation 参数校验，prepare 工作流准备，submit 提交到ComfyUI，
+# queue 在ComfyUI队列中等待，execution 执行，transfer 图片传输，encode 响应编码，
+# derivative 派生图片编码，object_info 获取ComfyUI元数据
+STAGE_SECONDS = Histogram(
+    'flux_api_stage_seconds', '请求各阶段耗时（秒）', ['stage']
+)
+GENERATION_SECONDS = Histogram(
+    'flux_api_generation_seconds', '任务从创建到结束的总耗时（秒）', ['status']
+)
+ERRORS = Counter(
+    'flux_api_errors_total', '各阶段的错误次数', ['stage']
+)
+TIMEOUTS = Counter(
+    'flux_api_timeouts_total', '超时次数（task 为生成超时，request 为同步请求等待超时）', ['kind']
+)
+CACHE_LOOKUPS = Counter(
+    'flux_api_cache_lookups_total', '结果缓存查询次数', ['result']
+)
+ADMISSION_REJECTED = Counter(
+    'flux_api_admission_rejected_total', '因超出准入限制被拒绝的请求数', ['reason']
+)
+COALESCED = Counter(
+    'flux_api_coalesced_requests_total', '合并到在途任务的请求数'
+)
+INFLIGHT_TASKS = Gauge(
+    'flux_api_inflight_tasks', '等待提交和已提交到ComfyUI但尚未结束的任务数', ['state']
+)
+BACKEND_QUEUE_DEPTH = Gauge(
+    'flux_api_backend_queue_depth', '各ComfyUI后端的队列深度', ['backend']
+)
+BACKEND_HEALTHY = Gauge(
+    'flux_api_backend_healthy', '各ComfyUI后端是否健康（1为健康）', ['backend']
+)
+BACKEND_CIRCUIT_STATE = Gauge(
+    'flux_api_backend_circuit_state', '各ComfyUI后端的熔断状态（0为正常，1为试探，2为熔断）', ['backend']
+)
+CIRCUIT_TRANSITIONS = Counter(
+    'flux_api_circuit_transitions_total', '熔断器状态切换次数', ['backend', 'state']
+)
+AFFINITY_HITS = Counter(
+    'flux_api_affinity_hits_total', '提交时可复用ComfyUI节点缓存的次数（encoder 文本编码，loader 模型加载）', ['kind']
+)
+MODEL_SWAPS = Counter(
+    'flux_api_model_swaps_total', '各ComfyUI后端更换UNet模型的次数', ['backend']
+)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成结果缓存
+对指定了种子的确定性请求缓存生成的图片，重复请求无需再经过ComfyUI
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from uuid import uuid4
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def link_or_copy(src, dst):
+    """优先使用硬链接，跨文件系统等无法链接时复制文件"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def make_request_key(params, fingerprint):
+    """计算确定性请求的键，未指定种子（结果不确定）时返回None
+
+    键由规范化的请求参数和工作流/模型指纹计算得到，相同的键必然产生相同的图片。
+    """
+    if params.get('seed', -1) == -1:
+        return None
+
+    canonical = {
+        'prompt': params['prompt'].strip(),
+        'width': int(params['width']),
+        'height': int(params['height']),
+        'steps': int(params['steps']),
+        'guidance_scale': float(params['guidance_scale']),
+        'seed': int(params['seed']),
+        'fingerprint': fingerprint
+    }
+    # 单张生成时不加入num_images，保持与已有缓存键一致
+    num_images = int(params.get('num_images', 1))
+    if num_images != 1:
+        canonical['num_images'] = num_images
+    payload = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """生成结果缓存类
+
+    缓存键见 make_request_key，图片以 <key>.png 保存在磁盘上，
+    批量生成的后续图片为 <key>_<index>.png。
+    文件的修改时间记录最近访问时间，启动时据此恢复LRU顺序；
+    总大小超过预算时按LRU淘汰。
+    """
+
+    def __init__(self, cache_config, project_root):
+        self.enabled = cache_config.get('enabled', True)
+        self.cache_dir = os.path.join(project_root, cache_config.get('dir', 'cache/results'))
+        self.max_bytes = int(cache_config.get('max_size_mb', 2048) * 1024 * 1024)
+
+        self._entries = OrderedDict()  # key -> (总大小, 图片数)，按访问顺序排列
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_entries()
+
+    def get(self, key):
+        """查找缓存，命中时返回缓存图片路径列表"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key not in self._entries and not self._adopt(key):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            _, count = self._entries[key]
+            self.hits += 1
+
+        paths = [self._path(key, index) for index in range(count)]
+        try:
+            for path in paths:
+                os.utime(path, None)
+        except OSError:
+            # 文件已被外部删除
+            with self._lock:
+                size, _ = self._entries.pop(key, (0, 0))
+                self._total_bytes -= size
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return paths
+
+    def contains(self, key):
+        """是否有缓存结果（不计入命中统计，也不更新访问顺序）"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            return key in self._entries or self._adopt(key)
+
+    def put(self, key, image_paths):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if not self.enabled or not key:
+            return
+        size = 0
+        tmp_path = None
+        try:
+            for index, image_path in enumerate(image_paths):
+                path = self._path(key, index)
+                # 多个工作进程可能同时写入同一个键，临时文件名不能相同
+                tmp_path = f"{path}.{uuid4().hex}.part"
+                link_or_copy(image_path, tmp_path)
+                os.replace(tmp_path, path)
+                tmp_path = None
+                size += os.path.getsize(path)
+        except OSError as e:
+            logger.warning(f"写入结果缓存失败: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            old_size, _ = self._entries.pop(key, (0, 0))
+            self._total_bytes -= old_size
+            self._entries[key] = (size, len(image_paths))
+            self._total_bytes += size
+            evicted = self._evict()
+
+        self._remove_files(evicted)
+
+    def get_stats(self):
+        """获取缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'size_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+    def _adopt(self, key):
+        """登记其他工作进程写入的缓存文件（调用方持有锁），返回是否找到"""
+        size = count = 0
+        while True:
+            try:
+                size += os.path.getsize(self._path(key, count))
+            except OSError:
+                break
+            count += 1
+        if not count:
+            return False
+        self._entries[key] = (size, count)
+        self._total_bytes += size
+        return True
+
+    def _evict(self):
+        evicted = []
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, (size, count) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append((key, count))
+        return evicted
+
+    def _remove_files(self, evicted):
+        for key, count in evicted:
+            for index in range(count):
+                try:
+                    os.remove(self._path(key, index))
+                except OSError:
+                    pass
+
+    def _path(self, key, index=0):
+        if index == 0:
+            return os.path.join(self.cache_dir, f"{key}.png")
+        return os.path.join(self.cache_dir, f"{key}_{index}.png")
+
+    def _load_entries(self):
+        """扫描缓存目录，按最近访问时间恢复LRU顺序"""
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.png'):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            key = name[:-4].split('_')[0]
+            mtime, size, count = entries.get(key, (0, 0, 0))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, count + 1)
+
+        for key, (_, size, count) in sorted(entries.items(), key=lambda item: item[1][0]):
+            self._entries[key] = (size, count)
+            self._total_bytes += size
+
+        self._remove_files(self._evict())
+        logger.info(f"结果缓存已加载: {len(self._entries)} 条, {self._total_bytes / 1024 / 1024:.1f}MB")
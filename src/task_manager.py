@@ -0,0 +1,830 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+任务管理器
+负责生成任务的排队、分发到ComfyUI以及状态跟踪
+"""
+
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .result_cache import link_or_copy, make_request_key
+from .task_store import TaskStore
+from .image_store import image_name
+from .admission import AdmissionController, AdmissionRejected
+from .affinity_scheduler import AffinityScheduler
+from .estimator import task_work
+from .metrics import (
+    GENERATION_SECONDS, ERRORS, TIMEOUTS, CACHE_LOOKUPS, COALESCED, INFLIGHT_TASKS, ADMISSION_REJECTED
+)
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+STATUS_QUEUED = 'queued'          # 已接收，等待提交到ComfyUI
+STATUS_SUBMITTED = 'submitted'    # 已提交到ComfyUI，等待执行
+STATUS_RUNNING = 'running'        # ComfyUI正在执行
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+STATUSES = (STATUS_QUEUED, STATUS_SUBMITTED, STATUS_RUNNING, STATUS_COMPLETED, STATUS_FAILED)
+
+class Task:
+    """生成任务"""
+
+    def __init__(self, task_id, params):
+        self.task_id = task_id
+        self.params = params
+        self.status = STATUS_QUEUED
+        self.prompt_id = None
+        self.backend = None
+        self.seed = params.get('seed', -1)
+        self.image_paths = []
+        self.checksums = []     # 下载时计算的各图片sha256
+        self.error = None
+        self.request_key = None
+        self.cached = False
+        self.work = 0           # 占用的准入预算（百万像素×步数），结束时归还
+        self.leader = None      # 合并到的同参数在途任务
+        self.coalesced_with = None
+        self.followers = []     # 合并到本任务的其他任务
+        self.created_at = time.time()
+        self.submitted_at = None
+        self.finished_at = None
+        self.queue_position = None  # 同一后端上排在前面的本服务prompt数
+        self.current_node = None
+        self.progress = None        # 采样进度 {'value': n, 'max': N}
+        self.estimated_execution_time = None
+        self.estimated_finish = None  # 预计完成时间（时间戳）
+        self._done = threading.Event()
+        self._subscribers = []
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def generation_time(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.created_at
+
+    @property
+    def image_path(self):
+        return self.image_paths[0] if self.image_paths else None
+
+    @property
+    def image_ids(self):
+        """各图片在 /image/<id> 中使用的ID"""
+        return [self.task_id] + [f"{self.task_id}_{i}" for i in range(1, len(self.image_paths))]
+
+    def wait(self, timeout=None):
+        """等待任务结束，返回是否已结束"""
+        return self._done.wait(timeout)
+
+    def subscribe(self, events=None):
+        """订阅任务事件，返回接收 (事件类型, 数据) 的队列
+
+        events 可以是任何带 put() 方法的对象（例如转发到asyncio队列的适配器）。
+        """
+        if events is None:
+            events = queue.Queue()
+        self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        try:
+            self._subscribers.remove(events)
+        except ValueError:
+            pass
+
+    def publish(self, event_type, data):
+        """向订阅方推送事件，合并到本任务的任务一并推送"""
+        for task in [self] + list(self.followers):
+            for events in list(task._subscribers):
+                events.put((event_type, data))
+
+    def complete(self, image_paths, checksums=None):
+        self.image_paths = image_paths
+        self.checksums = checksums or []
+        self.status = STATUS_COMPLETED
+        self.finished_at = time.time()
+        self._done.set()
+        self._publish_final('completed', self.to_dict())
+
+    def fail(self, error):
+        self.error = error
+        self.status = STATUS_FAILED
+        self.finished_at = time.time()
+        self._done.set()
+        self._publish_final('failed', self.to_dict())
+
+    def _publish_final(self, event_type, data):
+        # 结束事件只推送给本任务的订阅方，合并任务各自完成时推送自己的结果
+        for events in list(self._subscribers):
+            events.put((event_type, data))
+
+    def to_record(self):
+        """转换为任务存储的记录"""
+        return {
+            'task_id': self.task_id,
+            'status': self.status,
+            'params': self.params,
+            'seed': self.seed,
+            'backend': self.backend,
+            'prompt_id': self.prompt_id,
+            'error': self.error,
+            'image_paths': self.image_paths,
+            'checksums': self.checksums,
+            'cached': self.cached,
+            'coalesced_with': self.coalesced_with,
+            'created_at': self.created_at,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+            'estimated_execution_time': self.estimated_execution_time,
+            'estimated_finish': self.estimated_finish
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """由任务存储的记录重建任务（其他工作进程创建的任务的只读副本）"""
+        task = cls(record['task_id'], record['params'])
+        task.load_record(record)
+        return task
+
+    def load_record(self, record):
+        """用任务存储的记录更新状态"""
+        for field in ('status', 'seed', 'backend', 'prompt_id', 'error', 'cached', 'coalesced_with',
+                      'created_at', 'submitted_at', 'finished_at', 'estimated_execution_time', 'estimated_finish'):
+            setattr(self, field, record[field])
+        self.image_paths = record['image_paths'] or []
+        self.checksums = record['checksums'] or []
+        if self.status in (STATUS_COMPLETED, STATUS_FAILED):
+            self._done.set()
+
+    def to_dict(self):
+        """转换为API响应格式"""
+        status = self.status
+        if self.leader is not None and not self.done:
+            status = self.leader.status
+        data = {
+            'task_id': self.task_id,
+            'status': status,
+            'parameters': dict(self.params, seed=self.seed),
+            'created_at': self.created_at
+        }
+        if self.backend:
+            data['backend'] = self.backend
+        if self.coalesced_with:
+            data['coalesced_with'] = self.coalesced_with
+        source = self.leader if self.leader is not None and not self.done else self
+        if source.status == STATUS_SUBMITTED and source.queue_position is not None:
+            data['queue_position'] = source.queue_position
+        elif source.status == STATUS_RUNNING:
+            data['current_node'] = source.current_node
+            data['progress'] = source.progress
+        if not self.done and source.estimated_finish is not None:
+            data['eta'] = round(max(source.estimated_finish - time.time(), 0), 1)
+            data['estimated_execution_time'] = round(source.estimated_execution_time, 1)
+        if self.status == STATUS_COMPLETED:
+            data['image_url'] = f'/image/{self.task_id}'
+            data['image_urls'] = [f'/image/{image_id}' for image_id in self.image_ids]
+            if self.checksums:
+                data['sha256'] = self.checksums
+            data['generation_time'] = self.generation_time
+            data['cached'] = self.cached
+        elif self.status == STATUS_FAILED:
+            data['error'] = self.error
+        return data
+
+class TaskManager:
+    """任务管理器类
+
+    请求线程只负责创建任务，提交线程把任务送入ComfyUI队列，
+    完成通知来自ComfyUI的WebSocket事件；事件连接断开时由单个监视线程
+    统一轮询所有在途任务，因此在途任务数量不再受API服务器线程数限制。
+    任务状态写入任务存储（tasks.store），重启后由 recover() 接管未结束的任务。
+    提交顺序和后端由 AffinityScheduler 决定，以复用ComfyUI的节点缓存。
+    """
+
+    def __init__(self, comfyui_manager, config, result_cache=None):
+        self.comfyui_manager = comfyui_manager
+        self.result_cache = result_cache
+
+        task_config = config.get('tasks', {})
+        # 多进程部署时各工作进程共享同一个任务存储
+        self.task_store = TaskStore(
+            os.path.join(comfyui_manager.project_root, task_config.get('store', 'data/tasks.db'))
+        )
+        self.owner = str(os.getpid())
+        self.timeout = task_config.get('timeout', 300)
+        self.poll_interval = task_config.get('poll_interval', 1.0)
+        self.reconcile_interval = task_config.get('reconcile_interval', 30)
+        self.task_ttl = task_config.get('task_ttl', 3600)
+        self.store_ttl = task_config.get('store_ttl', 7 * 24 * 3600)
+        self.submit_workers = task_config.get('submit_workers', 2)
+        self.result_workers = task_config.get('result_workers', 4)
+
+        self.admission = AdmissionController(config.get('admission', {}), comfyui_manager.pool, self.timeout)
+        self._active_tasks = 0   # 已接收且尚未结束的任务数（不含缓存命中和合并的任务）
+        self._active_work = 0.0
+
+        self.tasks = {}
+        self._pending = AffinityScheduler(  # 等待提交的任务
+            config.get('affinity', {}), comfyui_manager.pool, self.timeout
+        )
+        self._queued = 0               # 等待提交的任务数
+        self._inflight = {}  # prompt_id -> Task
+        self._leaders = {}   # request_key -> 正在生成的Task，用于合并相同请求
+        self.coalesced = 0
+        self._remote = {}    # task_id -> (其他进程创建的Task副本, 读取时间)，用于推送订阅事件
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()
+        self._running = False
+        self._threads = []
+        self._result_executor = None
+        self._last_reconcile = 0
+        self._last_store_purge = 0
+        self._purge_store = True
+        self._started_at = None
+
+        self.comfyui_manager.add_finished_handler(self._on_prompt_finished)
+        self.comfyui_manager.pool.add_event_handler(self._on_comfyui_event)
+        INFLIGHT_TASKS.set_function(lambda: {
+            ('pending',): self._queued,
+            ('submitted',): len(self._inflight)
+        })
+
+    def start(self, housekeeping=True):
+        """启动分发和监视线程，housekeeping 为False时不清理任务存储（多进程部署时由一个工作进程负责）"""
+        if self._running:
+            return
+        self._running = True
+        self._purge_store = housekeeping
+        self._started_at = time.time()
+        self._result_executor = ThreadPoolExecutor(
+            max_workers=self.result_workers, thread_name_prefix='task-result'
+        )
+        for i in range(self.submit_workers):
+            thread = threading.Thread(target=self._dispatch_loop, name=f'task-dispatch-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        thread = threading.Thread(target=self._watch_loop, name='task-watch', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+        logger.info(f"任务管理器已启动，提交线程: {self.submit_workers}，结果线程: {self.result_workers}")
+
+    def stop(self):
+        """停止任务管理器"""
+        self._running = False
+        self._pending.close()
+        if self._result_executor:
+            self._result_executor.shutdown(wait=False)
+
+    def drain(self, timeout):
+        """等待已接收的任务全部结束（用于平滑退出），返回是否在超时前结束"""
+        deadline = time.time() + timeout
+        while True:
+            with self._lock:
+                busy = self._active_tasks > 0 or bool(self._inflight) or self._queued > 0
+            if not busy:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+
+    def recover(self, owner=None, created_before=None):
+        """接管任务存储中未结束的任务（API服务重启或工作进程意外退出后），返回接管的任务数
+
+        已提交的任务先到原后端的历史记录和队列中查找：已完成的直接获取结果，仍在队列中的继续跟踪，
+        后端已没有的重新提交；尚未提交的任务重新排队，合并的任务重新合并到同参数的任务。
+        owner 和 created_before 限定接管范围（见 TaskStore.list_unfinished），需要在 start() 之后调用。
+        """
+        try:
+            records = self.task_store.list_unfinished(owner, created_before)
+        except Exception as e:
+            logger.error(f"读取未结束任务失败: {e}")
+            return 0
+
+        # 先接管被合并的任务，合并任务再合并到它们
+        records.sort(key=lambda record: record['coalesced_with'] is not None)
+        for record in records:
+            try:
+                self._recover_task(Task.from_record(record))
+            except Exception as e:
+                logger.error(f"接管任务失败 - 任务ID: {record['task_id']}, 错误: {e}", exc_info=True)
+        if records:
+            logger.info(f"已接管 {len(records)} 个未结束的任务")
+        return len(records)
+
+    def _recover_task(self, task):
+        task.request_key = self._request_key(task.params)
+        with self._lock:
+            self.tasks[task.task_id] = task
+
+        if (task.prompt_id is None and task.request_key and self.result_cache is not None
+                and self._complete_from_cache(task)):
+            self._save(task)
+            return
+
+        with self._lock:
+            leader = self.tasks.get(task.coalesced_with) if task.coalesced_with else None
+            if leader is not None and not leader.done and leader.leader is None:
+                task.leader = leader
+                leader.followers.append(task)
+            else:
+                task.coalesced_with = None
+                task.work = task_work(task.params)
+                self._active_tasks += 1
+                self._active_work += task.work
+                if task.request_key and task.request_key not in self._leaders:
+                    self._leaders[task.request_key] = task
+        if task.leader is not None:
+            self._save(task)
+            logger.info(f"接管合并任务 - 任务ID: {task.task_id}, 合并到: {task.leader.task_id}")
+            return
+
+        if task.prompt_id is not None:
+            state, result = self.comfyui_manager.recover_prompt(
+                task.prompt_id, task.backend, task.work, task.params.get('model')
+            )
+            if state != 'lost':
+                with self._lock:
+                    self._inflight[task.prompt_id] = task
+                self._save(task)
+                logger.info(f"接管在途任务 - 任务ID: {task.task_id}, prompt_id: {task.prompt_id}, 状态: {state}")
+                if state == 'finished':
+                    self.comfyui_manager.mark_finished(task.prompt_id, result)
+                return
+            logger.warning(f"后端已没有该任务的prompt，重新提交 - 任务ID: {task.task_id}, prompt_id: {task.prompt_id}")
+
+        task.status = STATUS_QUEUED
+        task.prompt_id = None
+        task.backend = None
+        task.submitted_at = None
+        task.estimated_finish = None
+        self._save(task)
+        self._enqueue(task)
+        logger.info(f"任务重新加入队列 - 任务ID: {task.task_id}")
+
+    def submit(self, params):
+        """创建任务并加入等待队列
+
+        命中结果缓存时直接完成；与在途任务参数相同的确定性请求
+        合并到该任务，共享同一个ComfyUI prompt的结果。
+        其余任务超出准入限制时抛出 AdmissionRejected。
+        """
+        task = Task(str(uuid.uuid4()), params)
+        task.request_key = self._request_key(params)
+
+        if task.request_key and self.result_cache is not None and self._complete_from_cache(task):
+            with self._lock:
+                self.tasks[task.task_id] = task
+            self._save(task)
+            return task
+
+        with self._lock:
+            leader = self._leaders.get(task.request_key) if task.request_key else None
+            if leader is not None:
+                task.leader = leader
+                task.coalesced_with = leader.task_id
+                leader.followers.append(task)
+                self.coalesced += 1
+                COALESCED.inc()
+            else:
+                work = task_work(params)
+                estimate = self._estimate_work(work, params.get('model'))
+                try:
+                    self.admission.check(
+                        work, self._active_tasks, self._active_work, estimate['wait'] if estimate else None
+                    )
+                except AdmissionRejected as e:
+                    ADMISSION_REJECTED.inc(reason=e.reason)
+                    raise
+                task.work = work
+                if estimate:
+                    task.estimated_execution_time = estimate['execution_time']
+                    task.estimated_finish = task.created_at + estimate['eta']
+                self._active_tasks += 1
+                self._active_work += work
+                if task.request_key:
+                    self._leaders[task.request_key] = task
+            self.tasks[task.task_id] = task
+
+        # 先保存再入队，避免分发线程保存的新状态被覆盖
+        self._save(task)
+        if leader is not None:
+            logger.info(f"合并相同请求 - 任务ID: {task.task_id}, 合并到: {leader.task_id}")
+            return task
+
+        self._enqueue(task)
+        logger.info(f"任务已加入队列 - 任务ID: {task.task_id}")
+        return task
+
+    def _enqueue(self, task):
+        """加入等待提交的队列"""
+        with self._lock:
+            self._queued += 1
+        self._pending.put(task)
+
+    def estimate(self, params):
+        """估计请求的等待时间、执行时间和完成时间（秒），没有可用后端时返回None
+
+        命中结果缓存的请求立即完成；可合并到在途任务的请求与该任务同时完成。
+        """
+        work = task_work(params)
+        request_key = self._request_key(params)
+        if request_key and self.result_cache is not None and self.result_cache.contains(request_key):
+            return {'backend': None, 'wait': 0, 'execution_time': 0, 'eta': 0,
+                    'megapixel_steps': round(work, 2), 'cached': True}
+
+        with self._lock:
+            leader = self._leaders.get(request_key) if request_key else None
+            if leader is not None and leader.estimated_finish is not None:
+                eta = max(leader.estimated_finish - time.time(), 0)
+                return {'backend': leader.backend, 'wait': round(max(eta - leader.estimated_execution_time, 0), 1),
+                        'execution_time': round(leader.estimated_execution_time, 1), 'eta': round(eta, 1),
+                        'megapixel_steps': round(work, 2), 'coalesced_with': leader.task_id}
+            estimate = self._estimate_work(work, params.get('model'))
+
+        if estimate is None:
+            return None
+        return {
+            'backend': estimate['backend'],
+            'wait': round(estimate['wait'], 1),
+            'execution_time': round(estimate['execution_time'], 1),
+            'eta': round(estimate['eta'], 1),
+            'megapixel_steps': round(work, 2)
+        }
+
+    def _estimate_work(self, work, model=None):
+        """按后端排队情况和本服务尚未分发的任务估计计算量为work、使用model的新任务"""
+        estimate = self.comfyui_manager.estimate(work, model)
+        if estimate is None:
+            return None
+        # 尚未分发的任务会先于新任务提交，按可用后端的平均执行时间分摊
+        pending = self._queued
+        if pending:
+            # 后端可能在估计之后变为不可用，只取一次快照
+            backends = self.comfyui_manager.pool.available_backends()
+            if not backends:
+                return None
+            avg_execution_time = sum(b.avg_execution_time for b in backends) / len(backends)
+            estimate['wait'] += pending * avg_execution_time / len(backends)
+        estimate['eta'] = estimate['wait'] + estimate['execution_time']
+        return estimate
+
+    def _request_key(self, params):
+        """结果缓存键（见 make_request_key），按请求的模型计算指纹"""
+        return make_request_key(params, self.comfyui_manager.model_fingerprint(params.get('model')))
+
+    def _complete_from_cache(self, task):
+        """使用缓存结果完成任务，返回是否命中"""
+        cached_paths = self.result_cache.get(task.request_key)
+        if cached_paths is None:
+            CACHE_LOOKUPS.inc(result='miss')
+            return False
+        try:
+            image_paths = self._link_outputs(cached_paths, task.task_id)
+        except OSError as e:
+            logger.warning(f"读取结果缓存失败: {e}")
+            return False
+
+        task.cached = True
+        task.complete(image_paths)
+        CACHE_LOOKUPS.inc(result='hit')
+        GENERATION_SECONDS.observe(task.generation_time, status='cached')
+        logger.info(f"命中结果缓存 - 任务ID: {task.task_id}")
+        return True
+
+    def get_task(self, task_id):
+        """按任务ID获取任务，本进程没有时从任务存储读取（其他工作进程创建的或已从内存清理的任务）"""
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if task is not None:
+                return task
+            remote = self._remote.get(task_id)
+            if remote is not None:
+                return remote[0]
+
+        try:
+            record = self.task_store.get(task_id)
+        except Exception as e:
+            logger.error(f"读取任务存储失败: {e}")
+            return None
+        if record is None:
+            return None
+        task = Task.from_record(record)
+        if not task.done:
+            # 缓存未结束任务的副本，订阅方订阅到同一个对象上，由监视线程推送状态变化
+            with self._lock:
+                task = self._remote.setdefault(task_id, (task, time.time()))[0]
+        return task
+
+    def list_tasks(self, status=None, limit=20, offset=0):
+        """按创建时间倒序分页列出任务，返回 (任务列表, 总数)；本进程的任务使用内存中的最新状态"""
+        records, total = self.task_store.list_tasks(status, limit, offset)
+        with self._lock:
+            tasks = [self.tasks.get(record['task_id']) or Task.from_record(record) for record in records]
+        return tasks, total
+
+    def _save(self, task):
+        """把任务状态写入任务存储"""
+        try:
+            # 快照和写入在同一把锁内，避免不同线程的旧快照覆盖新状态
+            with self._store_lock:
+                self.task_store.save(dict(task.to_record(), owner=self.owner))
+        except Exception as e:
+            logger.error(f"保存任务状态失败 - 任务ID: {task.task_id}, 错误: {e}")
+
+    def get_stats(self):
+        """获取任务统计信息"""
+        with self._lock:
+            counts = {}
+            for task in self.tasks.values():
+                counts[task.status] = counts.get(task.status, 0) + 1
+            estimate = self._estimate_work(0)
+            return {
+                'pending': self._queued,
+                'inflight': len(self._inflight),
+                'coalesced': self.coalesced,
+                'active': self._active_tasks,
+                'active_megapixel_steps': round(self._active_work, 2),
+                'estimated_wait': round(estimate['wait'], 2) if estimate else None,
+                'affinity': self._pending.get_stats(),
+                'tasks': counts
+            }
+
+    def _dispatch_loop(self):
+        """从等待队列取出任务并提交到ComfyUI"""
+        while self._running:
+            item = self._pending.get()
+            if item is None:
+                break
+            task, preferred = item
+            with self._lock:
+                self._queued -= 1
+
+            params = task.params
+            submission = self.comfyui_manager.submit_generation(
+                prompt=params['prompt'],
+                width=params['width'],
+                height=params['height'],
+                steps=params['steps'],
+                guidance_scale=params['guidance_scale'],
+                seed=params['seed'],
+                task_id=task.task_id,
+                num_images=params.get('num_images', 1),
+                preferred=preferred,
+                model=params.get('model')
+            )
+            self._pending.submitted(preferred, submission.get('backend'), task)
+
+            if not submission['success']:
+                logger.error(f"任务提交失败 - 任务ID: {task.task_id}, 错误: {submission['error']}")
+                ERRORS.inc(stage='submit')
+                self._fail_task(task, submission['error'])
+                continue
+
+            prompt_id = submission['prompt_id']
+            submitted_at = time.time()
+            task.prompt_id = prompt_id
+            task.seed = submission['seed']
+            task.backend = submission['backend']
+            task.submitted_at = submitted_at
+            task.estimated_execution_time = submission['estimated_execution_time']
+            task.estimated_finish = (
+                submitted_at + submission['estimated_wait'] + submission['estimated_execution_time']
+            )
+            task.status = STATUS_SUBMITTED
+            with self._lock:
+                self._inflight[prompt_id] = task
+            self._save(task)
+            task.publish('status', {'status': STATUS_SUBMITTED, 'backend': task.backend})
+            self._publish_queue_positions(task.backend)
+
+            # prompt可能在登记前就已结束（例如命中ComfyUI缓存）
+            result = self.comfyui_manager.get_finished(prompt_id)
+            if result is not None:
+                self._on_prompt_finished(prompt_id, result)
+
+    def _watch_loop(self):
+        """统一轮询所有在途任务的完成情况"""
+        while self._running:
+            try:
+                self._check_inflight()
+                self._expire_held()
+                self._refresh_remote()
+                self._purge_expired()
+            except Exception as e:
+                logger.error(f"任务监视异常: {e}", exc_info=True)
+            time.sleep(self.poll_interval)
+
+    def _check_inflight(self):
+        # 先取快照再查询队列，保证快照中的任务在查询时已经进入ComfyUI队列
+        with self._lock:
+            inflight = dict(self._inflight)
+        if not inflight:
+            return
+
+        # 事件连接不可用或刚重新连接的后端轮询一次队列，到达对账周期时轮询所有后端
+        now = time.time()
+        force = now - self._last_reconcile >= self.reconcile_interval
+        if force:
+            self._last_reconcile = now
+        self.comfyui_manager.reconcile(list(inflight), force)
+
+        for prompt_id, task in inflight.items():
+            # 重启后接管的任务从本进程启动时开始计算超时
+            if now - max(task.submitted_at, self._started_at) > self.timeout and self._release(prompt_id):
+                logger.error(f"等待超时，prompt_id: {prompt_id}")
+                backend = self.comfyui_manager.get_prompt_backend(prompt_id)
+                if backend is not None:
+                    backend.breaker.record_failure('timeout')
+                self.comfyui_manager.release_prompt(prompt_id)
+                self._pending.notify()
+                TIMEOUTS.inc(kind='task')
+                self._fail_task(task, f'生成超时（{self.timeout}秒）')
+
+    def _expire_held(self):
+        """在本服务排队超过任务超时仍未提交的任务按超时失败，避免请求方放弃等待后任务仍然执行"""
+        for task in self._pending.expire(self.timeout):
+            with self._lock:
+                self._queued -= 1
+            logger.error(f"排队超时 - 任务ID: {task.task_id}")
+            TIMEOUTS.inc(kind='task')
+            self._fail_task(task, f'排队超时（{self.timeout}秒）')
+
+    def _refresh_remote(self):
+        """把其他工作进程创建的任务的状态变化推送给本进程的订阅方"""
+        if not self._remote:
+            return
+        now = time.time()
+        with self._lock:
+            remote = list(self._remote.items())
+
+        for task_id, (task, fetched_at) in remote:
+            if not task._subscribers:
+                # 没有订阅方的副本保留一段时间，供紧接着的订阅使用
+                if now - fetched_at > 60:
+                    with self._lock:
+                        self._remote.pop(task_id, None)
+                continue
+
+            record = self.task_store.get(task_id)
+            if record is None or record['status'] == task.status:
+                continue
+            task.load_record(record)
+            if task.done:
+                with self._lock:
+                    self._remote.pop(task_id, None)
+                task._publish_final(task.status, task.to_dict())
+            else:
+                task.publish('status', {'status': task.status, 'backend': task.backend})
+
+    def _release(self, prompt_id):
+        """移出在途列表，返回该prompt是否仍由本管理器跟踪"""
+        with self._lock:
+            return self._inflight.pop(prompt_id, None) is not None
+
+    def _on_comfyui_event(self, backend, event_type, data):
+        """把ComfyUI的执行事件转发给对应任务的订阅方"""
+        if event_type == 'status':
+            self._publish_queue_positions(backend.name)
+            return
+
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        with self._lock:
+            task = self._inflight.get(prompt_id)
+        if task is None:
+            return
+
+        if event_type == 'execution_start':
+            task.status = STATUS_RUNNING
+            task.queue_position = None
+            if task.estimated_execution_time is not None:
+                task.estimated_finish = time.time() + task.estimated_execution_time
+            self._save(task)
+            task.publish('status', {'status': STATUS_RUNNING, 'backend': backend.name})
+            self._publish_queue_positions(backend.name)
+        elif event_type == 'executing' and data.get('node') is not None:
+            node_id = data['node']
+            node = self.comfyui_manager.workflow_template.get(node_id, {})
+            task.current_node = {'id': node_id, 'class_type': node.get('class_type')}
+            task.publish('executing', task.current_node)
+        elif event_type == 'progress':
+            task.progress = {'value': data.get('value'), 'max': data.get('max')}
+            task.publish('progress', task.progress)
+
+    def _publish_queue_positions(self, backend_name):
+        """推送同一后端上等待执行的任务的排队位置"""
+        with self._lock:
+            tasks = sorted(
+                (task for task in self._inflight.values() if task.backend == backend_name),
+                key=lambda task: task.submitted_at
+            )
+        ahead = 0
+        for task in tasks:
+            if task.status == STATUS_SUBMITTED and task.queue_position != ahead:
+                task.queue_position = ahead
+                task.publish('queue', {'position': ahead})
+            ahead += 1
+
+    def _on_prompt_finished(self, prompt_id, result):
+        """prompt结束回调（来自WebSocket事件或队列轮询）"""
+        with self._lock:
+            task = self._inflight.pop(prompt_id, None)
+        if task is None:
+            return
+        # 后端空出排队名额
+        self._pending.notify()
+
+        if result['success']:
+            self._result_executor.submit(self._collect, task, result.get('outputs'))
+        else:
+            logger.error(f"图片生成失败 - 任务ID: {task.task_id}, 错误: {result['error']}")
+            ERRORS.inc(stage='execution')
+            self._fail_task(task, result['error'])
+
+    def _collect(self, task, outputs=None):
+        """获取已完成任务的生成结果"""
+        try:
+            result = self.comfyui_manager.collect_generation(task.prompt_id, task.task_id, outputs)
+            if result['success']:
+                if task.request_key and self.result_cache is not None:
+                    self.result_cache.put(task.request_key, result['image_paths'])
+                self._complete_task(task, result['image_paths'], result.get('checksums'))
+                logger.info(f"图片生成完成 - 任务ID: {task.task_id}, 耗时: {task.generation_time:.2f}秒")
+            else:
+                logger.error(f"图片生成失败 - 任务ID: {task.task_id}, 错误: {result['error']}")
+                ERRORS.inc(stage='transfer')
+                self._fail_task(task, result['error'])
+        except Exception as e:
+            logger.error(f"获取任务结果异常: {e}", exc_info=True)
+            ERRORS.inc(stage='transfer')
+            self._fail_task(task, str(e))
+
+    def _link_outputs(self, image_paths, task_id, checksums=None):
+        """把已有图片链接为指定任务的输出图片"""
+        images = self.comfyui_manager.images
+        output_paths = []
+        for index, image_path in enumerate(image_paths):
+            name = image_name(task_id, index)
+            staging_path = images.staging_path(name)
+            link_or_copy(image_path, staging_path)
+            checksum = checksums[index] if checksums else None
+            output_paths.append(images.commit(name, staging_path, checksum))
+        return output_paths
+
+    def _complete_task(self, task, image_paths, checksums=None):
+        task.complete(image_paths, checksums)
+        self._save(task)
+        GENERATION_SECONDS.observe(task.generation_time, status='completed')
+        for follower in self._take_followers(task):
+            try:
+                follower.seed = task.seed
+                follower.complete(self._link_outputs(image_paths, follower.task_id, checksums), checksums)
+            except OSError as e:
+                follower.fail(f'复制合并任务结果失败: {e}')
+            self._save(follower)
+
+    def _fail_task(self, task, error):
+        task.fail(error)
+        self._save(task)
+        GENERATION_SECONDS.observe(task.generation_time, status='failed')
+        for follower in self._take_followers(task):
+            follower.fail(error)
+            self._save(follower)
+
+    def _take_followers(self, task):
+        """任务结束后不再接受合并并归还准入预算，取出已合并的任务"""
+        with self._lock:
+            if task.work:
+                self._active_tasks -= 1
+                self._active_work -= task.work
+                task.work = 0
+            if task.request_key and self._leaders.get(task.request_key) is task:
+                del self._leaders[task.request_key]
+            followers, task.followers = task.followers, []
+        return followers
+
+    def _purge_expired(self):
+        """清理已结束且超过保留时间的任务：内存中保留 task_ttl 秒，任务存储中保留 store_ttl 秒"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                task_id for task_id, task in self.tasks.items()
+                if task.done and now - task.finished_at > self.task_ttl
+            ]
+            for task_id in expired:
+                del self.tasks[task_id]
+        if self._purge_store and now - self._last_store_purge >= 60:
+            self._last_store_purge = now
+            self.task_store.purge(now - self.store_ttl)
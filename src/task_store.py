@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+任务存储
+把任务状态写入SQLite，API服务重启后可以接管未结束的任务；
+多个工作进程共享同一个数据库文件，任一进程都能查询其他进程创建的任务
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 以JSON保存的字段
+JSON_FIELDS = ('params', 'image_paths', 'checksums')
+
+COLUMNS = (
+    'task_id', 'status', 'params', 'seed', 'backend', 'prompt_id', 'error',
+    'image_paths', 'checksums', 'cached', 'coalesced_with',
+    'created_at', 'submitted_at', 'finished_at',
+    'estimated_execution_time', 'estimated_finish', 'owner', 'updated_at'
+)
+
+# 未结束的任务状态
+UNFINISHED = ('queued', 'submitted', 'running')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    seed INTEGER,
+    backend TEXT,
+    prompt_id TEXT,
+    error TEXT,
+    image_paths TEXT,
+    checksums TEXT,
+    cached INTEGER DEFAULT 0,
+    coalesced_with TEXT,
+    created_at REAL NOT NULL,
+    submitted_at REAL,
+    finished_at REAL,
+    estimated_execution_time REAL,
+    estimated_finish REAL,
+    owner TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_finished_at ON tasks (finished_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks (created_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, created_at);
+"""
+
+class TaskStore:
+    """SQLite任务存储类
+
+    使用WAL日志模式，读操作不会被其他进程的写操作阻塞；每个线程使用独立连接。
+    记录为 Task.to_record() 返回的字典，owner 为保存记录的进程（PID）。
+    """
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        # 旧版本的数据库缺少 owner 列，先补上再创建索引
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(tasks)')}
+        if columns and 'owner' not in columns:
+            conn.execute('ALTER TABLE tasks ADD COLUMN owner TEXT')
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # WAL模式下NORMAL只在检查点时同步，进程崩溃不会丢失已提交的事务
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def save(self, record):
+        """插入或更新任务记录"""
+        values = dict(record, updated_at=time.time())
+        for field in JSON_FIELDS:
+            values[field] = json.dumps(values.get(field), ensure_ascii=False)
+        values['cached'] = int(bool(values.get('cached')))
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO tasks ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join(':' + column for column in COLUMNS)})",
+                {column: values.get(column) for column in COLUMNS}
+            )
+
+    def get(self, task_id):
+        """按任务ID获取记录，不存在时返回None"""
+        row = self._connect().execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return self._to_record(row) if row is not None else None
+
+    def list_tasks(self, status=None, limit=20, offset=0):
+        """按创建时间倒序分页列出任务，返回 (记录列表, 总数)
+
+        status 为状态列表，为空时不过滤。
+        """
+        where, args = '', []
+        if status:
+            where = f"WHERE status IN ({', '.join('?' * len(status))})"
+            args = list(status)
+        conn = self._connect()
+        total = conn.execute(f'SELECT COUNT(*) FROM tasks {where}', args).fetchone()[0]
+        rows = conn.execute(
+            f'SELECT * FROM tasks {where} ORDER BY created_at DESC, task_id LIMIT ? OFFSET ?',
+            args + [limit, offset]
+        ).fetchall()
+        return [self._to_record(row) for row in rows], total
+
+    def list_unfinished(self, owner=None, created_before=None):
+        """列出未结束的任务（按创建时间排序），可按所属进程和创建时间过滤"""
+        where = [f"status IN ({', '.join('?' * len(UNFINISHED))})"]
+        args = list(UNFINISHED)
+        if owner is not None:
+            where.append('owner = ?')
+            args.append(owner)
+        if created_before is not None:
+            where.append('created_at < ?')
+            args.append(created_before)
+        rows = self._connect().execute(
+            f"SELECT * FROM tasks WHERE {' AND '.join(where)} ORDER BY created_at", args
+        ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def purge(self, finished_before):
+        """删除在指定时间之前结束的任务，返回删除数量"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                'DELETE FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?', (finished_before,)
+            )
+        return cursor.rowcount
+
+    def _to_record(self, row):
+        record = dict(row)
+        for field in JSON_FIELDS:
+            record[field] = json.loads(record[field]) if record[field] else None
+        record['cached'] = bool(record['cached'])
+        return record
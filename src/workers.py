@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程部署
+主进程监听端口后创建多个工作进程，各工作进程在同一个监听socket上接受连接，
+任务状态通过共享的任务存储在进程间共享
+"""
+
+import os
+import time
+import errno
+import random
+import select
+import signal
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 工作进程初始化失败（例如ComfyUI不可用）时的退出码，主进程收到后停止，不再反复重启
+WORKER_BOOT_ERROR = 3
+
+# 工作进程开始平滑退出时通过管道通知主进程，主进程立即补充新的工作进程
+MESSAGE_DRAINING = b'd'
+
+class RequestCounter:
+    """统计请求数的WSGI中间件，达到上限时调用 on_limit 一次"""
+
+    def __init__(self, app, limit, on_limit):
+        self.app = app
+        self.limit = limit
+        self.on_limit = on_limit
+        self.count = 0
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+            self.active += 1
+            reached = self.limit and self.count == self.limit
+        if reached:
+            self.on_limit()
+        iterable = None
+        try:
+            # 响应体（例如SSE）迭代完成前请求仍在处理中
+            iterable = self.app(environ, start_response)
+            for chunk in iterable:
+                yield chunk
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            with self._lock:
+                self.active -= 1
+
+class WorkerSupervisor:
+    """工作进程管理类
+
+    api.workers.count                工作进程数，默认为CPU核心数
+    api.workers.server               工作进程运行的服务器：asgi（uvicorn，默认）或 flask（werkzeug开发服务器，仅用于调试）
+    api.workers.max_requests         工作进程处理的请求数达到上限后平滑重启，0为不限制
+    api.workers.max_requests_jitter  上限的随机增量，避免所有工作进程同时重启
+    api.workers.graceful_timeout     平滑退出时等待进行中的请求和已接收任务结束的最长时间（秒）
+
+    平滑退出的工作进程停止接受新连接，等待进行中的请求和本进程已接收的任务结束后退出，
+    主进程在它停止接受连接时就补充新的工作进程，接受连接的进程数保持不变。
+    SIGHUP 逐个平滑重启所有工作进程，SIGTERM / SIGINT 平滑停止服务。
+    任务状态保存在共享的任务存储（tasks.store）中：第一个工作进程接管上次运行未结束的任务，
+    意外退出的工作进程的任务由替代它的工作进程接管。
+
+    图片存储清理、任务存储清理和 /object_info 获取只由一个工作进程负责，其他工作进程读取它写入的
+    元数据共享文件；负责的进程退出时由替代它的工作进程接替。准入限制、相同请求合并、
+    缓存亲和调度、熔断器和运行指标仍是每个工作进程各自的状态：限制按进程计算（总量为 count 倍），
+    /status 和 /metrics 只反映处理该请求的工作进程，需要按进程汇总。
+    """
+
+    def __init__(self, config, project_root):
+        self.config = config
+        api_config = config['api']
+        worker_config = api_config.get('workers', {})
+        self.host = api_config['host']
+        self.port = api_config['port']
+        self.backlog = api_config.get('asgi', {}).get('backlog', 2048)
+        self.count = worker_config.get('count') or os.cpu_count() or 1
+        self.server = worker_config.get('server', 'asgi')
+        self.max_requests = worker_config.get('max_requests', 0)
+        self.max_requests_jitter = worker_config.get('max_requests_jitter', 0)
+        self.graceful_timeout = worker_config.get('graceful_timeout', 330)
+        self.task_store_path = os.path.join(project_root, config.get('tasks', {}).get('store', 'data/tasks.db'))
+
+        self.sock = None
+        self._workers = {}    # pid -> (工作进程编号, 通知管道读端)
+        self._draining = {}   # pid -> 开始平滑退出的时间
+        self._housekeeper = None  # 负责清理和元数据获取的工作进程pid
+        self._stopping = False
+        self._reload = False
+        self._next_id = 0
+        self._started_at = None
+
+    def run(self):
+        """启动工作进程并监督，直到收到停止信号"""
+        if not hasattr(os, 'fork'):
+            logger.error("多进程模式需要 fork，仅支持Linux/macOS，请使用 run_api.py 或 run_asgi.py")
+            return False
+
+        self.sock = socket.create_server((self.host, self.port), backlog=self.backlog)
+        self.sock.set_inheritable(True)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        # 第一个工作进程接管上次运行未结束的任务，不接管其他工作进程新创建的任务
+        self._started_at = time.time()
+        self._spawn(recovery={'created_before': self._started_at})
+        for _ in range(self.count - 1):
+            self._spawn()
+        self._print_banner()
+
+        try:
+            while not self._stopping:
+                if self._reload:
+                    self._reload = False
+                    self._recycle_all()
+                self._read_messages(timeout=0.5)
+                if not self._reap():
+                    break
+        finally:
+            self._shutdown()
+        return True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _spawn(self, recovery=None):
+        """创建一个工作进程，recovery 为它启动时接管的未结束任务范围（见 TaskManager.recover）"""
+        worker_id = self._next_id
+        self._next_id += 1
+        housekeeping = self._housekeeper is None
+        read_fd, write_fd = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for _, other_fd in self._workers.values():
+                os.close(other_fd)
+            code = 0
+            try:
+                code = Worker(self, worker_id, write_fd, recovery, housekeeping).run()
+            except BaseException:
+                logger.exception(f"工作进程 {worker_id} 异常退出")
+                code = 1
+            finally:
+                # 不执行主进程注册的清理逻辑
+                os._exit(code)
+
+        os.close(write_fd)
+        self._workers[pid] = (worker_id, read_fd)
+        if housekeeping:
+            self._housekeeper = pid
+            logger.info(f"工作进程 {worker_id} 已启动，PID: {pid}，负责清理和元数据获取")
+        else:
+            logger.info(f"工作进程 {worker_id} 已启动，PID: {pid}")
+        return pid
+
+    def _retire(self, pid):
+        """工作进程开始平滑退出，补充新的工作进程"""
+        if pid in self._draining or pid not in self._workers:
+            return
+        self._draining[pid] = time.time()
+        if pid == self._housekeeper:
+            self._housekeeper = None
+        if not self._stopping:
+            self._spawn()
+
+    def _recycle_all(self):
+        """逐个平滑重启所有工作进程"""
+        logger.info("收到SIGHUP，平滑重启所有工作进程")
+        for pid in [pid for pid in self._workers if pid not in self._draining]:
+            self._retire(pid)
+            self._signal(pid, signal.SIGTERM)
+
+    def _read_messages(self, timeout):
+        """读取工作进程的通知"""
+        fds = {read_fd: pid for pid, (_, read_fd) in self._workers.items()}
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except (InterruptedError, OSError):
+            return
+        for fd in readable:
+            try:
+                message = os.read(fd, 64)
+            except OSError:
+                continue
+            if MESSAGE_DRAINING in message:
+                self._retire(fds[fd])
+
+    def _reap(self):
+        """回收已退出的工作进程，意外退出的进程重新创建；返回是否继续运行"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return True
+            if pid == 0:
+                return True
+
+            worker_id, read_fd = self._workers.pop(pid, (None, None))
+            if read_fd is not None:
+                os.close(read_fd)
+            if pid == self._housekeeper:
+                self._housekeeper = None
+            code = os.waitstatus_to_exitcode(status)
+            if self._draining.pop(pid, None) is not None:
+                logger.info(f"工作进程 {worker_id} 已平滑退出，PID: {pid}")
+                continue
+            if code == WORKER_BOOT_ERROR:
+                logger.error(f"工作进程 {worker_id} 初始化失败，停止服务")
+                return False
+            if not self._stopping:
+                logger.error(f"工作进程 {worker_id} 意外退出（退出码 {code}），重新创建")
+                time.sleep(1)
+                self._spawn(recovery={'owner': str(pid)})
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _shutdown(self):
+        """通知所有工作进程平滑退出，超时后强制结束"""
+        self._stopping = True
+        logger.info("正在停止所有工作进程...")
+        for pid in self._workers:
+            self._draining.setdefault(pid, time.time())
+            self._signal(pid, signal.SIGTERM)
+
+        deadline = time.time() + self.graceful_timeout + 5
+        while self._workers and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self._workers):
+            logger.warning(f"工作进程未在超时前退出，强制结束，PID: {pid}")
+            self._signal(pid, signal.SIGKILL)
+        while self._workers:
+            self._reap()
+            time.sleep(0.1)
+        self.sock.close()
+        logger.info("API服务器已停止")
+
+    def _print_banner(self):
+        from .api_server import print_endpoints
+
+        task_config = self.config.get('tasks', {})
+        submit_workers = task_config.get('submit_workers', 2)
+        result_workers = task_config.get('result_workers', 4)
+        if self.server == 'asgi':
+            per_process = '事件循环（等待中的连接不占用线程）'
+        else:
+            per_process = '每个连接一个线程'
+
+        print("=== FLUX.1 DEV API 服务器（多进程） ===")
+        print()
+        print(f"工作进程: {self.count} × {self.server}（{per_process}），CPU核心: {os.cpu_count()}")
+        print(f"任务线程: 每个进程提交 {submit_workers} / 结果 {result_workers}，"
+              f"合计提交 {self.count * submit_workers} / 结果 {self.count * result_workers}")
+        if self.max_requests:
+            limit = f"{self.max_requests}"
+            if self.max_requests_jitter:
+                limit += f"~{self.max_requests + self.max_requests_jitter}"
+            print(f"回收: 每个工作进程处理 {limit} 个请求后平滑重启")
+        print(f"任务存储: {self.task_store_path}")
+        print()
+        print_endpoints(self.host, self.port)
+
+class Worker:
+    """工作进程：在继承的监听socket上运行Flask或ASGI服务器"""
+
+    def __init__(self, supervisor, worker_id, notify_fd, recovery=None, housekeeping=False):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.notify_fd = notify_fd
+        self.recovery = recovery
+        self.housekeeping = housekeeping
+        self.max_requests = supervisor.max_requests
+        if self.max_requests and supervisor.max_requests_jitter:
+            self.max_requests += random.randint(0, supervisor.max_requests_jitter)
+        self._notified = False
+
+    def run(self):
+        """运行工作进程，返回退出码"""
+        # 终端的Ctrl+C由主进程处理，工作进程只响应主进程的SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        formatter = logging.Formatter(f'%(asctime)s - %(levelname)s - [worker-{self.worker_id}] %(message)s')
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(formatter)
+
+        from . import api_server
+
+        api_server.load_config()
+        api_server.task_recovery = self.recovery
+        api_server.housekeeping = self.housekeeping
+
+        if self.supervisor.server == 'asgi':
+            return self._run_asgi()
+        return self._run_flask(api_server)
+
+    def notify_draining(self):
+        """通知主进程本进程不再接受新连接"""
+        if self._notified:
+            return
+        self._notified = True
+        try:
+            os.write(self.notify_fd, MESSAGE_DRAINING)
+        except OSError:
+            pass
+
+    def _run_flask(self, api_server):
+        from werkzeug.serving import make_server
+
+        if not api_server.init_services():
+            return WORKER_BOOT_ERROR
+
+        server = None
+        stop = threading.Event()
+
+        def begin_drain(*args):
+            # serve_forever所在线程不能调用shutdown，交给其他线程
+            if not stop.is_set():
+                stop.set()
+                self.notify_draining()
+                threading.Thread(target=server.shutdown, daemon=True).start()
+
+        counter = RequestCounter(api_server.app.wsgi_app, self.max_requests, begin_drain)
+        api_server.app.wsgi_app = counter
+        server = make_server(
+            self.supervisor.host, self.supervisor.port, api_server.app,
+            threaded=True, fd=self.supervisor.sock.fileno()
+        )
+        signal.signal(signal.SIGTERM, begin_drain)
+
+        server.serve_forever()
+        server.socket.close()
+
+        # 等待进行中的请求和本进程已接收的任务结束
+        deadline = time.time() + self.supervisor.graceful_timeout
+        if not api_server.task_manager.drain(self.supervisor.graceful_timeout):
+            logger.warning("等待任务结束超时，仍有未完成的任务")
+        while counter.active and time.time() < deadline:
+            time.sleep(0.1)
+        api_server.task_manager.stop()
+        api_server.derivatives.stop()
+        api_server.comfyui_manager.stop()
+        return 0
+
+    def _run_asgi(self):
+        import uvicorn
+        from . import asgi_server
+
+        worker = self
+        asgi_server.drain_timeout = self.supervisor.graceful_timeout
+
+        class WorkerServer(uvicorn.Server):
+            async def shutdown(self, sockets=None):
+                # 达到请求上限或收到SIGTERM时都会进入这里
+                worker.notify_draining()
+                await super().shutdown(sockets)
+
+        config = uvicorn.Config(
+            asgi_server.app,
+            limit_max_requests=self.max_requests or None,
+            timeout_graceful_shutdown=self.supervisor.graceful_timeout,
+            timeout_keep_alive=self.supervisor.config['api'].get('asgi', {}).get('timeout_keep_alive', 5),
+            log_level='info'
+        )
+        server = WorkerServer(config)
+        server.run(sockets=[self.supervisor.sock])
+        if not server.started:
+            return WORKER_BOOT_ERROR
+        return 0
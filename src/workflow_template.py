@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+工作流模板
+加载时把工作流编译为参数绑定计划，每个请求只填充绑定的输入，无需深拷贝和重新序列化整个工作流
+"""
+
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 请求参数可绑定的节点输入
+TEXT_INPUTS = ('clip_l', 't5xxl', 'text')
+
+class WorkflowTemplateError(ValueError):
+    """工作流模板中找不到或无法唯一确定参数对应的节点"""
+
+class WorkflowTemplate:
+    """编译后的工作流模板
+
+    参数按节点的 class_type（同类节点有多个时再按 _meta.title）和节点间的连线定位，
+    而不是写死的节点ID，模板重新编号后仍然有效：
+    采样器为唯一的 KSampler 节点，正/负面提示词节点和潜空间图像节点分别是
+    采样器 positive / negative / latent_image 输入连接的节点，输出节点为 SaveImage，
+    模型为唯一的 UNETLoader 节点（没有或有多个时不能按请求选择模型）。
+
+    编译时把绑定的输入替换为占位符并序列化一次，切分为静态JSON片段；
+    render() 只序列化各绑定参数的值并与静态片段拼接。
+    """
+
+    def __init__(self, workflow, sampler_title=None, save_title=None):
+        self.workflow = workflow
+        self.node_count = len(workflow)
+
+        sampler_id = self._find_node('KSampler', sampler_title)
+        sampler_inputs = workflow[sampler_id]['inputs']
+        positive_id = self._linked_node(sampler_id, 'positive')
+        negative_id = self._linked_node(sampler_id, 'negative')
+        latent_id = self._linked_node(sampler_id, 'latent_image')
+        save_id = self._find_node('SaveImage', save_title)
+        unet_ids = [node_id for node_id, node in workflow.items() if node.get('class_type') == 'UNETLoader']
+
+        if workflow[latent_id]['class_type'] != 'EmptyLatentImage':
+            raise WorkflowTemplateError(f"采样器的latent_image应连接EmptyLatentImage节点，实际为 {workflow[latent_id]['class_type']}")
+
+        # 参数名 -> [(节点ID, 输入名)]
+        self.bindings = {
+            'prompt': self._text_slots(positive_id),
+            'guidance_scale': [
+                (node_id, 'guidance') for node_id in (positive_id, negative_id)
+                if 'guidance' in workflow[node_id]['inputs']
+            ],
+            'seed': [(sampler_id, 'seed')],
+            'steps': [(sampler_id, 'steps')],
+            'width': [(latent_id, 'width')],
+            'height': [(latent_id, 'height')],
+            'batch_size': [(latent_id, 'batch_size')],
+            'filename_prefix': [(save_id, 'filename_prefix')],
+            'model': [(unet_ids[0], 'unet_name')] if len(unet_ids) == 1 else []
+        }
+        self.defaults = {
+            name: workflow[slots[0][0]]['inputs'][slots[0][1]]
+            for name, slots in self.bindings.items() if slots
+        }
+
+        # 每个请求都相同的输入：负面提示词为空，FLUX使用CFG=1
+        static_inputs = {(node_id, name): '' for node_id, name in self._text_slots(negative_id)}
+        if 'cfg' in sampler_inputs:
+            static_inputs[(sampler_id, 'cfg')] = 1.0
+
+        self._segments, self._slot_names = self._compile(static_inputs)
+        logger.info(
+            f"工作流模板编译完成，节点数: {self.node_count}，"
+            f"采样器: {sampler_id}，提示词: {positive_id}/{negative_id}，潜空间: {latent_id}，输出: {save_id}"
+        )
+
+    def render(self, **values):
+        """填充绑定参数，返回工作流的JSON字符串；未提供的参数使用模板中的值"""
+        unknown = set(values) - set(self.bindings)
+        if unknown:
+            raise WorkflowTemplateError(f"未知的工作流参数: {sorted(unknown)}")
+
+        encoded = {}
+        parts = [self._segments[0]]
+        for name, segment in zip(self._slot_names, self._segments[1:]):
+            if name not in encoded:
+                encoded[name] = json.dumps(values.get(name, self.defaults[name]), ensure_ascii=False)
+            parts.append(encoded[name])
+            parts.append(segment)
+        return ''.join(parts)
+
+    def _compile(self, static_inputs):
+        """把绑定输入替换为占位符后序列化，按占位符切分为静态片段"""
+        graph = {
+            node_id: dict(node, inputs=dict(node['inputs']))
+            for node_id, node in self.workflow.items()
+        }
+        for (node_id, name), value in static_inputs.items():
+            graph[node_id]['inputs'][name] = value
+
+        placeholders = {}
+        for param, slots in self.bindings.items():
+            for node_id, name in slots:
+                placeholder = f"\x00{param}\x00"
+                graph[node_id]['inputs'][name] = placeholder
+                placeholders[json.dumps(placeholder)] = param
+
+        serialized = json.dumps(graph, ensure_ascii=False)
+        pattern = '(' + '|'.join(re.escape(token) for token in placeholders) + ')'
+        parts = re.split(pattern, serialized)
+        return parts[0::2], [placeholders[token] for token in parts[1::2]]
+
+    def _find_node(self, class_type, title=None):
+        """按class_type查找唯一节点，有多个时按_meta.title区分"""
+        candidates = [
+            node_id for node_id, node in self.workflow.items()
+            if node.get('class_type') == class_type
+        ]
+        if len(candidates) > 1 and title:
+            candidates = [
+                node_id for node_id in candidates
+                if self.workflow[node_id].get('_meta', {}).get('title') == title
+            ]
+        if len(candidates) != 1:
+            raise WorkflowTemplateError(
+                f"工作流中应有且只有一个{class_type}节点" + (f"（标题: {title}）" if title else '') +
+                f"，实际找到: {candidates}"
+            )
+        return candidates[0]
+
+    def _linked_node(self, node_id, input_name):
+        """获取节点输入连接的上游节点ID"""
+        link = self.workflow[node_id]['inputs'].get(input_name)
+        if not isinstance(link, list) or link[0] not in self.workflow:
+            raise WorkflowTemplateError(f"节点 {node_id} 的输入 {input_name} 没有连接到有效节点")
+        return link[0]
+
+    def _text_slots(self, node_id):
+        inputs = self.workflow[node_id]['inputs']
+        slots = [(node_id, name) for name in TEXT_INPUTS if name in inputs]
+        if not slots:
+            raise WorkflowTemplateError(f"提示词节点 {node_id} 没有文本输入")
+        return slots
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试共用的假对象和fixture
+不需要运行中的ComfyUI，写入的文件都放在pytest的临时目录中
+"""
+
+import os
+import sys
+import json
+import time
+
+import pytest
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from src.comfyui_manager import ComfyUIManager
+
+def load_config():
+    with open(os.path.join(project_root, 'config', 'config.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, text=''):
+        self.status_code = status_code
+        self.data = data
+        self.text = text
+
+    def json(self):
+        return self.data
+
+class FakeHttp:
+    """代替后端的HTTP客户端，按顺序返回预设的 POST 响应"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def post(self, *args, **kwargs):
+        return self.responses.pop(0)
+
+class FakeBackend:
+    """只有名称、排队数、预计等待时间和平均执行时间的后端"""
+
+    def __init__(self, name, wait=0, avg_execution_time=10.0):
+        self.name = name
+        self.dispatched = 0
+        self.wait = wait
+        self.avg_execution_time = avg_execution_time
+
+    def estimated_wait(self):
+        return self.wait
+
+class FakePool:
+    """backends 为可用的后端，都不可用时 retry_after 秒后重试"""
+
+    def __init__(self, backends, retry_after=0):
+        self.backends = backends
+        self._retry_after = retry_after
+
+    def available_backends(self):
+        return self.backends
+
+    def retry_after(self):
+        return self._retry_after
+
+class FakeTask:
+    """等待提交的任务，age 为已经排队的秒数"""
+
+    def __init__(self, task_id, model=None, age=0, **params):
+        self.task_id = task_id
+        self.params = dict({'prompt': task_id, 'guidance_scale': 3.5, 'model': model}, **params)
+        self.created_at = time.time() - age
+
+@pytest.fixture
+def make_manager(tmp_path):
+    """创建ComfyUIManager的函数，comfyui 覆盖 comfyui 配置；图片存储和元数据共享文件都在临时目录"""
+    def make(comfyui=None):
+        config = load_config()
+        config['comfyui'].update(comfyui or {})
+        config['storage'] = dict(
+            config.get('storage', {}), dir=str(tmp_path / 'output'), index=str(tmp_path / 'data' / 'images.db')
+        )
+        config['metadata'] = dict(
+            config.get('metadata', {}), shared_file=str(tmp_path / 'data' / 'object_info.json')
+        )
+        return ComfyUIManager(config)
+    return make
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制测试
+使用假的后端池，不需要运行中的ComfyUI
+"""
+
+import pytest
+
+from src.admission import AdmissionController, AdmissionRejected
+from tests.conftest import FakeBackend, FakePool
+
+def make_controller(backends=None, **admission):
+    pool = FakePool([FakeBackend('local')] if backends is None else backends, retry_after=12.3)
+    return AdmissionController(dict({'enabled': True}, **admission), pool, default_max_wait=300)
+
+def rejection(controller, work=1.0, active_tasks=0, active_work=0.0, wait=0.0):
+    with pytest.raises(AdmissionRejected) as info:
+        controller.check(work, active_tasks, active_work, wait)
+    return info.value
+
+def test_accepts_within_limits():
+    controller = make_controller(max_inflight_tasks=2, max_megapixel_steps=10)
+    controller.check(1.0, 1, 5.0, 100)
+    assert controller.get_stats()['max_estimated_wait'] == 300
+
+def test_no_backend_is_503_even_when_disabled():
+    error = rejection(make_controller(backends=[], enabled=False))
+    assert error.reason == 'unavailable'
+    assert error.status_code == 503
+    assert error.retry_after == 13
+
+def test_inflight_limit_is_429():
+    backends = [FakeBackend('a', avg_execution_time=10), FakeBackend('b', avg_execution_time=30)]
+    error = rejection(make_controller(backends, max_inflight_tasks=4), active_tasks=5)
+    assert error.reason == 'inflight'
+    assert error.status_code == 429
+    # 超出2个任务，两个后端平均每个20秒
+    assert error.retry_after == 20
+
+def test_wait_limit():
+    error = rejection(make_controller(max_estimated_wait=60), wait=90.2)
+    assert error.reason == 'wait'
+    assert error.status_code == 429
+    assert error.retry_after == 31
+
+def test_budget_limit_admits_oversized_task_when_idle():
+    controller = make_controller(max_megapixel_steps=10)
+    controller.check(50.0, 0, 0.0, 0)
+    error = rejection(controller, work=4.0, active_tasks=1, active_work=8.0, wait=40)
+    assert error.reason == 'budget'
+    assert error.retry_after == 10
+
+def test_retry_after_is_at_least_one_second():
+    error = rejection(make_controller(max_estimated_wait=60), wait=60.1)
+    assert error.retry_after == 1
+
+def test_disabled_skips_load_limits():
+    controller = make_controller(enabled=False, max_inflight_tasks=1, max_estimated_wait=1)
+    controller.check(1.0, 10, 100.0, 1000)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+缓存亲和调度测试
+使用假的后端池，不需要运行中的ComfyUI
+"""
+
+from src.affinity_scheduler import AffinityScheduler
+from tests.conftest import FakeBackend, FakePool, FakeTask
+
+def make_scheduler():
+    """唯一的后端已加载fp8模型，且不允许换模型"""
+    scheduler = AffinityScheduler(
+        {'enabled': True, 'window': 2, 'max_queued_per_backend': 1, 'max_model_swaps': 0},
+        FakePool([FakeBackend('local')]), task_timeout=300
+    )
+    scheduler.put(FakeTask('warmup', 'fp8'))
+    take(scheduler)
+    return scheduler
+
+def take(scheduler):
+    task, backend = scheduler.get(timeout=0.05)
+    scheduler.submitted(backend, backend.name, task)
+    return task.task_id
+
+def test_compatible_job_behind_window_is_dispatched():
+    scheduler = make_scheduler()
+    for i in range(3):
+        scheduler.put(FakeTask(f'full-{i}', 'full'))
+    scheduler.put(FakeTask('fp8-late', 'fp8'))
+    assert take(scheduler) == 'fp8-late'
+    stats = scheduler.get_stats()
+    assert stats['reordered'] == 1
+    assert stats['loader_hits'] == 1
+    assert stats['held'] == 3
+
+def test_held_job_is_forced_then_expired():
+    scheduler = make_scheduler()
+    scheduler.put(FakeTask('full-0', 'full', age=scheduler.max_hold))
+    late = FakeTask('full-1', 'full')
+    scheduler.put(late)
+    assert take(scheduler) == 'full-0'
+    stats = scheduler.get_stats()
+    assert stats['forced'] == 1
+    assert stats['model_swaps'] == 1
+    assert stats['loaded_models'] == {'local': 'full'}
+
+    late.created_at -= 400
+    expired = scheduler.expire(300)
+    assert [task.task_id for task in expired] == ['full-1']
+    assert scheduler.get_stats()['held'] == 0
+
+def test_disabled_keeps_arrival_order():
+    scheduler = AffinityScheduler({'enabled': False}, FakePool([FakeBackend('local')]))
+    for task_id, model in (('a', 'full'), ('b', 'fp8'), ('c', 'fp8')):
+        scheduler.put(FakeTask(task_id, model))
+    order = []
+    for _ in range(3):
+        task, backend = scheduler.get(timeout=0.05)
+        assert backend is None
+        scheduler.submitted(backend, 'local', task)
+        order.append(task.task_id)
+    assert order == ['a', 'b', 'c']
+    assert scheduler.get_stats()['loader_hits'] == 1
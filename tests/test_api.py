@@ -145,6 +145,55 @@ def test_hq_generation():
         print(f"✗ 高质量图片生成异常: {e}")
         return False
 
+def test_async_generate():
+    """测试异步生成和任务状态接口"""
+    print("\n=== 测试异步生成接口 ===")
+    
+    test_data = {
+        "prompt": "a red fox in the snow, photorealistic",
+        "width": 1024,
+        "height": 1024,
+        "steps": 20,
+        "async": True
+    }
+    
+    try:
+        response = requests.post(f"{API_BASE_URL}/generate", json=test_data, timeout=10)
+        if response.status_code != 202:
+            print(f"✗ 异步提交失败: {response.status_code}")
+            print(f"  错误信息: {response.text}")
+            return False
+        
+        data = response.json()
+        task_id = data.get('task_id')
+        print("✓ 异步提交成功")
+        print(f"  任务ID: {task_id}")
+        print(f"  状态URL: {API_BASE_URL}{data.get('status_url')}")
+        
+        # 轮询任务状态
+        start_time = time.time()
+        while time.time() - start_time < 300:
+            status_response = requests.get(f"{API_BASE_URL}/tasks/{task_id}", timeout=10)
+            if status_response.status_code != 200:
+                print(f"✗ 任务状态获取失败: {status_response.status_code}")
+                return False
+            
+            task = status_response.json()
+            if task.get('status') == 'completed':
+                print(f"✓ 异步任务完成，耗时: {task.get('generation_time', 0):.2f}秒")
+                return True
+            if task.get('status') == 'failed':
+                print(f"✗ 异步任务失败: {task.get('error')}")
+                return False
+            time.sleep(2)
+        
+        print("✗ 异步任务超时")
+        return False
+        
+    except Exception as e:
+        print(f"✗ 异步生成错误: {e}")
+        return False
+
 def test_get_image(image_url):
     """测试获取图片接口"""
     print("\n=== 测试图片获取接口 ===")
@@ -205,6 +254,90 @@ def test_queue():
         print(f"✗ 队列状态获取错误: {e}")
         return False
 
+def test_metrics():
+    """测试运行指标接口"""
+    print("\n=== 测试运行指标接口 ===")
+    try:
+        response = requests.get(f"{API_BASE_URL}/metrics", timeout=10)
+        if response.status_code == 200:
+            stages = sorted({
+                line.split('stage="')[1].split('"')[0]
+                for line in response.text.splitlines()
+                if line.startswith('flux_api_stage_seconds_count')
+            })
+            print("✓ 运行指标获取成功")
+            print(f"  已记录阶段: {stages}")
+            return True
+        else:
+            print(f"✗ 运行指标获取失败: {response.status_code}")
+            return False
+    except Exception as e:
+        print(f"✗ 运行指标获取错误: {e}")
+        return False
+
+def test_estimate():
+    """测试预估等待时间接口"""
+    print("\n=== 测试预估等待时间接口 ===")
+    data = {
+        "prompt": "a cute cat sitting on a table",
+        "width": 1024,
+        "height": 1024,
+        "steps": 20
+    }
+    try:
+        response = requests.post(f"{API_BASE_URL}/estimate", json=data, timeout=10)
+        if response.status_code == 200:
+            result = response.json()
+            print("✓ 预估成功")
+            print(f"  后端: {result['backend']}")
+            print(f"  等待: {result['wait']}秒, 执行: {result['execution_time']}秒, 完成: {result['eta']}秒")
+            return True
+        else:
+            print(f"✗ 预估失败: {response.status_code}")
+            print(f"  错误: {response.text}")
+            return False
+    except Exception as e:
+        print(f"✗ 预估错误: {e}")
+        return False
+
+def test_list_tasks():
+    """测试任务列表接口"""
+    print("\n=== 测试任务列表接口 ===")
+    try:
+        response = requests.get(f"{API_BASE_URL}/tasks", params={"status": "completed", "limit": 5}, timeout=10)
+        if response.status_code == 200:
+            result = response.json()
+            print("✓ 任务列表获取成功")
+            print(f"  已完成任务: {result['total']} 个，本页: {len(result['tasks'])} 个")
+            return all(task['status'] == 'completed' for task in result['tasks'])
+        else:
+            print(f"✗ 任务列表获取失败: {response.status_code}")
+            print(f"  错误: {response.text}")
+            return False
+    except Exception as e:
+        print(f"✗ 任务列表获取错误: {e}")
+        return False
+
+def test_model_selection():
+    """测试model参数校验"""
+    print("\n=== 测试model参数校验 ===")
+    data = {
+        "prompt": "a cute cat sitting on a table",
+        "model": "not-a-model.safetensors"
+    }
+    try:
+        response = requests.post(f"{API_BASE_URL}/estimate", json=data, timeout=10)
+        if response.status_code == 400:
+            print("✓ 未知模型被拒绝")
+            print(f"  错误: {response.json().get('details')}")
+            return True
+        else:
+            print(f"✗ 未知模型未被拒绝: {response.status_code}")
+            return False
+    except Exception as e:
+        print(f"✗ model参数校验错误: {e}")
+        return False
+
 def main():
     """主函数"""
     print("=== FLUX.1 DEV API 测试程序 ===")
@@ -216,8 +349,13 @@ def main():
         ("状态接口", test_status),
         ("模型列表接口", test_models),
         ("队列状态接口", test_queue),
+        ("预估等待时间接口", test_estimate),
         ("标准图片生成", test_generate_image),
-        ("高质量图片生成", test_hq_generation)
+        ("异步图片生成", test_async_generate),
+        ("高质量图片生成", test_hq_generation),
+        ("任务列表接口", test_list_tasks),
+        ("模型参数校验", test_model_selection),
+        ("运行指标接口", test_metrics)
     ]
     
     results = []
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+熔断器测试
+不需要运行中的ComfyUI，通过假的HTTP客户端提交prompt，再记录prompt的结束
+"""
+
+import pytest
+
+from src.circuit_breaker import STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN
+from tests.conftest import FakeHttp, FakeResponse
+
+@pytest.fixture
+def manager(make_manager):
+    return make_manager({'circuit_breaker': {
+        'enabled': True, 'failure_threshold': 1, 'reset_timeout': 0, 'half_open_max_calls': 1
+    }})
+
+def submit(manager, *responses):
+    backend = manager.backends[0]
+    backend.http = FakeHttp(*responses)
+    return manager.submit_generation('test', steps=1, seed=1)
+
+def accepted(prompt_id):
+    return FakeResponse(200, {'prompt_id': prompt_id})
+
+def start_trial(manager, prompt_id):
+    """让后端熔断后进入试探状态，并用唯一的试探名额提交prompt"""
+    backend = manager.backends[0]
+    backend.breaker.record_failure('submit')
+    assert backend.breaker.allow()
+    assert backend.breaker.state == STATE_HALF_OPEN
+    result = submit(manager, accepted(prompt_id))
+    assert result['success']
+    assert manager.get_prompt_backend(prompt_id) is backend
+    assert not backend.breaker.allow()
+    return backend
+
+def test_half_open_execution_error_releases_trial(manager):
+    backend = start_trial(manager, 'p1')
+    manager.mark_finished('p1', {'success': False, 'error': 'execution_error'})
+    assert backend.breaker.state == STATE_HALF_OPEN
+    assert backend.breaker.allow()
+
+def test_execution_errors_do_not_open(manager):
+    backend = manager.backends[0]
+    for i in range(3):
+        assert submit(manager, accepted(f'e{i}'))['success']
+        manager.mark_finished(f'e{i}', {'success': False, 'error': '生成被中断'})
+    assert backend.breaker.state == STATE_CLOSED
+    assert backend.breaker.get_stats()['failures'] == 0
+
+def test_half_open_timeout_reopens(manager):
+    backend = start_trial(manager, 'p4')
+    backend.breaker.record_failure('timeout')
+    backend.breaker.reset_timeout = 30
+    assert backend.breaker.state == STATE_OPEN
+    assert not backend.breaker.allow()
+
+def test_half_open_success_closes(manager):
+    backend = start_trial(manager, 'p2')
+    manager.mark_finished('p2', {'success': True})
+    assert backend.breaker.state == STATE_CLOSED
+    assert backend.breaker.allow()
+
+def test_half_open_rejected_workflow_releases_trial(manager):
+    backend = manager.backends[0]
+    backend.breaker.record_failure('submit')
+    assert backend.breaker.allow()
+    result = submit(manager, FakeResponse(400, text='invalid prompt'))
+    assert not result['success']
+    assert backend.breaker.state == STATE_HALF_OPEN
+    assert backend.breaker.allow()
+
+def test_server_error_reopens(manager):
+    backend = manager.backends[0]
+    backend.breaker.record_failure('submit')
+    assert backend.breaker.allow()
+    backend.breaker.reset_timeout = 30
+    result = submit(manager, FakeResponse(500, text='internal error'))
+    assert not result['success']
+    assert backend.breaker.state == STATE_OPEN
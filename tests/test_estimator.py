@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+执行时间估计测试
+不需要运行中的ComfyUI
+"""
+
+import pytest
+
+from src.estimator import ExecutionTimeEstimator, REFERENCE_WORK, task_work
+
+def make_estimator(**estimator):
+    return ExecutionTimeEstimator({'comfyui': {'default_execution_time': 20.0}, 'estimator': estimator})
+
+def test_task_work():
+    assert task_work({'width': 1024, 'height': 1024, 'steps': 20}) == pytest.approx(REFERENCE_WORK)
+    assert task_work({'width': 512, 'height': 512, 'steps': 10, 'num_images': 4}) == pytest.approx(REFERENCE_WORK / 2)
+
+def test_prior_before_samples():
+    estimator = make_estimator(prior_overhead=2.0)
+    assert estimator.predict('local', 'f1', REFERENCE_WORK) == pytest.approx(20.0)
+    assert estimator.predict('local', 'f1', 0) == pytest.approx(2.0)
+    assert estimator.predict('local', 'f1', REFERENCE_WORK / 2) == pytest.approx(11.0)
+
+def test_learns_overhead_and_rate():
+    estimator = make_estimator()
+    # 实际为 1秒开销 + 每百万像素×步数 0.5秒
+    for _ in range(200):
+        for work in (5.0, 10.0, 40.0):
+            estimator.observe('local', 'f1', work, 1.0 + 0.5 * work)
+    assert estimator.predict('local', 'f1', 20.0) == pytest.approx(11.0, rel=0.01)
+    stats = estimator.get_stats()[0]
+    assert stats['samples'] == 600
+    assert stats['overhead'] == pytest.approx(1.0, abs=0.05)
+    assert stats['seconds_per_megapixel_step'] == pytest.approx(0.5, abs=0.01)
+
+def test_fits_are_per_backend_and_workflow():
+    estimator = make_estimator()
+    for _ in range(50):
+        estimator.observe('fast', 'f1', REFERENCE_WORK, 5.0)
+    assert estimator.predict('fast', 'f1', REFERENCE_WORK) == pytest.approx(5.0, rel=0.05)
+    assert estimator.predict('slow', 'f1', REFERENCE_WORK) == pytest.approx(20.0)
+    assert estimator.predict('fast', 'f2', REFERENCE_WORK) == pytest.approx(20.0)
+
+def test_prediction_has_a_floor():
+    estimator = make_estimator(prior_overhead=0.0)
+    estimator.observe('local', 'f1', 10.0, 0.0)
+    assert estimator.predict('local', 'f1', 0) == 0.1
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片存储测试
+存储目录和索引在pytest的临时目录中，不需要运行中的ComfyUI
+"""
+
+import os
+import time
+
+import pytest
+
+from src import image_store
+from src.image_store import ImageStore, file_checksum
+
+class Clock:
+    """代替图片存储模块中的 time，测试中手动推进"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(image_store, 'time', clock)
+    return clock
+
+def make_store(tmp_path, **storage):
+    return ImageStore(dict({'ttl': 0, 'max_size_mb': 0}, **storage), str(tmp_path))
+
+def save(store, name, size):
+    staging = store.staging_path(name)
+    with open(staging, 'wb') as f:
+        f.write(b'x' * size)
+    return store.commit(name, staging)
+
+def test_commit_and_get(tmp_path):
+    store = make_store(tmp_path)
+    path = save(store, 'a.png', 10)
+    assert os.path.exists(path)
+    assert not os.listdir(store.staging_dir)
+    image = store.get('a.png')
+    assert image['path'] == path
+    assert image['size'] == 10
+    assert image['checksum'] == file_checksum(path)
+    assert store.get('missing.png') is None
+
+def test_ttl_expiry(tmp_path, clock):
+    store = make_store(tmp_path, ttl=3600)
+    save(store, 'old.png', 10)
+    clock.now += 7200
+    save(store, 'new.png', 10)
+    assert store.purge() == 1
+    assert store.get('old.png') is None
+    assert store.get('new.png') is not None
+    assert store.get_stats()['evicted'] == 1
+
+def test_lru_eviction_over_budget(tmp_path, clock):
+    store = make_store(tmp_path, max_size_mb=25 / 1024 / 1024)
+    for name in ('a.png', 'b.png', 'c.png'):
+        save(store, name, 10)
+        clock.now += 100
+    # 读取a更新它的访问时间，淘汰的是次旧的b
+    store.get('a.png')
+    assert store.purge() == 1
+    assert store.get('b.png') is None
+    assert store.get('a.png') is not None and store.get('c.png') is not None
+    stats = store.get_stats()
+    assert stats['images'] == 2 and stats['size_bytes'] == 20
+
+def test_totals_follow_replace_and_delete(tmp_path):
+    store = make_store(tmp_path)
+    save(store, 'a.png', 10)
+    save(store, 'b.png', 20)
+    save(store, 'a.png', 5)
+    assert (store.get_stats()['images'], store.get_stats()['size_bytes']) == (2, 25)
+    store.delete('b.png')
+    assert (store.get_stats()['images'], store.get_stats()['size_bytes']) == (1, 5)
+    # 共享同一索引的其他工作进程看到相同的汇总
+    assert make_store(tmp_path).get_stats()['size_bytes'] == 5
+
+def test_reindex_from_disk(tmp_path):
+    store = make_store(tmp_path)
+    path = save(store, 'a.png', 10)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(store.index_path + suffix):
+            os.remove(store.index_path + suffix)
+
+    # 索引丢失后清理线程启动时扫描存储重建
+    rebuilt = make_store(tmp_path)
+    rebuilt.start()
+    deadline = time.time() + 5
+    while rebuilt.get_stats()['images'] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    rebuilt.stop()
+    image = rebuilt.get('a.png')
+    assert image['path'] == path and image['size'] == 10
+    assert rebuilt.get_stats()['images'] == 1
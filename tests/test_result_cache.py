@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求键和生成结果缓存测试
+缓存目录在pytest的临时目录中，不需要运行中的ComfyUI
+"""
+
+import os
+
+from src.result_cache import ResultCache, make_request_key
+
+PARAMS = {'prompt': 'a cat', 'width': 1024, 'height': 1024, 'steps': 20, 'guidance_scale': 3.5, 'seed': 42}
+
+def write_image(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+def test_request_key_requires_seed():
+    assert make_request_key(dict(PARAMS, seed=-1), 'f1') is None
+    assert make_request_key({k: v for k, v in PARAMS.items() if k != 'seed'}, 'f1') is None
+
+def test_request_key_is_canonical():
+    key = make_request_key(PARAMS, 'f1')
+    same = dict(PARAMS, prompt='  a cat ', width='1024', guidance_scale=3.5, num_images=1)
+    assert make_request_key(same, 'f1') == key
+    assert make_request_key(dict(PARAMS, seed=43), 'f1') != key
+    assert make_request_key(dict(PARAMS, num_images=2), 'f1') != key
+    # 工作流模板或模型变化后指纹不同，旧结果不再命中
+    assert make_request_key(PARAMS, 'f2') != key
+
+def test_put_get_and_stats(tmp_path):
+    cache = ResultCache({'dir': str(tmp_path / 'cache')}, str(tmp_path))
+    key = make_request_key(PARAMS, 'f1')
+    assert cache.get(key) is None
+
+    sources = [write_image(tmp_path / f'src{i}.png', 10) for i in range(2)]
+    cache.put(key, sources)
+    paths = cache.get(key)
+    assert [os.path.basename(path) for path in paths] == [f'{key}.png', f'{key}_1.png']
+    assert cache.contains(key)
+    assert not any(name.endswith('.part') for name in os.listdir(tmp_path / 'cache'))
+
+    stats = cache.get_stats()
+    assert stats['entries'] == 1 and stats['size_bytes'] == 20
+    assert stats['hits'] == 1 and stats['misses'] == 1
+
+def test_lru_eviction(tmp_path):
+    cache = ResultCache({'dir': str(tmp_path / 'cache'), 'max_size_mb': 25 / 1024 / 1024}, str(tmp_path))
+    source = write_image(tmp_path / 'src.png', 10)
+    cache.put('a', [source])
+    cache.put('b', [source])
+    cache.get('a')
+    cache.put('c', [source])
+    assert cache.contains('a') and cache.contains('c')
+    assert not cache.contains('b')
+    assert not os.path.exists(tmp_path / 'cache' / 'b.png')
+
+def test_entries_from_other_workers_and_restart(tmp_path):
+    config = {'dir': str(tmp_path / 'cache')}
+    cache = ResultCache(config, str(tmp_path))
+    other = ResultCache(config, str(tmp_path))
+    other.put('k', [write_image(tmp_path / 'src.png', 10)])
+    # 其他工作进程写入的文件在查找时登记
+    assert cache.get('k') is not None
+    # 重启后扫描目录恢复
+    assert ResultCache(config, str(tmp_path)).get_stats()['entries'] == 1
+
+def test_disabled(tmp_path):
+    cache = ResultCache({'enabled': False, 'dir': str(tmp_path / 'cache')}, str(tmp_path))
+    cache.put('k', [write_image(tmp_path / 'src.png', 10)])
+    assert cache.get('k') is None
+    assert not os.path.exists(tmp_path / 'cache')